@@ -0,0 +1,818 @@
+#!/usr/bin/env python
+
+"""Micro-benchmarks for the adapters. Run all of them or name the ones you
+want on the command-line, e.g. `dev/benchmark.py drain`.
+"""
+
+import os.path
+import sys
+current_path = os.path.dirname(__file__)
+dev_path = os.path.abspath(os.path.join(current_path, '..'))
+sys.path.insert(0, dev_path)
+
+import fcntl
+import select
+import struct
+import threading
+import time
+
+import inotify.adapters
+import inotify.constants
+import inotify.test_support
+
+
+class _CountingEpoll(object):
+    """Stands in for `select.epoll` so that we can count the polls."""
+
+    polls = 0
+
+    def __init__(self):
+        self.__epoll = select.epoll()
+
+    def register(self, *args, **kwargs):
+        return self.__epoll.register(*args, **kwargs)
+
+    def unregister(self, *args, **kwargs):
+        return self.__epoll.unregister(*args, **kwargs)
+
+    def poll(self, *args, **kwargs):
+        _CountingEpoll.polls += 1
+        return self.__epoll.poll(*args, **kwargs)
+
+
+class _CountingSelect(object):
+    epoll = _CountingEpoll
+    POLLIN = select.POLLIN
+
+
+def _count_reads(f):
+    counter = [0]
+    original_read = os.read
+    original_readv = getattr(os, 'readv', None)
+
+    def counting_read(fd, n):
+        counter[0] += 1
+        return original_read(fd, n)
+
+    def counting_readv(fd, buffers):
+        counter[0] += 1
+        return original_readv(fd, buffers)
+
+    os.read = counting_read
+    if original_readv is not None:
+        os.readv = counting_readv
+
+    try:
+        f()
+    finally:
+        os.read = original_read
+        if original_readv is not None:
+            os.readv = original_readv
+
+    return counter[0]
+
+
+def _bench_drain():
+    """Syscalls per event while consuming a create/modify storm."""
+
+    num_files = 2000
+    name_prefix = 'a_rather_long_file_name_to_fill_the_buffer_quickly_'
+
+    original_select = inotify.adapters.select
+    inotify.adapters.select = _CountingSelect
+
+    try:
+        for read_buffer_size in (1024, inotify.adapters._DEFAULT_READ_BUFFER_SIZE):
+            with inotify.test_support.temp_path() as path:
+                i = inotify.adapters.Inotify(block_duration_s=0,
+                                             read_buffer_size=read_buffer_size)
+                i.add_watch(path)
+
+                for n in range(num_files):
+                    with open(os.path.join(path, name_prefix + str(n)), 'w') as f:
+                        f.write('x')
+
+                events = []
+                _CountingEpoll.polls = 0
+
+                def consume():
+                    for event in i.event_gen(timeout_s=0, yield_nones=False):
+                        events.append(event)
+
+                start_s = time.time()
+                reads = _count_reads(consume)
+                elapsed_s = time.time() - start_s
+
+                print("drain: buffer=%6d events=%6d reads=%5d polls=%5d "
+                      "syscalls/event=%.4f time=%.3fs" % (
+                      read_buffer_size, len(events), reads, _CountingEpoll.polls,
+                      float(reads + _CountingEpoll.polls) / len(events),
+                      elapsed_s))
+    finally:
+        inotify.adapters.select = original_select
+
+
+def _bench_parse():
+    """Decoding throughput for synthetic events fed through a pipe."""
+
+    num_rounds = 200
+
+    filename = b'some_file_name.txt'
+    padded_length = (len(filename) // 16 + 1) * 16
+    event = struct.pack(inotify.adapters._HEADER_STRUCT_FORMAT,
+                        1, inotify.constants.IN_MODIFY, 0, padded_length) + \
+            filename.ljust(padded_length, b'\0')
+
+    events_per_round = (60 * 1024) // len(event)
+    chunk = event * events_per_round
+
+    for compact_events in (False, True):
+        i = inotify.adapters.Inotify(compact_events=compact_events)
+        i._Inotify__watch_table.add('/some/watched/path', 1)
+
+        r, w = os.pipe()
+        fcntl.fcntl(r, fcntl.F_SETFL, fcntl.fcntl(r, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+        get_mask = inotify.adapters._get_compact_event_mask if compact_events \
+                   else inotify.adapters._get_event_mask
+
+        try:
+            num_events = 0
+            elapsed_s = 0.0
+            for _ in range(num_rounds):
+                os.write(w, chunk)
+
+                # The consumer only looks at the mask.
+                start_s = time.time()
+                for e in i._handle_inotify_event(r):
+                    if get_mask(e) & inotify.constants.IN_MODIFY:
+                        num_events += 1
+                elapsed_s += time.time() - start_s
+        finally:
+            os.close(r)
+            os.close(w)
+
+        print("parse: compact=%-5s events=%d time=%.3fs events/s=%d" % (
+              compact_events, num_events, elapsed_s, num_events / elapsed_s))
+
+
+def _bench_names():
+    """Type-name resolution: list copies vs. the immutable tables."""
+
+    import timeit
+
+    masks = [
+        inotify.constants.IN_MODIFY,
+        inotify.constants.IN_CREATE | inotify.constants.IN_ISDIR,
+        inotify.constants.IN_CLOSE_WRITE,
+        inotify.constants.IN_IGNORED,
+    ]
+
+    lookup_comb = inotify.constants.MASK_LOOKUP_COMB
+
+    def copy_event_names(event_type):
+        try:
+            return lookup_comb[event_type][:]
+        except KeyError as ex:
+            raise AssertionError("We could not resolve all event-types (%x)" % event_type)
+
+    def copy_names():
+        for mask in masks:
+            copy_event_names(mask)
+
+    get_event_names = inotify.adapters._get_event_names
+
+    def table_names():
+        for mask in masks:
+            get_event_names(mask)
+
+    number = 200000
+    for name, f in (('copy', copy_names), ('table', table_names)):
+        elapsed_s = min(timeit.repeat(f, number=number, repeat=3))
+        print("names: %-5s %.1f ns/lookup" % (
+              name, elapsed_s / (number * len(masks)) * 1e9))
+
+
+def _bench_read_events():
+    """One-shot reads from an event-loop: the generator idiom (a zero
+    block-duration and looking for the None) vs. `read_events()`, for an
+    empty queue and for a few queued events.
+    """
+
+    num_reads = 1000
+    num_files = 10
+
+    with inotify.test_support.temp_path() as path:
+        i = inotify.adapters.Inotify(block_duration_s=0)
+        i.add_watch(path, inotify.constants.IN_CREATE)
+
+        def read_with_generator():
+            events = []
+            for event in i.event_gen():
+                if event is None:
+                    break
+
+                events.append(event)
+
+            return events
+
+        def read_with_read_events():
+            return i.read_events(timeout_s=0)
+
+        for (name, read) in (('event_gen', read_with_generator),
+                             ('read_events', read_with_read_events)):
+            start_s = time.time()
+            for _ in range(num_reads):
+                read()
+
+            empty_s = (time.time() - start_s) / num_reads
+
+            num_events = 0
+            queued_s = 0
+            for n1 in range(num_reads // 10):
+                for n2 in range(num_files):
+                    with open(os.path.join(path, 'file_%s_%d_%d' % (name, n1, n2)), 'w'):
+                        pass
+
+                start_s = time.time()
+                num_events += len(read())
+                queued_s += time.time() - start_s
+
+            print("read_events: api=%-11s empty=%.1fus queued=%.1fus events=%d" % (
+                  name, empty_s * 1e6, queued_s / (num_reads // 10) * 1e6,
+                  num_events))
+
+
+def _bench_tree_load():
+    """Directories watched per second by the initial tree-load, serially and
+    with several workers.
+    """
+
+    fan_out = 12
+
+    with inotify.test_support.temp_path() as path:
+        for n1 in range(fan_out):
+            for n2 in range(fan_out):
+                for n3 in range(fan_out):
+                    os.makedirs(os.path.join(path, str(n1), str(n2), str(n3)))
+
+        for load_workers in (None, 2, 4, 8):
+            i = inotify.adapters.InotifyTree(path, load_workers=load_workers)
+            stats = i.load_stats
+
+            print("tree_load: workers=%d directories=%d time=%.3fs "
+                  "directories/s=%d" % (
+                  stats['workers'], stats['directories'], stats['seconds'],
+                  stats['directories_per_s']))
+
+            del i
+
+
+def _bench_tree_move():
+    """Time and add-watch calls to handle renaming a large subtree within the
+    tree.
+    """
+
+    fan_out = 12
+
+    with inotify.test_support.temp_path() as path:
+        for n1 in range(fan_out):
+            for n2 in range(fan_out):
+                for n3 in range(fan_out):
+                    os.makedirs(os.path.join(path, 'old', str(n1), str(n2), str(n3)))
+
+        i = inotify.adapters.InotifyTree(path, block_duration_s=0.1)
+
+        add_watch_calls = [0]
+        original_add_watch = i._i.add_watch
+
+        def counting_add_watch(*args, **kwargs):
+            add_watch_calls[0] += 1
+            return original_add_watch(*args, **kwargs)
+
+        i._i.add_watch = counting_add_watch
+
+        os.rename(os.path.join(path, 'old'), os.path.join(path, 'new'))
+
+        start_s = time.time()
+        events = list(i.event_gen(timeout_s=0, yield_nones=False))
+        elapsed_s = time.time() - start_s
+
+        print("tree_move: directories=%d events=%d add_watch=%d time=%.3fs" % (
+              len(i._i._get_watch_tree(os.path.join(path, 'new'))),
+              len(events), add_watch_calls[0], elapsed_s))
+
+
+def _bench_emit_existing():
+    """Time to the first event with the whole tree walked up-front vs. walked
+    as the events are taken.
+    """
+
+    fan_out = 12
+
+    with inotify.test_support.temp_path() as path:
+        for n1 in range(fan_out):
+            for n2 in range(fan_out):
+                for n3 in range(fan_out):
+                    os.makedirs(os.path.join(path, str(n1), str(n2), str(n3)))
+
+        for emit_existing in (False, True):
+            start_s = time.time()
+            i = inotify.adapters.InotifyTree(path, emit_existing=emit_existing)
+
+            with open(os.path.join(path, 'new_file'), 'w'):
+                pass
+
+            mask = inotify.constants.IN_CREATE
+            events = i.event_gen(yield_nones=False, mask=mask)
+            next(events)
+            first_s = time.time() - start_s
+
+            num_events = 1 + len(list(i.event_gen(timeout_s=0, yield_nones=False,
+                                                  mask=mask)))
+            all_s = time.time() - start_s
+
+            print("emit_existing: emit_existing=%s first_event=%.3fs "
+                  "events=%d all=%.3fs directories=%d" % (
+                  emit_existing, first_s, num_events, all_s,
+                  i.load_stats['directories']))
+
+            os.unlink(os.path.join(path, 'new_file'))
+            del i
+
+
+def _bench_progressive():
+    """Time until the constructor returns and until the first event arrives,
+    with the tree loaded up-front vs. progressively.
+    """
+
+    fan_out = 12
+
+    with inotify.test_support.temp_path() as path:
+        for n1 in range(fan_out):
+            for n2 in range(fan_out):
+                for n3 in range(fan_out):
+                    os.makedirs(os.path.join(path, str(n1), str(n2), str(n3)))
+
+        for progressive in (False, True):
+            start_s = time.time()
+            i = inotify.adapters.InotifyTree(path, progressive=progressive)
+            constructed_s = time.time() - start_s
+
+            with open(os.path.join(path, 'new_file'), 'w'):
+                pass
+
+            events = i.event_gen(yield_nones=False, mask=inotify.constants.IN_CREATE)
+            next(events)
+            first_s = time.time() - start_s
+
+            (loaded, pending) = i.load_progress
+
+            while i.loading is True:
+                i.read_batch(timeout_s=0)
+
+            loaded_s = time.time() - start_s
+
+            print("progressive: progressive=%s constructed=%.3fs "
+                  "first_event=%.3fs (loaded=%d pending=%d) loaded=%.3fs "
+                  "directories=%d" % (
+                  progressive, constructed_s, first_s, loaded, pending,
+                  loaded_s, i.load_stats['directories']))
+
+            os.unlink(os.path.join(path, 'new_file'))
+            del i
+
+
+def _bench_watch_budget():
+    """Loading a tree within a watch-budget that's a fraction of its
+    directories, and what a sweep of the polled ones costs.
+    """
+
+    fan_out = 12
+
+    with inotify.test_support.temp_path() as path:
+        for n1 in range(fan_out):
+            for n2 in range(fan_out):
+                for n3 in range(fan_out):
+                    os.makedirs(os.path.join(path, str(n1), str(n2), str(n3)))
+
+        # Nothing has changed in a while.
+        past_s = time.time() - 60
+        for (dirpath, _, _) in os.walk(path):
+            os.utime(dirpath, (past_s, past_s))
+
+        for watch_budget in (None, 1000, 100):
+            start_s = time.time()
+            i = inotify.adapters.InotifyTree(path, watch_budget=watch_budget,
+                                             poll_interval_s=0)
+            load_s = time.time() - start_s
+
+            if watch_budget is None:
+                print("watch_budget: budget=None load=%.3fs" % (load_s,))
+                continue
+
+            # What the load left queued.
+            i.read_batch(timeout_s=0)
+
+            start_s = time.time()
+            i.read_batch(timeout_s=0)
+            sweep_s = time.time() - start_s
+
+            stats = i.budget_stats
+            print("watch_budget: budget=%d load=%.3fs watched=%d polled=%d "
+                  "evicted=%d sweep=%.4fs" % (
+                  watch_budget, load_s, stats['watched'], stats['polled'],
+                  stats['evicted'], sweep_s))
+
+            del i
+
+
+def _bench_shards():
+    """A burst of events spread over a tree, without reading them, with the
+    watches on one inotify queue vs. spread over several.
+    """
+
+    fan_out = 8
+    num_files = 30000
+
+    with inotify.test_support.temp_path() as path:
+        directories = []
+        for n1 in range(fan_out):
+            directory = os.path.join(path, str(n1))
+            os.mkdir(directory)
+            directories.append(directory)
+
+        for shards in (1, 2, 4):
+            i = inotify.adapters.InotifyTree(path, shards=shards,
+                                             mask=inotify.constants.IN_CREATE)
+
+            for n2 in range(num_files):
+                directory = directories[n2 % fan_out]
+                with open(os.path.join(directory, 'file_%d_%d' % (shards, n2)), 'w'):
+                    pass
+
+            queued_bytes = [stats['queued_bytes'] for stats in i.inotify.shard_stats]
+
+            try:
+                events = list(i.event_gen(timeout_s=0, yield_nones=False))
+                num_events = len(events)
+            except inotify.adapters.TerminalEventException:
+                num_events = -1
+
+            print("shards: shards=%d events=%d overflows=%d queued_bytes=%s" % (
+                  shards, num_events,
+                  sum(stats['overflows'] for stats in i.inotify.shard_stats),
+                  queued_bytes))
+
+            del i
+
+
+def _bench_hub():
+    """Many watchers with a thread each (`BackgroundReader`) vs. all of them
+    on one `EventHub`.
+    """
+
+    num_watchers = 64
+    num_files = 100
+
+    with inotify.test_support.temp_path() as path:
+        directories = []
+        for n1 in range(num_watchers):
+            directory = os.path.join(path, str(n1))
+            os.mkdir(directory)
+            directories.append(directory)
+
+        for hub in (False, True):
+            adapters = []
+            for directory in directories:
+                i = inotify.adapters.Inotify(block_duration_s=0.1)
+                i.add_watch(directory, inotify.constants.IN_CREATE)
+                adapters.append(i)
+
+            if hub is True:
+                h = inotify.adapters.EventHub(block_duration_s=0.1)
+                for i in adapters:
+                    h.add_adapter(i)
+
+                events = h.event_gen(yield_nones=False)
+            else:
+                readers = [inotify.adapters.BackgroundReader(i) for i in adapters]
+                for reader in readers:
+                    reader.start()
+
+            num_threads = threading.active_count()
+
+            start_s = time.time()
+            for n2 in range(num_files):
+                for directory in directories:
+                    with open(os.path.join(directory, 'file_%d_%d' % (hub, n2)), 'w'):
+                        pass
+
+            num_events = 0
+            if hub is True:
+                for _ in events:
+                    num_events += 1
+                    if num_events == num_watchers * num_files:
+                        break
+
+                h.close()
+            else:
+                for reader in readers:
+                    while num_events < num_files * (readers.index(reader) + 1):
+                        num_events += len(reader.get_batch(timeout_s=1))
+
+            elapsed_s = time.time() - start_s
+
+            if hub is False:
+                for reader in readers:
+                    reader.stop()
+
+                del readers
+
+            print("hub: hub=%s threads=%d events=%d elapsed=%.3fs" % (
+                  hub, num_threads, num_events, elapsed_s))
+
+            del adapters[:]
+
+
+def _bench_checkpoint():
+    """Loading a tree from scratch vs. from its checkpoint, with a few of the
+    directories changed in-between.
+    """
+
+    fan_out = 12
+    num_files = 10
+    num_changed = 10
+
+    with inotify.test_support.temp_path() as checkpoint_path:
+        checkpoint_filepath = os.path.join(checkpoint_path, 'checkpoint')
+
+        with inotify.test_support.temp_path() as path:
+            directories = []
+            for n1 in range(fan_out):
+                for n2 in range(fan_out):
+                    for n3 in range(fan_out):
+                        directory = os.path.join(path, str(n1), str(n2), str(n3))
+                        os.makedirs(directory)
+                        directories.append(directory)
+
+                        for n4 in range(num_files):
+                            with open(os.path.join(directory, 'file_%d' % n4), 'w'):
+                                pass
+
+            # Nothing has changed in a while.
+            past_s = time.time() - 60
+            for (dirpath, _, _) in os.walk(path):
+                os.utime(dirpath, (past_s, past_s))
+
+            start_s = time.time()
+            i = inotify.adapters.InotifyTree(path, index=True)
+            cold_s = time.time() - start_s
+
+            i.save_checkpoint(checkpoint_filepath)
+            del i
+
+            for directory in directories[:num_changed]:
+                with open(os.path.join(directory, 'new_file'), 'w'):
+                    pass
+
+            start_s = time.time()
+            i = inotify.adapters.InotifyTree(path, checkpoint=checkpoint_filepath)
+            warm_s = time.time() - start_s
+
+            events = list(i.event_gen(timeout_s=0, yield_nones=False,
+                                      mask=inotify.constants.IN_CREATE))
+
+            print("checkpoint: directories=%d cold=%.3fs warm=%.3fs relisted=%d "
+                  "created=%d checkpoint_bytes=%d" % (
+                  i.load_stats['directories'], cold_s, warm_s,
+                  i.load_stats['relisted'], len(events),
+                  os.path.getsize(checkpoint_filepath)))
+
+
+def _synthetic_paths(fan_out=10, depth=5, root='/srv/data/projects/deployment'):
+    paths = [root]
+    level = [root]
+    for _ in range(depth):
+        level = [os.path.join(parent, 'directory_%02d' % n)
+                 for parent in level
+                 for n in range(fan_out)]
+        paths.extend(level)
+
+    return paths
+
+
+def _bench_watch_table():
+    """Memory per watch and subtree lookups: flat dictionaries vs. the
+    watch-table.
+    """
+
+    import tracemalloc
+
+    # Copies, like the paths that we decode.
+    paths = [''.join(path) for path in _synthetic_paths()]
+    subtree = os.path.join(paths[0], 'directory_03', 'directory_07')
+
+    def flat():
+        watches = {}
+        watches_r = {}
+        for wd, path in enumerate(paths, 1):
+            path = ''.join(path)
+            watches[path] = wd
+            watches_r[wd] = path
+
+        return watches
+
+    def flat_subtree(watches):
+        prefix = os.path.join(subtree, '')
+        return [(path, wd)
+                for (path, wd) in watches.items()
+                if path == subtree or path.startswith(prefix)]
+
+    def table():
+        t = inotify.adapters._WatchTable()
+        for wd, path in enumerate(paths, 1):
+            t.add(''.join(path), wd)
+
+        return t
+
+    def table_subtree(t):
+        return t.get_tree(subtree)
+
+    def compact_table():
+        t = inotify.adapters._CompactWatchTable()
+        for wd, path in enumerate(paths, 1):
+            t.add(''.join(path), wd)
+
+        return t
+
+    for name, build, get_subtree in (('flat', flat, flat_subtree),
+                                     ('table', table, table_subtree),
+                                     ('compact', compact_table, table_subtree)):
+        tracemalloc.start()
+        watches = build()
+        (allocated, _) = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        start_s = time.time()
+        found = get_subtree(watches)
+        elapsed_s = time.time() - start_s
+
+        print("watch_table: %-7s watches=%d bytes/watch=%d "
+              "subtree=%d subtree_time=%.6fs" % (
+              name, len(paths), allocated / len(paths), len(found), elapsed_s))
+
+
+def _bench_memory():
+    """Python-side bytes per watch of an `InotifyTree` over a deep tree, with
+    the default and with the compact watch-table.
+    """
+
+    import tracemalloc
+
+    fan_out = 6
+    depth = 5
+
+    def make_tree(path, level):
+        if level == depth:
+            return
+
+        for n in range(fan_out):
+            child_path = os.path.join(path, 'some_directory_name_%02d' % n)
+            os.mkdir(child_path)
+            make_tree(child_path, level + 1)
+
+    with inotify.test_support.temp_path() as empty_path:
+        with inotify.test_support.temp_path() as path:
+            make_tree(path, 0)
+
+            for compact_watches in (False, True):
+                # The buffers and such of the adapter itself.
+                tracemalloc.start()
+                i = inotify.adapters.InotifyTree(empty_path, compact_watches=compact_watches)
+                (baseline, _) = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                del i
+
+                tracemalloc.start()
+                i = inotify.adapters.InotifyTree(path, compact_watches=compact_watches)
+                (allocated, _) = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+
+                num_watches = len(i._i._Inotify__watches)
+                del i
+
+                print("memory: compact_watches=%-5s watches=%d bytes/watch=%d" % (
+                      compact_watches, num_watches,
+                      (allocated - baseline) / num_watches))
+
+
+def _bench_masks():
+    """Events read while only *IN_CLOSE_WRITE* is wanted from files that are
+    mostly being read, with and without pushing the mask down.
+    """
+
+    num_files = 200
+    num_reads = 10
+
+    for push_masks in (False, True):
+        with inotify.test_support.temp_path() as path:
+            for n in range(num_files):
+                with open(os.path.join(path, 'file_%d' % n), 'w') as f:
+                    f.write('x')
+
+            i = inotify.adapters.Inotify(block_duration_s=0, push_masks=push_masks)
+            i.add_watch(path)
+
+            # What `event_gen()` does while it's being iterated.
+            if push_masks is True:
+                i.add_consumer(inotify.constants.IN_CLOSE_WRITE)
+
+            for n in range(num_files):
+                file_path = os.path.join(path, 'file_%d' % n)
+                for _ in range(num_reads):
+                    with open(file_path) as f:
+                        f.read()
+
+                with open(file_path, 'w') as f:
+                    f.write('y')
+
+            read = list(i._event_gen(timeout_s=0, yield_nones=False))
+            delivered = [e for e in read
+                         if e[0].mask & inotify.constants.IN_CLOSE_WRITE]
+
+            print("masks: push_masks=%-5s events_read=%d delivered=%d" % (
+                  push_masks, len(read), len(delivered)))
+
+
+def _bench_index():
+    """Directory listings and existence checks from the tree-index vs. the
+    filesystem.
+    """
+
+    fan_out = 8
+    num_files = 20
+
+    with inotify.test_support.temp_path() as path:
+        directories = []
+        for n1 in range(fan_out):
+            for n2 in range(fan_out):
+                directory = os.path.join(path, str(n1), str(n2))
+                os.makedirs(directory)
+                directories.append(directory)
+
+                for n3 in range(num_files):
+                    with open(os.path.join(directory, 'file_%d' % n3), 'w'):
+                        pass
+
+        file_paths = [os.path.join(directory, 'file_%d' % n)
+                      for directory in directories
+                      for n in range(num_files)]
+
+        i = inotify.adapters.InotifyTree(path, index=True)
+        index = i.index
+
+        for name, listdir, exists in (('filesystem', os.listdir, os.path.exists),
+                                      ('index', index.listdir, index.exists)):
+            start_s = time.time()
+            for directory in directories:
+                listdir(directory)
+            listdir_s = time.time() - start_s
+
+            start_s = time.time()
+            for file_path in file_paths:
+                exists(file_path)
+            exists_s = time.time() - start_s
+
+            print("index: %-10s listdir=%.1fus exists=%.1fus" % (
+                  name, listdir_s / len(directories) * 1e6,
+                  exists_s / len(file_paths) * 1e6))
+
+
+_BENCHMARKS = [
+    ('drain', _bench_drain),
+    ('parse', _bench_parse),
+    ('names', _bench_names),
+    ('read_events', _bench_read_events),
+    ('tree_load', _bench_tree_load),
+    ('tree_move', _bench_tree_move),
+    ('checkpoint', _bench_checkpoint),
+    ('emit_existing', _bench_emit_existing),
+    ('progressive', _bench_progressive),
+    ('watch_budget', _bench_watch_budget),
+    ('shards', _bench_shards),
+    ('hub', _bench_hub),
+    ('watch_table', _bench_watch_table),
+    ('memory', _bench_memory),
+    ('masks', _bench_masks),
+    ('index', _bench_index),
+]
+
+def _main():
+    names = sys.argv[1:]
+    for name, f in _BENCHMARKS:
+        if not names or name in names:
+            f()
+
+if __name__ == '__main__':
+    _main()
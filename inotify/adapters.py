@@ -1,22 +1,54 @@
 import logging
 import select
+import fcntl
+import termios
 import os
 import struct
 import collections
+import itertools
+import threading
 import time
+import array
+import re
+import stat
 
 if hasattr(os, 'scandir'):
-    from os import walk
+    from os import walk, scandir
     scandirmode = 'builtin'
 else:
     try:
-        from scandir import walk
+        from scandir import walk, scandir
         scandirmode = 'external'
     except ImportError:
         from os import walk
+        scandir = None
         scandirmode = 'unavailable'
 
-from errno import EINTR
+try:
+    import concurrent.futures
+    _HAS_FUTURES = True
+except ImportError:
+    _HAS_FUTURES = False
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+try:
+    from sys import intern as _intern
+except ImportError:
+    # Python 2 only interns byte-strings.
+    def _intern(name):
+        return name
+
+try:
+    _monotonic = time.monotonic
+except AttributeError:
+    # Python 2 (where we can't tell wall-clock jumps).
+    _monotonic = time.time
+
+from errno import EINTR, EAGAIN, ENOSPC
 
 import inotify.constants
 import inotify.calls
@@ -24,8 +56,95 @@ import inotify.calls
 # Constants.
 
 _DEFAULT_EPOLL_BLOCK_DURATION_S = 1
+_DEFAULT_READ_BUFFER_SIZE = 64 * 1024
+_DEFAULT_QUEUE_MAX_SIZE = 64 * 1024
+_DEFAULT_DISPATCH_WORKERS = 4
+_DEFAULT_DISPATCH_MAX_IN_FLIGHT = 1024
+_DEFAULT_COALESCE_QUIET_S = 0.1
+_DEFAULT_COALESCE_MAX_LATENCY_S = 1.0
+_DEFAULT_MOVE_TIMEOUT_S = 0.5
+_DEFAULT_MOVE_MAX_PENDING = 4096
+
+# How many directories a progressive load lists in-between looking for
+# events.
+_PROGRESSIVE_LOAD_STEP = 64
+
+# How often the directories that we couldn't watch within the budget are
+# looked at.
+_DEFAULT_POLL_INTERVAL_S = 1.0
+
+_MAX_USER_WATCHES_FILEPATH = '/proc/sys/fs/inotify/max_user_watches'
+
+# The events that the trees need to curate their watches.
+_TREE_CURATION_MASK = inotify.constants.IN_CREATE | \
+                      inotify.constants.IN_MOVED_TO | \
+                      inotify.constants.IN_DELETE | \
+                      inotify.constants.IN_MOVED_FROM | \
+                      inotify.constants.IN_DELETE_SELF | \
+                      inotify.constants.IN_MOVE_SELF
+
+# How close to when we looked at a directory its modification-time has to be
+# for us to not trust it (timestamps are coarser than the changes).
+_INDEX_RACY_S = 1.0
+
+# The events that change what a tree-index has for a directory.
+_INDEX_LISTING_MASK = inotify.constants.IN_CREATE | \
+                         inotify.constants.IN_DELETE | \
+                         inotify.constants.IN_MOVED_FROM | \
+                         inotify.constants.IN_MOVED_TO
+
+_INDEX_MASK = _INDEX_LISTING_MASK | \
+                 inotify.constants.IN_MODIFY | \
+                 inotify.constants.IN_ATTRIB | \
+                 inotify.constants.IN_CLOSE_WRITE
+
+# The checkpoint-file: a header, then, for every tree, its root and the
+# directories with their entries.
+_CHECKPOINT_MAGIC = b'INOTIFYC'
+_CHECKPOINT_VERSION = 1
+_CHECKPOINT_HEADER = struct.Struct('<8sII')     # magic, version, trees
+_CHECKPOINT_ROOT = struct.Struct('<HI')         # path-length, directories
+_CHECKPOINT_DIRECTORY = struct.Struct('<HQddI') # path-length, ino, mtime, when we looked, entries
+_CHECKPOINT_ENTRY = struct.Struct('<B?')        # name-length, is_dir
+
+# The parts of a watch-mask that aren't events and that we keep when we
+# re-add a watch with a narrower mask.
+_WATCH_FLAGS = inotify.constants.IN_ONLYDIR | \
+               inotify.constants.IN_DONT_FOLLOW | \
+               inotify.constants.IN_EXCL_UNLINK | \
+               inotify.constants.IN_ONESHOT
+
+# How many resolved paths the watch-table caches for event delivery.
+_WATCH_PATH_CACHE_SIZE = 4096
+
+# How many directories a worker scans before handing the rest back.
+_LOAD_DIRECTORIES_PER_TASK = 64
+
 _HEADER_STRUCT_FORMAT = 'iIII'
 
+# Policies for a full `BackgroundReader` queue.
+OVERFLOW_BLOCK = 'block'
+OVERFLOW_DROP_OLDEST = 'drop_oldest'
+OVERFLOW_DROP_NEWEST = 'drop_newest'
+OVERFLOW_COALESCE = 'coalesce'
+
+_OVERFLOW_POLICIES = (
+    OVERFLOW_BLOCK,
+    OVERFLOW_DROP_OLDEST,
+    OVERFLOW_DROP_NEWEST,
+    OVERFLOW_COALESCE,
+)
+
+# How `EventDispatcher` assigns events to shards.
+SHARD_BY_WD = 'wd'
+SHARD_BY_PATH = 'path'
+
+# `EventCoalescer` rules: a pending event that has any of the first bits is
+# cancelled, together with a following event that has any of the second.
+_DEFAULT_CANCEL_RULES = (
+    (inotify.constants.IN_CREATE, inotify.constants.IN_DELETE),
+)
+
 # todo: the real terminal event beside IN_Q_OVERFLOW is IN_IGNORED
 # ohterwise the IN_DELETE_SELF would count as much as IN_UNMOUNT
 # where both could be handled differently, depending on context
@@ -48,454 +167,5055 @@ _INOTIFY_EVENT = collections.namedtuple(
                         'len',
                     ])
 
-_STRUCT_HEADER_LENGTH = struct.calcsize(_HEADER_STRUCT_FORMAT)
+_HEADER_STRUCT = struct.Struct(_HEADER_STRUCT_FORMAT)
+_STRUCT_HEADER_LENGTH = _HEADER_STRUCT.size
+
+# The largest single event the kernel can hand us (header plus NAME_MAX and
+# the terminating NUL). A read that leaves at least this much room unused
+# means that the queue has been drained.
+_MAX_EVENT_LENGTH = _STRUCT_HEADER_LENGTH + 255 + 1
+_EVENT_NAMES = dict(inotify.constants.MASK_LOOKUP_NAMES)
+_NAME_LOOKUP = dict((name, bit) for bit, name in inotify.constants.MASK_LOOKUP.items())
 _IS_DEBUG = bool(int(os.environ.get('DEBUG', '0')))
 
-#todo: we should have a master exception for the whole adapter
-class EventTimeoutException(Exception):
-    pass
+if hasattr(os, 'readv'):
+    def _read_into(fd, view):
+        return os.readv(fd, [view])
+else:
+    def _read_into(fd, view):
+        b = os.read(fd, len(view))
+        view[:len(b)] = b
+        return len(b)
 
+def _get_deadline(timeout_s):
+    """The monotonic time at which a wait of `timeout_s` seconds is over (None
+    for forever).
+    """
 
-#todo: we should have a master exception for the whole adapter
-class TerminalEventException(Exception):
-    def __init__(self, type_name, event):
-        super(TerminalEventException, self).__init__(type_name)
-        self.event = event
+    if timeout_s is None:
+        return None
 
+    return _monotonic() + timeout_s
 
-class Inotify(object):
-    def __init__(self, paths=[], block_duration_s=_DEFAULT_EPOLL_BLOCK_DURATION_S):
-        self.__block_duration = block_duration_s
-        self.__watches = {}
-        self.__watches_r = {}
-        self.__buffer = b''
 
-        self.__inotify_fd = inotify.calls.inotify_init()
-        _LOGGER.debug("Inotify handle is (%d).", self.__inotify_fd)
+def _get_event_names(event_type):
+    """Return the (shared, immutable) type-names for a mask. Combinations
+    that weren't precomputed are resolved bit-by-bit once and then cached.
+    Bits we don't know of are ignored.
+    """
 
-        self.__epoll = select.epoll()
-        self.__epoll.register(self.__inotify_fd, select.POLLIN)
+    try:
+        return _EVENT_NAMES[event_type]
+    except KeyError:
+        type_names = tuple(name for bit, name in inotify.constants.MASK_LOOKUP_BITS
+                           if event_type & bit)
 
-        self.__last_success_return = None
+        _EVENT_NAMES[event_type] = type_names
+        return type_names
 
-        for path in paths:
-            self.add_watch(path)
+def _get_event_mask(event):
+    return event[0].mask
 
-    def __get_block_duration(self):
-        """Allow the block-duration to be an integer or a function-call."""
+def _get_compact_event_mask(event):
+    return event.mask
 
-        try:
-            return self.__block_duration()
-        except TypeError:
-            # A scalar value describing seconds.
-            return self.__block_duration
+def _get_any_event_mask(event):
+    if isinstance(event, InotifyEvent):
+        return event.mask
 
-    def __del__(self):
-        _LOGGER.debug("Cleaning-up inotify.")
-        os.close(self.__inotify_fd)
+    return event[0].mask
 
-    def add_watch(self, path_unicode, mask=inotify.constants.IN_ALL_EVENTS_WATCH):
-        _LOGGER.debug("Adding watch: [%s]", path_unicode)
-        # todo: log a warning if user supplies something in mask that is not valid as mask (but silently ignored)
-        # defined IN_ALL_MASKVALS for that (should encourage user to understand when they are requesting something
-        # wrong and make it more likely that they log an issue if they have some valid mask value from sources
-        # which isn't implemented in PyInotify
+def _get_event_key(event):
+    """The path and filename that an event is about."""
 
-        # todo: handle removes for same object (with possible different pathnames)
-        # more outcome-oriented
+    if isinstance(event, InotifyEvent):
+        return (event.path, event.filename_bytes)
 
-        # todo: cope with the mentioned race-conditions
-        # Because there might be race-conditions in the recursive handling (see
-        # the notes in the documentation), we recommend to add watches using
-        # data from a secondary channel, if possible, which means that we might
-        # then be adding it, yet again, if we then receive it in the normal
-        # fashion afterward.
-        if path_unicode in self.__watches:
-            # to consider: a raise would be more appropriate for most cases
-            _LOGGER.warning("Path already being watched: [%s]", path_unicode)
-            return
+    return (event[2], event[3])
 
-        path_bytes = path_unicode.encode('utf8')
+def _merge_events(event, other):
+    """Return a single event for (event) followed by (other), for the same
+    path. The masks are OR-ed and the cookie of the latter is kept.
+    """
 
-        wd = inotify.calls.inotify_add_watch(self.__inotify_fd, path_bytes, mask)
-        _LOGGER.debug("Added watch (%d): [%s]", wd, path_unicode)
+    if isinstance(event, InotifyEvent):
+        return InotifyEvent(event.wd, event.mask | other.mask, other.cookie,
+                            event.len, event.filename_bytes, event.path)
 
-        self.__watches[path_unicode] = wd
-        self.__watches_r[wd] = path_unicode
+    (header, _, path, filename) = event
+    other_header = other[0]
+    mask = header.mask | other_header.mask
+    return (_INOTIFY_EVENT(header.wd, mask, other_header.cookie, header.len),
+            _get_event_names(mask), path, filename)
 
-        return wd
+def _make_event(wd, mask, path, filename, compact_events=False):
+    """An event that we generate rather than read. It's flagged with
+    *IN_SYNTHETIC*, and the cookie and length are zero.
+    """
 
-    def _remove_watch(self, wd, path, superficial=False):
-        _LOGGER.debug("Removing watch for watch-handle (%d): [%s]",
-                      wd, path)
+    mask |= inotify.constants.IN_SYNTHETIC
 
-        if superficial is not None:
-            del self.__watches[path]
-            del self.__watches_r[wd]
-            inotify.adapters._LOGGER.debug(".. removed from adaptor")
-        if superficial is not False:
-            return
-        inotify.calls.inotify_rm_watch(self.__inotify_fd, wd)
-        _LOGGER.debug(".. removed from inotify")
+    if compact_events is True:
+        return InotifyEvent(wd, mask, 0, 0, filename.encode('utf8'), path)
 
+    return (_INOTIFY_EVENT(wd, mask, 0, 0), _get_event_names(mask), path, filename)
 
-    def remove_watch(self, path, superficial=False):
-        """Remove our tracking information and call inotify to stop watching
-        the given path. When a directory is removed, we'll just have to remove
-        our tracking since inotify already cleans-up the watch.
-        With superficial set to None it is also possible to remove only inotify
-        watch to be able to wait for the final IN_IGNORED event received for
-        the wd (useful for example in threaded applications).
-        """
+def _get_names_mask(type_names):
+    mask = 0
+    for type_name in type_names:
+        mask |= _NAME_LOOKUP.get(type_name, 0)
 
-        # todo: handle removes for same object (with possible different pathnames)
-        # more outcome-oriented
+    return mask
 
-        wd = self.__watches.get(path)
-        if wd is None:
-            _LOGGER.warning("Path not in watch list: [%s]", path)
-            #todo: returning always None but no success indicator is not fine
-            # to consider: a raise would be more appropriate for most cases
-            return
-        self._remove_watch(wd, path, superficial)
+def _translate_glob(pattern):
+    """Translate a gitignore-style glob to a regular expression: "*" and "?"
+    don't match a separator, "**/" matches any number of directories and a
+    trailing "**" everything below.
+    """
 
-    def remove_watch_with_id(self, wd, superficial=False):
-        """Same as remove_watch but does the same by id"""
-        path = self.__watches_r.get(wd)
-        if path is None:
-            #todo: returning always None but no success indicator is not fine
-            # to consider: a raise would be more appropriate for most cases
-            _LOGGER.warning("Watchdescriptor not in watch list: [%d]", wd)
-            return
-        self._remove_watch(wd, path, superficial)
+    parts = []
+    i = 0
+    n = len(pattern)
+    while i < n:
+        c = pattern[i]
+        if c == '*':
+            if pattern.startswith('**/', i):
+                parts.append('(?:.*/)?')
+                i += 3
+            elif pattern.startswith('**', i):
+                parts.append('.*')
+                i += 2
+            else:
+                parts.append('[^/]*')
+                i += 1
+        elif c == '?':
+            parts.append('[^/]')
+            i += 1
+        elif c == '[':
+            j = pattern.find(']', i + 2)
+            if j == -1:
+                parts.append('\\[')
+                i += 1
+            else:
+                body = pattern[i + 1:j].replace('\\', '\\\\')
+                if body.startswith('!'):
+                    body = '^' + body[1:]
 
-    def _get_event_names(self, event_type):
-        try:
-            return inotify.constants.MASK_LOOKUP_COMB[event_type][:]
-        except KeyError as ex:
-            raise AssertionError("We could not resolve all event-types (%x)" % event_type)
+                parts.append('[%s]' % body)
+                i = j + 1
+        else:
+            parts.append(re.escape(c))
+            i += 1
 
-    def _handle_inotify_event(self, wd):
-        """Handle a series of events coming-in from inotify."""
+    return ''.join(parts)
 
-        # to consider: inotify should always return only complete events
-        # for a single read, so implementation could be optimized
-        b = os.read(wd, 1024)
-        if not b:
-            return
 
-        self.__buffer += b
+class _IgnoreMatcher(object):
+    """Patterns for the paths (relative to the top of their tree) that we
+    don't want to watch, compiled into a single regular expression (plus one
+    for the directory-only patterns).
 
-        while 1:
-            length = len(self.__buffer)
+    Strings are gitignore-style globs: without a slash they match the name at
+    any depth (e.g. "node_modules" or "*.pyc"), otherwise the whole relative
+    path (e.g. "build/output" or "**/cache/*"), and with a trailing slash
+    only directories. Negation ("!") is not supported. Compiled regular
+    expressions are matched from the start of the relative path.
+    """
 
-            if length < _STRUCT_HEADER_LENGTH:
-                _LOGGER.debug("Not enough bytes for a header.")
-                return
+    def __init__(self, patterns):
+        any_parts = []
+        dir_parts = []
 
-            # We have, at least, a whole-header in the buffer.
+        for pattern in patterns:
+            if hasattr(pattern, 'pattern'):
+                if pattern.flags & ~re.UNICODE:
+                    raise ValueError("Use inline flags for the ignore pattern: %r" % (pattern.pattern,))
 
-            peek_slice = self.__buffer[:_STRUCT_HEADER_LENGTH]
+                any_parts.append('(?:%s)' % (pattern.pattern,))
+                continue
 
-            header_raw = struct.unpack(
-                            _HEADER_STRUCT_FORMAT,
-                            peek_slice)
+            pattern = pattern.strip()
+            if not pattern or pattern.startswith('#'):
+                continue
 
-            header = _INOTIFY_EVENT(*header_raw)
-            type_names = self._get_event_names(header.mask)
-            _LOGGER.debug("Events received in stream: {0}".format(type_names))
+            if pattern.startswith('!'):
+                raise ValueError("Negated ignore patterns are not supported: %r" % (pattern,))
 
-            event_length = (_STRUCT_HEADER_LENGTH + header.len)
-            if length < event_length:
-                return
+            dir_only = pattern.endswith('/')
+            pattern = pattern.rstrip('/')
 
-            filename = self.__buffer[_STRUCT_HEADER_LENGTH:event_length]
+            if '/' in pattern:
+                regex = _translate_glob(pattern.lstrip('/'))
+            else:
+                regex = '(?:.*/)?' + _translate_glob(pattern)
 
-            # Our filename is 16-byte aligned and right-padded with NULs.
-            filename_bytes = filename.rstrip(b'\0')
+            regex = '(?:%s)\\Z' % (regex,)
+            if dir_only is True:
+                dir_parts.append(regex)
+            else:
+                any_parts.append(regex)
 
-            self.__buffer = self.__buffer[event_length:]
+        self.__any = re.compile('|'.join(any_parts)) if any_parts else None
+        self.__dirs = re.compile('|'.join(any_parts + dir_parts)) if any_parts or dir_parts else None
 
-            #todo: proper accounting for renames missing (it's possible to leave
-            # that up to the user but the user currently cannot rename a watch)
-            path = self.__watches_r.get(header.wd)
-            if path is not None:
-                filename_unicode = filename_bytes.decode('utf8')
-                yield (header, type_names, path, filename_unicode)
+    def matches(self, relative_path, is_dir):
+        regex = self.__dirs if is_dir else self.__any
+        return regex is not None and regex.match(relative_path) is not None
 
-            buffer_length = len(self.__buffer)
-            if buffer_length < _STRUCT_HEADER_LENGTH:
-                break
 
-    def event_gen(
-            self, timeout_s=None, yield_nones=True, filter_predicate=None,
-            terminal_events=_DEFAULT_TERMINAL_EVENTS, mask=inotify.constants.IN_ALL_EVENTS):
-        """Yield one event after another. If `timeout_s` is provided, we'll
-        break when no event is received for that many seconds.
-        """
+def _get_kernel_mask(mask, consumer_mask):
+    """The mask to give the kernel for a watch that was added with `mask`,
+    when the consumers want `consumer_mask` (None for everything).
+    """
 
-        # todo: implement proper one-shot mechanism
-        # currently for that a function (! :-() is needed to temporary set
-        # block_duration which can only be specified for the whole instance
-        # to zero - in addition we would need to enable (or keep default :-()
-        # yield_nones and check for two nones in succession to then break iteration
-        # thats very inefficent and requires to much code for such a simple request
+    if consumer_mask is None:
+        return mask
 
-        # We will either return due to the optional filter or because of a
-        # timeout. The former will always set this. The latter will never set
-        # this.
-        self.__last_success_return = None
+    events = mask & consumer_mask & inotify.constants.IN_ALL_EVENTS_WATCH
+    if events == 0:
+        # The kernel wants at least one event.
+        events = inotify.constants.IN_DELETE_SELF
 
-        last_hit_s = time.time()
-        while True:
-            block_duration_s = self.__get_block_duration()
+    return (mask & ~inotify.constants.IN_ALL_EVENTS_WATCH) | events
 
-            # Poll, but manage signal-related errors.
+#todo: we should have a master exception for the whole adapter
+class EventTimeoutException(Exception):
+    pass
 
-            try:
-                events = self.__epoll.poll(block_duration_s)
-            except IOError as e:
-                if e.errno != EINTR:
-                    raise
 
-                if timeout_s is not None:
-                    time_since_event_s = time.time() - last_hit_s
-                    if time_since_event_s > timeout_s:
-                        break
+#todo: we should have a master exception for the whole adapter
+class TerminalEventException(Exception):
+    def __init__(self, type_name, event):
+        super(TerminalEventException, self).__init__(type_name)
+        self.event = event
 
-                continue
 
-            # Process events.
+class InotifyEvent(object):
+    """A compact event that keeps the raw values from the kernel and only
+    builds the header, the type-names, the unicode filename and the full path
+    when they're first asked for. It unpacks just like the usual
+    (header, type_names, path, filename) tuples.
+    """
 
-            for fd, event_type in events:
-                # (fd) looks to always match the inotify FD.
-                
-                #names = self._get_event_names(event_type)
-                #_LOGGER.debug("Events received from epoll: {}".format(names))
-                #remove confusing event name... if resolved it should resolve to
-                #proper EPOLL* name (EPOLLIN/1 should be common case)
-                #but implement this just for this single debug line?
-                _LOGGER.debug("Events received from epoll (mask o%o)", event_type)
-
-                for (header, type_names, path, filename) \
-                        in self._handle_inotify_event(fd):
-                    last_hit_s = time.time()
-
-                    e = (header, type_names, path, filename)
-                    for type_name in type_names:
-                        if filter_predicate is not None and \
-                           filter_predicate(type_name, e) is False:
-                             self.__last_success_return = (type_name, e)
-                             return
-                        elif type_name in terminal_events:
-                            raise TerminalEventException(type_name, e)
+    __slots__ = (
+        'wd',
+        'mask',
+        'cookie',
+        'len',
+        'path',
+        'filename_bytes',
+        '_header',
+        '_type_names',
+        '_filename',
+        '_full_path',
+    )
 
-                    if header.mask & mask:
-                        yield e
+    # What the items of the tuples are, in order.
+    _fields = ('header', 'type_names', 'path', 'filename')
 
-            if timeout_s is not None:
-                time_since_event_s = time.time() - last_hit_s
-                if time_since_event_s > timeout_s:
-                    break
+    def __init__(self, wd, mask, cookie, length, filename_bytes, path=None):
+        self.wd = wd
+        self.mask = mask
+        self.cookie = cookie
+        self.len = length
+        self.path = path
+        self.filename_bytes = filename_bytes
 
-            if yield_nones is True:
-                yield None
+        self._header = None
+        self._type_names = None
+        self._filename = None
+        self._full_path = None
 
     @property
-    def last_success_return(self):
-        return self.__last_success_return
+    def header(self):
+        if self._header is None:
+            self._header = _INOTIFY_EVENT(self.wd, self.mask, self.cookie, self.len)
 
+        return self._header
 
-class _BaseTree(object):
-    def __init__(self, mask=inotify.constants.IN_ALL_EVENTS,
-                 block_duration_s=_DEFAULT_EPOLL_BLOCK_DURATION_S, ignored_dirs=[]):
+    @property
+    def type_names(self):
+        if self._type_names is None:
+            self._type_names = _get_event_names(self.mask)
 
-        # No matter what we actually received as the mask, make sure we have
-        # the minimum that we require to curate our list of watches.
-        if mask & (inotify.constants.IN_MASK_CREATE | inotify.constants.IN_MASK_ADD | inotify.constants.IN_ONESHOT):
-            raise ValueError('mask must not contain IN_MASK_CREATE/IN_MASK_ADD/IN_ONESHOT for ' + self.__class__.__name__)
-        if mask & inotify.constants.IN_DONT_FOLLOW:
-            _LOGGER.info('IN_DONT_FOLLOW (or the opposite) currently not implemented for ' + self.__class__.__name__)
-        if mask & inotify.constants.IN_ONLYDIR:
-            _LOGGER.info('IN_ONLYDIR (or the opposite) currently not implemented for ' + self.__class__.__name__)
-        # if we would want to give user the opportunity to get only IS_DIR events this would need to be implemented
-        # in a dedicated way
-        self._consumer_mask = mask & (~inotify.constants.IN_ISDIR)
-        self._mask = mask | \
-                        inotify.constants.IN_CREATE | \
-                        inotify.constants.IN_MOVED_TO | \
-                        inotify.constants.IN_DELETE | \
-                        inotify.constants.IN_MOVED_FROM | \
-                        inotify.constants.IN_DELETE_SELF | \
-                        inotify.constants.IN_MOVE_SELF
+        return self._type_names
 
-        ignored_dirs_lookup = {}
-        for parent, child in (os.path.split(ignored.rstrip('/')) for ignored in ignored_dirs):
-            if not parent:
-                parent = '.'
-            if parent in ignored_dirs_lookup:
-                ignored_dirs_lookup[parent].add(child)
+    @property
+    def filename(self):
+        if self._filename is None:
+            self._filename = self.filename_bytes.decode('utf8')
+
+        return self._filename
+
+    @property
+    def full_path(self):
+        if self._full_path is None:
+            filename = self.filename
+            if filename:
+                self._full_path = os.path.join(self.path, filename)
             else:
-                ignored_dirs_lookup[parent] = set((child,))
-        self._ignored_dirs = ignored_dirs_lookup
+                self._full_path = self.path
 
-        self._moved_out_dirs = {}
-        self._deleted_dirs = {}
-        self._top_level_watches = {}
+        return self._full_path
 
-        self._i = Inotify(block_duration_s=block_duration_s)
+    def __len__(self):
+        return 4
 
-    def __directory_deleted(self, full_path):
-        self._i.remove_watch(full_path, superficial=True)
+    def __iter__(self):
+        yield self.header
+        yield self.type_names
+        yield self.path
+        yield self.filename
+
+    def __getitem__(self, index):
+        # Only build what was asked for (e.g. just the filename for e[3]).
+        if isinstance(index, slice):
+            return tuple(self)[index]
 
-    def __directory_moved_out(self, full_path):
+        return getattr(self, self._fields[index])
+
+    def __eq__(self, other):
         try:
-            self._i.remove_watch(full_path, superficial=False)
-        except inotify.calls.InotifyError as ex:
-            # for the unlikely case the moved diretory is deleted
-            # and automatically unregistered before we try to
-            # unregister....
-            pass
+            return tuple(self) == tuple(other)
+        except TypeError:
+            return NotImplemented
 
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
 
-    def event_gen(self, ignore_missing_new_folders=False, **kwargs):
-        """This is a secondary generator that wraps the principal one, and
-        adds/removes watches as directories are added/removed.
+        return not result
 
-        If we're doing anything funky and allowing the events to queue while a
-        rename occurs then the folder may no longer exist. In this case, set
-        `ignore_missing_new_folders`.
-        """
+    __hash__ = None
 
-        consumer_mask = self._consumer_mask
-        for event in self._i.event_gen(**kwargs):
-            if event is not None:
-                (header, type_names, path, filename) = event
-
-                if header.mask & inotify.constants.IN_ISDIR:
-                    full_path = os.path.join(path, filename)
-
-                    if (header.mask & inotify.constants.IN_MOVED_TO)\
-                     or (header.mask & inotify.constants.IN_CREATE):
-                        # todo: as long as the "Path already being watche/not in watch list" warnings
-                        # instead of exceptions are in place, it should really be default to also log
-                        # only a warning if target folder does not exists in tree autodiscover mode.
-                        # - but probably better to implement that with try/catch around add_watch
-                        # when errno fix is merged and also this should normally not be an argument
-                        # to event_gen but to InotifyTree(s) constructor (at least set default there)
-                        # to not steal someones use case to specify this differently for each event_gen 
-                        # call?? Even more this expression is simply wrong.
-                        if (ignore_missing_new_folders is False or os.path.exists(full_path) is True)\
-                         and (path not in self._ignored_dirs or filename not in self._ignored_dirs[path]):
-                            _LOGGER.debug("A directory has been created. We're "
-                                          "adding a watch on it (because we're "
-                                          "being recursive): [%s]", full_path)
-
-                            self._load_tree(full_path)
-
-                    elif header.mask & inotify.constants.IN_DELETE:
-                        _LOGGER.debug("A directory has been removed. We're "
-                                      "being recursive, but it would have "
-                                      "automatically been deregistered: [%s]",
-                                      full_path)
-
-                        # todo: it would be appropriate to ensure the the watch is not removed
-                        # that far that following events from the child fd are suppressed
-                        # before the watch on the child disappeared
-                        # also we have to take in mind that the subdirectory could be on
-                        # ignore list (currently that is handled by the remove_watch but a
-                        # debug message is emitted then what is not fine)
-
-                        # The watch would've already been cleaned-up internally.
-                        self.__directory_deleted(full_path)
-                    elif header.mask & inotify.constants.IN_MOVED_FROM:
-                        _LOGGER.debug("A directory has been renamed. We're "
-                                      "being recursive, we will remove watch "
-                                      "from it and re-add with IN_MOVED_TO "
-                                      "if target parent dir is within "
-                                      "our tree: [%s]", full_path)
-
-                        # todo: it would be fine if no remove/add action would take place
-                        # if directory is moved within watched tree (so doesn't goes out of scope
-                        # by the move)
-                        # also we have to take in mind that the subdirectory could be on
-                        # ignore list (currently that is handled by the exception handler)
-                        self.__directory_moved_out(full_path)
-                if header.mask & consumer_mask:
-                    yield event
-            else:
-                yield event
+    def __repr__(self):
+        return '%s(wd=%d, mask=%d, cookie=%d, len=%d, path=%r, filename=%r)' % (
+               self.__class__.__name__, self.wd, self.mask, self.cookie,
+               self.len, self.path, self.filename)
+
+
+class MoveEvent(tuple):
+    """An IN_MOVED_FROM and the IN_MOVED_TO with the same cookie, as one
+    event. It unpacks like the others, as the new path and filename with an
+    IN_MOVE mask (plus IN_ISDIR for directories), and has `old_path` and
+    `new_path` (full paths), and the two original events.
+    """
+
+    def __new__(cls, from_event, to_event):
+        (to_header, _, path, filename) = to_event
+
+        mask = inotify.constants.IN_MOVE | \
+               (to_header.mask & inotify.constants.IN_ISDIR)
+
+        header = _INOTIFY_EVENT(to_header.wd, mask, to_header.cookie, to_header.len)
+
+        self = tuple.__new__(cls, (header, _get_event_names(mask), path, filename))
+        self.from_event = from_event
+        self.to_event = to_event
+
+        return self
 
     @property
-    def inotify(self):
-        return self._i
+    def old_path(self):
+        (_, _, path, filename) = self.from_event
+        return os.path.join(path, filename)
 
-    def _load_tree(self, path):
-        # to be cosnidered: it would be very convenient to emit some "fake" events
-        # (events that are generated by the implementation and not inotify) for all
-        # found objects so that consumers do not need to scan directories again to
-        # generate themself an overview of the tree
+    @property
+    def new_path(self):
+        return os.path.join(self[2], self[3])
 
-        i = self._i
-        mask = self._mask | inotify.constants.IN_ONLYDIR
-        wd = i.add_watch(path, mask)
-        added_watches = [(path, wd)]
-        ignored_dirs = self._ignored_dirs
 
-        # todo: check whether and how to handle symlinks to directories
-        for dirpath, subdirs, _f in walk(path):
-            if subdirs:
-                num_subdirs = len(subdirs)
-                pos_subdirs = 0
-                ignored_subdirs = ignored_dirs.get(dirpath)
-                if ignored_subdirs:
-                    while pos_subdirs < num_subdirs:
-                        subdir = subdirs[pos_subdirs]
-                        if subdir in ignored_subdirs:
-                            del subdirs[pos_subdirs]
-                            num_subdirs -= 1
-                            continue
-                        path = os.path.join(dirpath, subdir)
-                        wd = i.add_watch(path, mask)
-                        added_watches.append((path, wd))
-                        pos_subdirs += 1
-                else:
-                    while pos_subdirs < num_subdirs:
-                        subdir = subdirs[pos_subdirs]
-                        path = os.path.join(dirpath, subdir)
-                        wd = i.add_watch(path, mask)
-                        added_watches.append((path, wd))
-                        pos_subdirs += 1
-        return added_watches
+class _WatchNode(object):
+    """One path component in the watch-table."""
 
-class InotifyTree(_BaseTree):
-    """Recursively watch a path."""
+    __slots__ = (
+        'name',
+        'parent',
+        'children',
+        'wd',
+        'mask',
+    )
 
-    def __init__(self, path, mask=inotify.constants.IN_ALL_EVENTS,
-                 block_duration_s=_DEFAULT_EPOLL_BLOCK_DURATION_S, ignored_dirs=[]):
-        super(InotifyTree, self).__init__(mask=mask, block_duration_s=block_duration_s,
-              ignored_dirs=ignored_dirs)
+    def __init__(self, name, parent):
+        self.name = name
+        self.parent = parent
 
-        self.__load_tree(path)
+        # Only created for nodes that have children.
+        self.children = None
+        self.wd = None
+        self.mask = 0
 
-    def __load_tree(self, path):
-        _LOGGER.debug("Adding initial watches on tree: [%s]", path)
-        tl_watch_path, tl_watch_desc = self._load_tree(path)[0]
-        self._top_level_watches[tl_watch_path] = tl_watch_desc
 
+class _WatchTable(object):
+    """The watches, as a trie of path components with the watch-descriptors
+    linked to their nodes. Paths are split on the separator (and joined again
+    exactly), lookups cost the depth of the path, the operations on a
+    directory and everything below it cost the size of that subtree, and
+    common prefixes are only stored once. Full paths are built when they're
+    asked for; the ones that events are resolved to are cached.
+    """
 
-class InotifyTrees(_BaseTree):
-    """Recursively watch over a list of trees."""
+    def __init__(self):
+        self.__root = _WatchNode(None, None)
+        self.__nodes = {}
+        self.__count = 0
 
-    def __init__(self, paths, mask=inotify.constants.IN_ALL_EVENTS,
-                 block_duration_s=_DEFAULT_EPOLL_BLOCK_DURATION_S, ignored_dirs=[]):
-        super(InotifyTrees, self).__init__(mask=mask, block_duration_s=block_duration_s,
-              ignored_dirs=ignored_dirs)
+        self.__path_cache = {}
 
-        self.__load_trees(paths)
+        # Writes may come from the tree-loading threads.
+        self.__lock = threading.Lock()
 
-    def __load_trees(self, paths):
-        _LOGGER.debug("Adding initial watches on trees: [%s]", ",".join(map(str, paths)))
-        for path in paths:
-            tl_watch_path, tl_watch_desc = self._load_tree(path)[0]
-            self._top_level_watches[tl_watch_path] = tl_watch_desc
+    def __find(self, path):
+        node = self.__root
+        for name in path.split(os.sep):
+            children = node.children
+            if children is None:
+                return None
+
+            node = children.get(name)
+            if node is None:
+                return None
+
+        return node
+
+    def __find_or_create(self, names):
+        node = self.__root
+        for name in names:
+            children = node.children
+            if children is None:
+                children = node.children = {}
+
+            child = children.get(name)
+            if child is None:
+                # The same names recur all over a tree.
+                name = _intern(name)
+                child = children[name] = _WatchNode(name, node)
+
+            node = child
+
+        return node
+
+    def __prune(self, node):
+        """Drop a node that no longer carries a watch, and any parents that
+        are left empty.
+        """
+
+        while node.parent is not None and node.wd is None and not node.children:
+            parent = node.parent
+            del parent.children[node.name]
+            if not parent.children:
+                parent.children = None
+
+            node = parent
+
+    def __get_node_path(self, node):
+        names = []
+        while node.parent is not None:
+            names.append(node.name)
+            node = node.parent
+
+        names.reverse()
+        return os.sep.join(names)
+
+    def __iter_node(self, node, path):
+        """Yield (path, node) for a node and everything below it that
+        carries a watch.
+        """
+
+        stack = [(node, path)]
+        while stack:
+            (node, path) = stack.pop()
+            if node.wd is not None:
+                yield (path, node)
+
+            children = node.children
+            if children:
+                for name, child in children.items():
+                    if path is None:
+                        stack.append((child, name))
+                    else:
+                        stack.append((child, path + os.sep + name))
+
+    def add(self, path, wd, mask=0):
+        with self.__lock:
+            node = self.__find_or_create(path.split(os.sep))
+            if node.wd is None:
+                self.__count += 1
+
+            node.wd = wd
+            node.mask = mask
+            self.__nodes[wd] = node
+            self.__path_cache.pop(wd, None)
+
+    def remove(self, path, wd):
+        with self.__lock:
+            node = self.__find(path)
+            if node is not None and node.wd is not None:
+                node.wd = None
+                self.__count -= 1
+                self.__prune(node)
+
+            self.__nodes.pop(wd, None)
+            self.__path_cache.pop(wd, None)
+
+    def get_wd(self, path):
+        node = self.__find(path)
+        if node is None:
+            return None
+
+        return node.wd
+
+    def get_path(self, wd):
+        path_cache = self.__path_cache
+
+        path = path_cache.get(wd)
+        if path is not None:
+            return path
+
+        node = self.__nodes.get(wd)
+        if node is None:
+            return None
+
+        path = self.__get_node_path(node)
+
+        if len(path_cache) >= _WATCH_PATH_CACHE_SIZE:
+            path_cache.clear()
+
+        path_cache[wd] = path
+        return path
+
+    def get_tree(self, path):
+        """The watches on a path and on everything below it, as (path, wd)
+        tuples.
+        """
+
+        node = self.__find(path.rstrip(os.sep) or path)
+        if node is None:
+            return []
+
+        return [(path, node.wd)
+                for (path, node)
+                in self.__iter_node(node, self.__get_node_path(node))]
+
+    def move(self, old_path, new_path):
+        """Re-attach a directory and everything below it under a new path.
+        Returns the moved watches as (new path, wd) tuples.
+        """
+
+        with self.__lock:
+            node = self.__find(old_path)
+            if node is None:
+                return []
+
+            parent = node.parent
+            del parent.children[node.name]
+            if not parent.children:
+                parent.children = None
+
+            self.__prune(parent)
+
+            names = new_path.split(os.sep)
+            new_parent = self.__find_or_create(names[:-1])
+
+            if new_parent.children is None:
+                new_parent.children = {}
+
+            # A directory that was replaced by the rename. Its watch is gone
+            # and the kernel will tell us so with an IN_IGNORED.
+            replaced = new_parent.children.get(names[-1])
+            if replaced is not None:
+                for (_, replaced_node) in self.__iter_node(replaced, None):
+                    self.__count -= 1
+                    if self.__nodes.get(replaced_node.wd) is replaced_node:
+                        del self.__nodes[replaced_node.wd]
+
+            node.name = _intern(names[-1])
+            node.parent = new_parent
+            new_parent.children[node.name] = node
+
+            self.__path_cache.clear()
+
+            return [(path, node.wd)
+                    for (path, node) in self.__iter_node(node, new_path)]
+
+    def iter_watches(self):
+        for (path, node) in self.__iter_node(self.__root, None):
+            yield (path, node.wd)
+
+    def iter_watch_masks(self):
+        """Yield (path, wd, mask) with the mask that the watch was added
+        with.
+        """
+
+        return [(path, node.wd, node.mask)
+                for (path, node) in self.__iter_node(self.__root, None)]
+
+    def iter_wds(self):
+        return iter(list(self.__nodes.keys()))
+
+    def __len__(self):
+        return self.__count
+
+    @property
+    def wd_count(self):
+        return len(self.__nodes)
+
+
+class _NodeIndex(object):
+    """An open-addressing hash-table (linear probing) of node numbers in an
+    array. The keys are in the columns of the owning table; `get_hash` gives
+    the hash of a node's key.
+    """
+
+    def __init__(self, get_hash):
+        self.__get_hash = get_hash
+        self.__slots = array.array('i', [-1]) * 8
+        self.__count = 0
+
+    def find(self, key_hash, matches):
+        """Return the node for which `matches(node)` is true, or -1."""
+
+        slots = self.__slots
+        mask = len(slots) - 1
+        i = key_hash & mask
+        while True:
+            node = slots[i]
+            if node == -1 or matches(node):
+                return node
+
+            i = (i + 1) & mask
+
+    def __insert(self, node):
+        slots = self.__slots
+        mask = len(slots) - 1
+        i = self.__get_hash(node) & mask
+        while slots[i] != -1:
+            i = (i + 1) & mask
+
+        slots[i] = node
+
+    def add(self, node):
+        if (self.__count + 1) * 2 > len(self.__slots):
+            old_slots = self.__slots
+            self.__slots = array.array('i', [-1]) * (len(old_slots) * 2)
+            for old_node in old_slots:
+                if old_node != -1:
+                    self.__insert(old_node)
+
+        self.__insert(node)
+        self.__count += 1
+
+    def remove(self, node):
+        slots = self.__slots
+        mask = len(slots) - 1
+        get_hash = self.__get_hash
+
+        i = get_hash(node) & mask
+        while slots[i] != node:
+            if slots[i] == -1:
+                return
+
+            i = (i + 1) & mask
+
+        # Shift the following entries back, so that no probe-sequence is
+        # broken by the hole.
+        j = i
+        while True:
+            j = (j + 1) & mask
+            other = slots[j]
+            if other == -1:
+                break
+
+            k = get_hash(other) & mask
+            if (i <= j and i < k <= j) or (i > j and (k > i or k <= j)):
+                continue
+
+            slots[i] = other
+            i = j
+
+        slots[i] = -1
+        self.__count -= 1
+
+
+class _CompactWatchTable(object):
+    """The same as `_WatchTable`, but for very many watches: the nodes are
+    rows in integer arrays (parent, wd and the sibling-links of the children),
+    the names are interned and the lookups by (parent, name) and by wd go
+    through open-addressing tables of row numbers, so there is no Python
+    object per watch. A rename only re-links one row.
+    """
+
+    def __init__(self):
+        self.__parents = array.array('i', [-1])
+        self.__names = [None]
+        self.__wds = array.array('i', [-1])
+        self.__masks = array.array('I', [0])
+        self.__first_children = array.array('i', [-1])
+        self.__next_siblings = array.array('i', [-1])
+        self.__previous_siblings = array.array('i', [-1])
+
+        # Rows that can be reused.
+        self.__free = []
+
+        self.__children = _NodeIndex(self.__get_child_hash)
+        self.__nodes = _NodeIndex(self.__get_wd_hash)
+        self.__count = 0
+        self.__wd_count = 0
+
+        self.__path_cache = {}
+
+        # Writes may come from the tree-loading threads.
+        self.__lock = threading.Lock()
+
+    def __get_child_hash(self, node):
+        return hash(self.__names[node]) ^ (self.__parents[node] * 1000003)
+
+    def __get_wd_hash(self, node):
+        return self.__wds[node] * 1000003
+
+    def __find_child(self, parent, name):
+        parents = self.__parents
+        names = self.__names
+
+        return self.__children.find(
+                hash(name) ^ (parent * 1000003),
+                lambda node: parents[node] == parent and names[node] == name)
+
+    def __find_wd(self, wd):
+        wds = self.__wds
+        return self.__nodes.find(wd * 1000003, lambda node: wds[node] == wd)
+
+    def __find(self, path):
+        node = 0
+        for name in path.split(os.sep):
+            node = self.__find_child(node, name)
+            if node == -1:
+                return -1
+
+        return node
+
+    def __attach(self, parent, node):
+        first_children = self.__first_children
+
+        sibling = first_children[parent]
+        self.__next_siblings[node] = sibling
+        self.__previous_siblings[node] = -1
+        if sibling != -1:
+            self.__previous_siblings[sibling] = node
+
+        first_children[parent] = node
+
+    def __detach(self, node):
+        previous_sibling = self.__previous_siblings[node]
+        next_sibling = self.__next_siblings[node]
+
+        if previous_sibling != -1:
+            self.__next_siblings[previous_sibling] = next_sibling
+        else:
+            self.__first_children[self.__parents[node]] = next_sibling
+
+        if next_sibling != -1:
+            self.__previous_siblings[next_sibling] = previous_sibling
+
+    def __create(self, parent, name):
+        if self.__free:
+            node = self.__free.pop()
+            self.__parents[node] = parent
+            self.__names[node] = name
+            self.__wds[node] = -1
+            self.__first_children[node] = -1
+        else:
+            node = len(self.__parents)
+            self.__parents.append(parent)
+            self.__names.append(name)
+            self.__wds.append(-1)
+            self.__masks.append(0)
+            self.__first_children.append(-1)
+            self.__next_siblings.append(-1)
+            self.__previous_siblings.append(-1)
+
+        self.__children.add(node)
+        self.__attach(parent, node)
+
+        return node
+
+    def __release(self, node):
+        self.__children.remove(node)
+        self.__detach(node)
+
+        self.__parents[node] = -1
+        self.__names[node] = None
+        self.__free.append(node)
+
+    def __find_or_create(self, names):
+        node = 0
+        for name in names:
+            child = self.__find_child(node, name)
+            if child == -1:
+                child = self.__create(node, _intern(name))
+
+            node = child
+
+        return node
+
+    def __prune(self, node):
+        wds = self.__wds
+        first_children = self.__first_children
+
+        while node != 0 and wds[node] == -1 and first_children[node] == -1:
+            parent = self.__parents[node]
+            self.__release(node)
+            node = parent
+
+    def __get_node_path(self, node):
+        parents = self.__parents
+        names = self.__names
+
+        path_names = []
+        while node != 0:
+            path_names.append(names[node])
+            node = parents[node]
+
+        path_names.reverse()
+        return os.sep.join(path_names)
+
+    def __iter_node(self, node, path):
+        """Yield (path, row) for a node and everything below it that carries
+        a watch.
+        """
+
+        wds = self.__wds
+        names = self.__names
+        first_children = self.__first_children
+        next_siblings = self.__next_siblings
+
+        stack = [(node, path)]
+        while stack:
+            (node, path) = stack.pop()
+            if wds[node] != -1:
+                yield (path, node)
+
+            child = first_children[node]
+            while child != -1:
+                if path is None:
+                    stack.append((child, names[child]))
+                else:
+                    stack.append((child, path + os.sep + names[child]))
+
+                child = next_siblings[child]
+
+    def __unlink_wd(self, wd):
+        node = self.__find_wd(wd)
+        if node != -1:
+            self.__nodes.remove(node)
+            self.__wd_count -= 1
+
+    def add(self, path, wd, mask=0):
+        with self.__lock:
+            node = self.__find_or_create(path.split(os.sep))
+            if self.__wds[node] == -1:
+                self.__count += 1
+            else:
+                self.__unlink_wd(self.__wds[node])
+
+            # Another path with the same watch (e.g. through a symlink).
+            self.__unlink_wd(wd)
+
+            self.__wds[node] = wd
+            self.__masks[node] = mask
+            self.__nodes.add(node)
+            self.__wd_count += 1
+
+            self.__path_cache.pop(wd, None)
+
+    def remove(self, path, wd):
+        with self.__lock:
+            self.__unlink_wd(wd)
+
+            node = self.__find(path)
+            if node != -1 and self.__wds[node] != -1:
+                if self.__wds[node] != wd:
+                    self.__unlink_wd(self.__wds[node])
+
+                self.__wds[node] = -1
+                self.__count -= 1
+                self.__prune(node)
+
+            self.__path_cache.pop(wd, None)
+
+    def get_wd(self, path):
+        node = self.__find(path)
+        if node == -1 or self.__wds[node] == -1:
+            return None
+
+        return self.__wds[node]
+
+    def get_path(self, wd):
+        path_cache = self.__path_cache
+
+        path = path_cache.get(wd)
+        if path is not None:
+            return path
+
+        node = self.__find_wd(wd)
+        if node == -1:
+            return None
+
+        path = self.__get_node_path(node)
+
+        if len(path_cache) >= _WATCH_PATH_CACHE_SIZE:
+            path_cache.clear()
+
+        path_cache[wd] = path
+        return path
+
+    def get_tree(self, path):
+        node = self.__find(path.rstrip(os.sep) or path)
+        if node == -1:
+            return []
+
+        wds = self.__wds
+        return [(path, wds[node])
+                for (path, node)
+                in self.__iter_node(node, self.__get_node_path(node))]
+
+    def move(self, old_path, new_path):
+        with self.__lock:
+            node = self.__find(old_path)
+            if node == -1:
+                return []
+
+            old_parent = self.__parents[node]
+            self.__children.remove(node)
+            self.__detach(node)
+
+            # Keep the old parent from being pruned into our row.
+            self.__parents[node] = -1
+            self.__prune(old_parent)
+
+            names = new_path.split(os.sep)
+            new_parent = self.__find_or_create(names[:-1])
+            name = _intern(names[-1])
+
+            # A directory that was replaced by the rename. Its watch is gone
+            # and the kernel will tell us so with an IN_IGNORED.
+            replaced = self.__find_child(new_parent, name)
+            if replaced != -1:
+                self.__release_tree(replaced)
+
+            self.__parents[node] = new_parent
+            self.__names[node] = name
+            self.__children.add(node)
+            self.__attach(new_parent, node)
+
+            self.__path_cache.clear()
+
+            wds = self.__wds
+            return [(path, wds[node])
+                    for (path, node) in self.__iter_node(node, new_path)]
+
+    def __release_tree(self, node):
+        wds = self.__wds
+        first_children = self.__first_children
+
+        stack = [node]
+        rows = []
+        while stack:
+            row = stack.pop()
+            rows.append(row)
+
+            child = first_children[row]
+            while child != -1:
+                stack.append(child)
+                child = self.__next_siblings[child]
+
+        # Children first.
+        for row in reversed(rows):
+            wd = wds[row]
+            if wd != -1:
+                self.__count -= 1
+                if self.__find_wd(wd) == row:
+                    self.__unlink_wd(wd)
+
+                wds[row] = -1
+
+            self.__first_children[row] = -1
+            self.__release(row)
+
+    def iter_watches(self):
+        wds = self.__wds
+        for (path, node) in self.__iter_node(0, None):
+            yield (path, wds[node])
+
+    def iter_watch_masks(self):
+        wds = self.__wds
+        masks = self.__masks
+        return [(path, wds[node], masks[node])
+                for (path, node) in self.__iter_node(0, None)]
+
+    def iter_wds(self):
+        wds = self.__wds
+        return iter([wds[node] for (_, node) in self.__iter_node(0, None)
+                     if self.__find_wd(wds[node]) == node])
+
+    def __len__(self):
+        return self.__count
+
+    @property
+    def wd_count(self):
+        return self.__wd_count
+
+
+class _WatchesView(Mapping):
+    """A read-only path to watch-descriptor mapping over a `_WatchTable`."""
+
+    def __init__(self, table):
+        self.__table = table
+
+    def __getitem__(self, path):
+        wd = self.__table.get_wd(path)
+        if wd is None:
+            raise KeyError(path)
+
+        return wd
+
+    def __iter__(self):
+        for (path, _) in self.__table.iter_watches():
+            yield path
+
+    def __len__(self):
+        return len(self.__table)
+
+
+class _WatchesReverseView(Mapping):
+    """A read-only watch-descriptor to path mapping over a `_WatchTable`."""
+
+    def __init__(self, table):
+        self.__table = table
+
+    def __getitem__(self, wd):
+        path = self.__table.get_path(wd)
+        if path is None:
+            raise KeyError(wd)
+
+        return path
+
+    def __iter__(self):
+        return self.__table.iter_wds()
+
+    def __len__(self):
+        return self.__table.wd_count
+
+
+class Inotify(object):
+    def __init__(self, paths=[], block_duration_s=_DEFAULT_EPOLL_BLOCK_DURATION_S,
+                 read_buffer_size=_DEFAULT_READ_BUFFER_SIZE, compact_events=False,
+                 compact_watches=False, push_masks=False, shards=1):
+        if read_buffer_size < _MAX_EVENT_LENGTH:
+            raise ValueError('read_buffer_size must be at least %d bytes' % _MAX_EVENT_LENGTH)
+
+        self.__block_duration = block_duration_s
+        self.__read_buffer_size = read_buffer_size
+        self.__compact_events = compact_events
+        if compact_watches is True:
+            self.__watch_table = _CompactWatchTable()
+        else:
+            self.__watch_table = _WatchTable()
+
+        self.__watches = _WatchesView(self.__watch_table)
+        self.__watches_r = _WatchesReverseView(self.__watch_table)
+
+        # The masks of the registered consumers. While there are any, the
+        # kernel is only asked for what they want (plus the pinned events).
+        self.__push_masks = push_masks
+        self.__consumers = {}
+        self.__next_consumer = 0
+        self.__pinned_mask = 0
+        self.__consumer_mask = None
+
+        # Events are read straight into this buffer. A partial event (which
+        # the kernel should never hand us) is moved to the front and the
+        # remainder is used for the next read.
+        self.__buffer = bytearray(read_buffer_size + _MAX_EVENT_LENGTH)
+        self.__buffer_view = memoryview(self.__buffer)
+        self.__buffer_length = 0
+
+        # Decoded events that have not been handed to a consumer yet.
+        self.__pending = collections.deque()
+
+        if shards < 1:
+            raise ValueError('shards must be at least 1')
+
+        # Non-blocking so that we can drain the queue on every wakeup and
+        # stop at EAGAIN. With several shards, each has its own queue in the
+        # kernel, the watches are spread over them by subtree, and the watch
+        # descriptors that we hand out are (kernel wd * shards + shard).
+        self.__epoll = select.epoll()
+        self.__shards = shards
+        self.__inotify_fds = []
+        self.__shard_by_fd = {}
+        self.__shard_stats = []
+
+        # Watches are added from several threads by a parallel tree-load.
+        self.__shard_lock = threading.Lock()
+        for shard in range(shards):
+            fd = inotify.calls.inotify_init1(inotify.constants.IN_NONBLOCK |
+                                             inotify.constants.IN_CLOEXEC)
+            _LOGGER.debug("Inotify handle is (%d).", fd)
+
+            self.__epoll.register(fd, select.POLLIN)
+            self.__inotify_fds.append(fd)
+            self.__shard_by_fd[fd] = shard
+            self.__shard_stats.append({
+                'watches': 0,
+                'drains': 0,
+                'events': 0,
+                'overflows': 0,
+            })
+
+        self.__inotify_fd = self.__inotify_fds[0]
+
+        self.__last_success_return = None
+
+        self.__idle_step = None
+
+        for path in paths:
+            self.add_watch(path)
+
+    def _set_idle_step(self, step):
+        """Have `step()` called whenever we'd otherwise wait for events. For
+        as long as it returns True (there's more for it to do), we don't
+        block.
+        """
+
+        self.__idle_step = step
+
+    def _run_idle_step(self):
+        """Returns True if there's more for the idle-step to do."""
+
+        step = self.__idle_step
+        if step is None:
+            return False
+
+        if step() is True:
+            return True
+
+        self.__idle_step = None
+        return False
+
+    def __get_block_duration(self):
+        """Allow the block-duration to be an integer or a function-call."""
+
+        try:
+            return self.__block_duration()
+        except TypeError:
+            # A scalar value describing seconds.
+            return self.__block_duration
+
+    def __del__(self):
+        _LOGGER.debug("Cleaning-up inotify.")
+        for fd in self.__inotify_fds:
+            os.close(fd)
+
+    def __get_shard(self, path):
+        """The tops and the directories right below them go to the shard
+        with the fewest watches, and everything else goes with its parent.
+        """
+
+        table = self.__watch_table
+        parent = os.path.dirname(path)
+        parent_wd = table.get_wd(parent)
+        if parent_wd is not None and \
+           table.get_wd(os.path.dirname(parent)) is not None:
+            return parent_wd % self.__shards
+
+        stats = self.__shard_stats
+        return min(range(self.__shards), key=lambda shard: stats[shard]['watches'])
+
+    def add_watch(self, path_unicode, mask=inotify.constants.IN_ALL_EVENTS_WATCH):
+        _LOGGER.debug("Adding watch: [%s]", path_unicode)
+        # todo: log a warning if user supplies something in mask that is not valid as mask (but silently ignored)
+        # defined IN_ALL_MASKVALS for that (should encourage user to understand when they are requesting something
+        # wrong and make it more likely that they log an issue if they have some valid mask value from sources
+        # which isn't implemented in PyInotify
+
+        # todo: handle removes for same object (with possible different pathnames)
+        # more outcome-oriented
+
+        # todo: cope with the mentioned race-conditions
+        # Because there might be race-conditions in the recursive handling (see
+        # the notes in the documentation), we recommend to add watches using
+        # data from a secondary channel, if possible, which means that we might
+        # then be adding it, yet again, if we then receive it in the normal
+        # fashion afterward.
+        if self.__watch_table.get_wd(path_unicode) is not None:
+            # to consider: a raise would be more appropriate for most cases
+            _LOGGER.warning("Path already being watched: [%s]", path_unicode)
+            return
+
+        path_bytes = path_unicode.encode('utf8')
+        kernel_mask = _get_kernel_mask(mask, self.__consumer_mask)
+
+        if self.__shards == 1:
+            shard = 0
+            wd = inotify.calls.inotify_add_watch(self.__inotify_fd, path_bytes, kernel_mask)
+        else:
+            shard = self.__get_shard(path_unicode)
+            wd = inotify.calls.inotify_add_watch(self.__inotify_fds[shard],
+                                                 path_bytes, kernel_mask)
+            wd = wd * self.__shards + shard
+
+        _LOGGER.debug("Added watch (%d): [%s]", wd, path_unicode)
+
+        self.__watch_table.add(path_unicode, wd, mask)
+
+        with self.__shard_lock:
+            self.__shard_stats[shard]['watches'] += 1
+
+        return wd
+
+    def _remove_watch(self, wd, path, superficial=False):
+        _LOGGER.debug("Removing watch for watch-handle (%d): [%s]",
+                      wd, path)
+
+        shards = self.__shards
+        if superficial is not None:
+            self.__watch_table.remove(path, wd)
+
+            with self.__shard_lock:
+                self.__shard_stats[wd % shards]['watches'] -= 1
+            inotify.adapters._LOGGER.debug(".. removed from adaptor")
+        if superficial is not False:
+            return
+        inotify.calls.inotify_rm_watch(self.__inotify_fds[wd % shards], wd // shards)
+        _LOGGER.debug(".. removed from inotify")
+
+
+    def remove_watch(self, path, superficial=False):
+        """Remove our tracking information and call inotify to stop watching
+        the given path. When a directory is removed, we'll just have to remove
+        our tracking since inotify already cleans-up the watch.
+        With superficial set to None it is also possible to remove only inotify
+        watch to be able to wait for the final IN_IGNORED event received for
+        the wd (useful for example in threaded applications).
+        """
+
+        # todo: handle removes for same object (with possible different pathnames)
+        # more outcome-oriented
+
+        wd = self.__watch_table.get_wd(path)
+        if wd is None:
+            _LOGGER.warning("Path not in watch list: [%s]", path)
+            #todo: returning always None but no success indicator is not fine
+            # to consider: a raise would be more appropriate for most cases
+            return
+        self._remove_watch(wd, path, superficial)
+
+    def remove_watch_with_id(self, wd, superficial=False):
+        """Same as remove_watch but does the same by id"""
+        path = self.__watch_table.get_path(wd)
+        if path is None:
+            #todo: returning always None but no success indicator is not fine
+            # to consider: a raise would be more appropriate for most cases
+            _LOGGER.warning("Watchdescriptor not in watch list: [%d]", wd)
+            return
+        self._remove_watch(wd, path, superficial)
+
+    def add_consumer(self, mask):
+        """Register interest in the events of `mask`. While there are
+        consumers, the kernel is only asked for the events that one of them
+        wants (of those that each watch was added with), so that nothing else
+        is generated, read and thrown away. Returns a handle for
+        `remove_consumer()`.
+        """
+
+        handle = self.__next_consumer
+        self.__next_consumer += 1
+
+        self.__consumers[handle] = mask
+        self.__sync_masks()
+
+        return handle
+
+    def remove_consumer(self, handle):
+        """Unregister a consumer. When the last one goes, the watches get
+        back the masks that they were added with, as the readers that don't
+        register (e.g. `read_batch()`) expect everything.
+        """
+
+        del self.__consumers[handle]
+        self.__sync_masks()
+
+    def _set_pinned_mask(self, mask):
+        """Events that we always ask the kernel for (the trees need to see
+        the directories come and go).
+        """
+
+        self.__pinned_mask = mask
+        if self.__consumers:
+            self.__sync_masks()
+
+    def _consuming(self, mask, events):
+        """Be a consumer of `mask` while `events` is iterated."""
+
+        handle = self.add_consumer(mask)
+        try:
+            for event in events:
+                yield event
+        finally:
+            self.remove_consumer(handle)
+
+    def __sync_masks(self):
+        if self.__consumers:
+            consumer_mask = self.__pinned_mask
+            for mask in self.__consumers.values():
+                consumer_mask |= mask
+        else:
+            consumer_mask = None
+
+        old_consumer_mask = self.__consumer_mask
+        if consumer_mask == old_consumer_mask:
+            return
+
+        self.__consumer_mask = consumer_mask
+
+        table = self.__watch_table
+        shards = self.__shards
+        readded = 0
+        for (path, wd, mask) in table.iter_watch_masks():
+            kernel_mask = _get_kernel_mask(mask, consumer_mask)
+            if kernel_mask == _get_kernel_mask(mask, old_consumer_mask):
+                continue
+
+            # Without IN_MASK_ADD the mask is replaced, so this narrows as well
+            # as widens.
+            kernel_mask &= ~(inotify.constants.IN_MASK_ADD | inotify.constants.IN_MASK_CREATE)
+
+            fd = self.__inotify_fds[wd % shards]
+
+            try:
+                new_wd = inotify.calls.inotify_add_watch(
+                            fd, path.encode('utf8'), kernel_mask)
+                new_wd = new_wd * shards + wd % shards
+            except inotify.calls.InotifyError as e:
+                # Gone, we'll hear about it.
+                _LOGGER.debug("Could not update the mask of watch (%d): [%s] %s",
+                              wd, path, e)
+                continue
+
+            if new_wd != wd and table.get_path(new_wd) is None:
+                # The path is now something else.
+                _LOGGER.warning("Path was replaced while updating its mask: [%s]", path)
+                inotify.calls.inotify_rm_watch(fd, new_wd // shards)
+
+            readded += 1
+
+        _LOGGER.debug("Consumer mask is now (0x%x). Re-added (%d) watches.",
+                      consumer_mask, readded)
+
+    @property
+    def consumer_mask(self):
+        """The events that the kernel is asked for, or None if the watches
+        have the masks that they were added with.
+        """
+
+        return self.__consumer_mask
+
+    def _get_max_wait(self):
+        """How long we can wait for events before there's something else to
+        do, or None (there never is, for us).
+        """
+
+        return None
+
+    def fileno(self):
+        """The inotify descriptor, e.g. to wait on it in a foreign event-loop
+        (it's non-blocking). With several shards, it's the descriptor of the
+        epoll that they're all on, which becomes readable along with them.
+        """
+
+        if self.__shards == 1:
+            return self.__inotify_fd
+
+        return self.__epoll.fileno()
+
+    @property
+    def shards(self):
+        return self.__shards
+
+    @property
+    def shard_stats(self):
+        """For every shard: its watches, how often its queue was drained and
+        how many events that yielded, how often it overflowed, and how many
+        bytes are queued in the kernel right now.
+        """
+
+        shard_stats = []
+        for (fd, stats) in zip(self.__inotify_fds, self.__shard_stats):
+            stats = dict(stats)
+            stats['queued_bytes'] = _get_queued_bytes(fd)
+            shard_stats.append(stats)
+
+        return shard_stats
+
+    def _get_watch_path(self, wd):
+        return self.__watch_table.get_path(wd)
+
+    def _get_watch_wd(self, path):
+        return self.__watch_table.get_wd(path)
+
+    def _get_watch_tree(self, path):
+        """The watches on a path and on everything below it, as (path, wd)
+        tuples.
+        """
+
+        return self.__watch_table.get_tree(path)
+
+    def _move_watches(self, old_path, new_path):
+        """Re-path the watches on a renamed directory and on everything below
+        it. The kernel keeps the watches across a rename, so this is just
+        bookkeeping. Returns the moved watches as (new path, wd) tuples.
+        """
+
+        new_watches = self.__watch_table.move(old_path, new_path)
+
+        _LOGGER.debug("Moved (%d) watches: [%s] => [%s]",
+                      len(new_watches), old_path, new_path)
+
+        return new_watches
+
+    def _get_event_names(self, event_type):
+        return _get_event_names(event_type)
+
+    def __drain(self, fd):
+        """Read everything that is queued and decode it onto the pending
+        events. The descriptor is non-blocking, so we keep reading until the
+        queue is drained.
+        """
+
+        pending = self.__pending
+        num_pending = len(pending)
+
+        # A foreign descriptor (e.g. one handed to `_handle_inotify_event()`)
+        # counts as the first shard.
+        shard = self.__shard_by_fd.get(fd, 0)
+        shard_stats = self.__shard_stats[shard]
+        shard_stats['drains'] += 1
+
+        try:
+            self.__drain_shard(fd, shard)
+        finally:
+            shard_stats['events'] += len(pending) - num_pending
+
+    def __drain_shard(self, fd, shard):
+        buf = self.__buffer
+        view = self.__buffer_view
+        read_buffer_size = self.__read_buffer_size
+        drained_length = read_buffer_size - _MAX_EVENT_LENGTH
+        unpack_from = _HEADER_STRUCT.unpack_from
+        make_header = _INOTIFY_EVENT._make
+        get_event_names = self._get_event_names
+        append = self.__pending.append
+        compact_events = self.__compact_events
+        is_debug = _LOGGER.isEnabledFor(logging.DEBUG)
+
+        shards = self.__shards
+        shard_stats = self.__shard_stats[shard]
+
+        offset = 0
+        length = self.__buffer_length
+
+        try:
+            while 1:
+                try:
+                    num_read = _read_into(fd, view[length:length + read_buffer_size])
+                except OSError as e:
+                    if e.errno == EINTR:
+                        continue
+                    elif e.errno == EAGAIN:
+                        return
+
+                    raise
+
+                if not num_read:
+                    return
+
+                length += num_read
+
+                while length - offset >= _STRUCT_HEADER_LENGTH:
+                    header_raw = unpack_from(buf, offset)
+
+                    start = offset + _STRUCT_HEADER_LENGTH
+                    end = start + header_raw[3]
+                    if end > length:
+                        break
+
+                    offset = end
+
+                    if is_debug:
+                        _LOGGER.debug("Events received in stream: %s",
+                                      get_event_names(header_raw[1]))
+
+                    # Overflows are counted here, as the events can be
+                    # requeued and delivered more than once.
+                    if header_raw[0] == -1:
+                        shard_stats['overflows'] += 1
+                    elif shards != 1:
+                        header_raw = (header_raw[0] * shards + shard,) + header_raw[1:]
+
+                    # Our filename is 16-byte aligned and right-padded with
+                    # NULs.
+                    if start < end:
+                        nul = buf.find(b'\0', start, end)
+                        if nul == -1:
+                            nul = end
+                    else:
+                        nul = end
+
+                    # The path is only resolved on delivery, as watches may
+                    # be removed in-between.
+                    if compact_events is True:
+                        append(InotifyEvent(header_raw[0], header_raw[1],
+                                            header_raw[2], header_raw[3],
+                                            view[start:nul].tobytes()))
+                    else:
+                        append((make_header(header_raw),
+                                get_event_names(header_raw[1]),
+                                buf[start:nul].decode('utf8')))
+
+                if offset:
+                    length -= offset
+                    buf[:length] = buf[offset:offset + length]
+                    offset = 0
+
+                # The kernel only returns whole events and would have filled
+                # the buffer further if more had been queued, so we can save
+                # the read that would just fail with EAGAIN.
+                if num_read <= drained_length:
+                    return
+        finally:
+            if offset:
+                length -= offset
+                buf[:length] = buf[offset:offset + length]
+
+            self.__buffer_length = length
+
+    def __iter_pending(self):
+        """Deliver the pending events with their paths resolved. Anything
+        that isn't iterated over stays pending.
+        """
+
+        pending = self.__pending
+        get_path = self.__watch_table.get_path
+
+        #todo: proper accounting for renames missing (it's possible to leave
+        # that up to the user but the user currently cannot rename a watch)
+        # Events for the whole queue (IN_Q_OVERFLOW) don't have a watch.
+        if self.__compact_events is True:
+            while pending:
+                e = pending.popleft()
+                path = get_path(e.wd)
+                if path is not None:
+                    e.path = path
+                    yield e
+                elif e.wd == -1:
+                    e.path = ''
+                    yield e
+        else:
+            while pending:
+                (header, type_names, filename) = pending.popleft()
+                path = get_path(header.wd)
+                if path is not None:
+                    yield (header, type_names, path, filename)
+                elif header.wd == -1:
+                    yield (header, type_names, '', filename)
+
+    def _handle_inotify_event(self, wd):
+        """Handle a series of events coming-in from inotify. Events that a
+        consumer leaves behind by not iterating to the end are kept and
+        delivered first on the next call.
+        """
+
+        self.__drain(wd)
+        return self.__iter_pending()
+
+    def _read_available(self):
+        """Drain whatever is queued right now without blocking."""
+
+        for fd in self.__inotify_fds:
+            self.__drain(fd)
+
+    def __poll(self, block_duration_s):
+        """Wait for the descriptor to become readable and drain it. Returns
+        False if we were interrupted by a signal.
+        """
+
+        try:
+            events = self.__epoll.poll(block_duration_s)
+        except IOError as e:
+            if e.errno != EINTR:
+                raise
+
+            return False
+
+        for fd, event_type in events:
+            # (fd) looks to always match the inotify FD.
+
+            #names = self._get_event_names(event_type)
+            #_LOGGER.debug("Events received from epoll: {}".format(names))
+            #remove confusing event name... if resolved it should resolve to
+            #proper EPOLL* name (EPOLLIN/1 should be common case)
+            #but implement this just for this single debug line?
+            _LOGGER.debug("Events received from epoll (mask o%o)", event_type)
+
+            self.__drain(fd)
+
+        return True
+
+    def _wait(self, deadline_s, max_wait_s=None):
+        """Wait for the descriptor to become readable, until the monotonic
+        `deadline_s` (None for no deadline) but for no longer than
+        `max_wait_s`, and drain it. Returns False once the deadline has
+        passed.
+        """
+
+        if deadline_s is None:
+            wait_s = -1
+        else:
+            wait_s = deadline_s - _monotonic()
+            if wait_s <= 0:
+                return False
+
+        if max_wait_s is not None and (wait_s < 0 or max_wait_s < wait_s):
+            wait_s = max_wait_s
+
+        self.__poll(wait_s)
+        return True
+
+    def event_gen(
+            self, timeout_s=None, yield_nones=True, filter_predicate=None,
+            terminal_events=_DEFAULT_TERMINAL_EVENTS, mask=inotify.constants.IN_ALL_EVENTS):
+        """Yield one event after another. If `timeout_s` is provided, we'll
+        break when no event is received for that many seconds. With
+        `push_masks`, `mask` is registered as a consumer while we iterate.
+        """
+
+        events = self._event_gen(timeout_s, yield_nones, filter_predicate,
+                                 terminal_events, mask)
+
+        if self.__push_masks is True:
+            events = self._consuming(mask, events)
+
+        return events
+
+    def _event_gen(
+            self, timeout_s=None, yield_nones=True, filter_predicate=None,
+            terminal_events=_DEFAULT_TERMINAL_EVENTS, mask=inotify.constants.IN_ALL_EVENTS):
+
+        # For one-shot reads, see `poll()` and `read_events()`.
+
+        # We will either return due to the optional filter or because of a
+        # timeout. The former will always set this. The latter will never set
+        # this.
+        self.__last_success_return = None
+
+        pending = self.__pending
+        compact_events = self.__compact_events
+        terminal_mask = _get_names_mask(terminal_events)
+
+        last_hit_s = _monotonic()
+        while True:
+            # Events left behind by an earlier consumer are delivered without
+            # blocking.
+            if pending or self._run_idle_step() is True:
+                block_duration_s = 0
+            else:
+                block_duration_s = self.__get_block_duration()
+
+            # Poll, but manage signal-related errors.
+
+            if self.__poll(block_duration_s) is False:
+                if timeout_s is not None:
+                    time_since_event_s = _monotonic() - last_hit_s
+                    if time_since_event_s > timeout_s:
+                        break
+
+                continue
+
+            # Process events.
+
+            for e in self.__iter_pending():
+                last_hit_s = _monotonic()
+
+                if compact_events is True:
+                    event_mask = e.mask
+                else:
+                    event_mask = e[0].mask
+
+                if filter_predicate is not None or event_mask & terminal_mask:
+                    for type_name in e[1]:
+                        if filter_predicate is not None and \
+                           filter_predicate(type_name, e) is False:
+                             self.__last_success_return = (type_name, e)
+                             return
+                        elif type_name in terminal_events:
+                            raise TerminalEventException(type_name, e)
+
+                if event_mask & mask:
+                    yield e
+
+            if timeout_s is not None:
+                time_since_event_s = _monotonic() - last_hit_s
+                if time_since_event_s > timeout_s:
+                    break
+
+            if yield_nones is True:
+                yield None
+
+    def _take_batch(self, terminal_events=_DEFAULT_TERMINAL_EVENTS,
+                    mask=inotify.constants.IN_ALL_EVENTS):
+        """Take all pending events as a list. The terminal-event and mask
+        checks look at the combined mask of the batch first, so the common
+        case doesn't have to look at the individual events again.
+        """
+
+        pending = self.__pending
+        if not pending:
+            return []
+
+        batch = list(self.__iter_pending())
+
+        if self.__compact_events is True:
+            get_mask = _get_compact_event_mask
+        else:
+            get_mask = _get_event_mask
+
+        batch_mask = 0
+        for e in batch:
+            batch_mask |= get_mask(e)
+
+        terminal_mask = _get_names_mask(terminal_events)
+        if batch_mask & terminal_mask:
+            for index, e in enumerate(batch):
+                if get_mask(e) & terminal_mask:
+                    break
+
+            # Deliver what came before the terminal event now and raise on
+            # the next call.
+            if index > 0:
+                self.__requeue(batch[index:])
+                batch = batch[:index]
+            else:
+                self.__requeue(batch[1:])
+                for type_name in e[1]:
+                    if type_name in terminal_events:
+                        raise TerminalEventException(type_name, e)
+
+            batch_mask = 0
+            for e in batch:
+                batch_mask |= get_mask(e)
+
+        if batch_mask & ~mask:
+            batch = [e for e in batch if get_mask(e) & mask]
+
+        return batch
+
+    def __requeue(self, events):
+        """Put events back at the front of the queue (ahead of, e.g., a
+        terminal event that was put back earlier).
+        """
+
+        if self.__compact_events is True:
+            self.__pending.extendleft(reversed(events))
+        else:
+            self.__pending.extendleft(reversed([(h, n, f) for (h, n, _, f) in events]))
+
+    def read_batch(self, timeout_s=None, terminal_events=_DEFAULT_TERMINAL_EVENTS,
+                   mask=inotify.constants.IN_ALL_EVENTS):
+        """Return every event decoded from one drain of the queue as a list.
+        If nothing is pending, we'll block for up to `timeout_s` seconds (the
+        block-duration by default) and return an empty list if nothing
+        arrived.
+        """
+
+        if not self.__pending:
+            if self._run_idle_step() is True:
+                timeout_s = 0
+            elif timeout_s is None:
+                timeout_s = self.__get_block_duration()
+
+            self.__poll(timeout_s)
+
+        return self._take_batch(terminal_events=terminal_events, mask=mask)
+
+    def poll(self, timeout_s=None):
+        """Wait for up to `timeout_s` seconds (forever if None, not at all if
+        zero) for events to be queued, and return whether there are. Nothing
+        is consumed, so `read_events()` won't block after a True.
+        """
+
+        deadline_s = _get_deadline(timeout_s)
+
+        self._read_available()
+        while not self.__pending:
+            if self._wait(deadline_s) is False:
+                return False
+
+        return True
+
+    def read_events(self, max_events=None, timeout_s=None,
+                    terminal_events=_DEFAULT_TERMINAL_EVENTS,
+                    mask=inotify.constants.IN_ALL_EVENTS):
+        """Return up to `max_events` events (all of those queued by default)
+        as a list. Whatever is queued is returned right away; otherwise we
+        wait for up to `timeout_s` seconds (forever if None) and return an
+        empty list if nothing arrived. The events beyond `max_events` are
+        kept for the next call.
+        """
+
+        deadline_s = _get_deadline(timeout_s)
+
+        while True:
+            batch = self.read_batch(timeout_s=0, terminal_events=terminal_events,
+                                    mask=mask)
+            if batch:
+                break
+
+            if self._run_idle_step() is True:
+                continue
+
+            if self._wait(deadline_s) is False:
+                return []
+
+        if max_events is not None and len(batch) > max_events:
+            self.__requeue(batch[max_events:])
+            batch = batch[:max_events]
+
+        return batch
+
+    def event_gen_batches(
+            self, timeout_s=None, yield_nones=True,
+            terminal_events=_DEFAULT_TERMINAL_EVENTS, mask=inotify.constants.IN_ALL_EVENTS):
+        """Like `event_gen()` but yield lists of events, one per drain of the
+        queue. A None is only yielded for a cycle that didn't produce any
+        events.
+        """
+
+        batches = self._event_gen_batches(timeout_s, yield_nones,
+                                          terminal_events, mask)
+
+        if self.__push_masks is True:
+            batches = self._consuming(mask, batches)
+
+        return batches
+
+    def _event_gen_batches(
+            self, timeout_s=None, yield_nones=True,
+            terminal_events=_DEFAULT_TERMINAL_EVENTS, mask=inotify.constants.IN_ALL_EVENTS):
+
+        last_hit_s = _monotonic()
+        while True:
+            batch = self.read_batch(terminal_events=terminal_events, mask=mask)
+            if batch:
+                last_hit_s = _monotonic()
+                yield batch
+                continue
+
+            if timeout_s is not None:
+                time_since_event_s = _monotonic() - last_hit_s
+                if time_since_event_s > timeout_s:
+                    break
+
+            if yield_nones is True:
+                yield None
+
+    @property
+    def last_success_return(self):
+        return self.__last_success_return
+
+    @property
+    def compact_events(self):
+        return self.__compact_events
+
+
+def _get_stat_entry(full_path):
+    try:
+        st = os.lstat(full_path)
+    except OSError:
+        return None
+
+    return (st.st_ino, st.st_mtime, st.st_size, stat.S_ISDIR(st.st_mode))
+
+
+class TreeIndex(object):
+    """An in-memory mirror of the watched tree: the names in every watched
+    directory and whether they're directories, and, optionally, their
+    inode-numbers, modification-times and sizes. It's seeded while the tree
+    is loaded and kept up to date from the events, so queries don't touch the
+    filesystem. Directories are kept by watch-descriptor, so they don't have
+    to be re-keyed when they're moved.
+    """
+
+    def __init__(self, i, with_stat=False):
+        self.__i = i
+        self.__with_stat = with_stat
+
+        # wd => [mtime, when we looked, {name: entry}, ino], where an entry is
+        # (ino, mtime, size, is_dir) with stat data and is_dir otherwise. The
+        # mtime is None once a directory has changed and we didn't look.
+        self.__directories = {}
+
+    @property
+    def with_stat(self):
+        return self.__with_stat
+
+    def __get_directory(self, path):
+        wd = self.__i._get_watch_wd(path.rstrip(os.sep) or path)
+        if wd is None:
+            return None
+
+        return self.__directories.get(wd)
+
+    def __is_dir(self, entry):
+        if self.__with_stat is True:
+            return entry[3]
+
+        return entry
+
+    def __scan(self, path):
+        stamp_s = time.time()
+
+        try:
+            st = os.stat(path)
+            names = os.listdir(path)
+        except OSError:
+            return None
+
+        entries = {}
+        for name in names:
+            entry = _get_stat_entry(os.path.join(path, name))
+            if entry is not None:
+                entries[name] = entry
+
+        return [st.st_mtime, stamp_s, entries, st.st_ino]
+
+    def add_directory(self, wd, path, dirnames, filenames, st=None):
+        """Seed a directory with what was found in it. The directory is
+        watched by now, so a change after we look at it will be applied from
+        its event. `st` is its stat, if we already have it.
+        """
+
+        stamp_s = time.time()
+
+        if st is None:
+            try:
+                st = os.stat(path)
+            except OSError:
+                return
+
+        if self.__with_stat is False:
+            entries = dict.fromkeys(filenames, False)
+            entries.update(dict.fromkeys(dirnames, True))
+        else:
+            entries = {}
+            for name in itertools.chain(dirnames, filenames):
+                entry = _get_stat_entry(os.path.join(path, name))
+                if entry is not None:
+                    entries[name] = entry
+
+        self.__directories[wd] = [st.st_mtime, stamp_s, entries, st.st_ino]
+
+    def get_directory(self, wd):
+        """The (ino, mtime, when we looked, [(name, is_dir)]) of a
+        directory, or None. The mtime is None if the directory has changed
+        since we looked.
+        """
+
+        directory = self.__directories.get(wd)
+        if directory is None:
+            return None
+
+        return (directory[3], directory[0], directory[1], self.get_entries(wd))
+
+    def discard(self, wd):
+        self.__directories.pop(wd, None)
+
+    def wds(self):
+        return list(self.__directories)
+
+    def get_entries(self, wd):
+        """The (name, is_dir) of what we have for a directory, sorted."""
+
+        directory = self.__directories.get(wd)
+        if directory is None:
+            return []
+
+        is_dir = self.__is_dir
+        return sorted((name, is_dir(entry)) for (name, entry) in directory[2].items())
+
+    def listdir(self, path):
+        """The names in a watched directory, sorted, or None if it isn't
+        one.
+        """
+
+        directory = self.__get_directory(path)
+        if directory is None:
+            return None
+
+        return sorted(directory[2])
+
+    def __get_entry(self, path):
+        path = path.rstrip(os.sep) or path
+        (parent, name) = os.path.split(path)
+
+        directory = self.__get_directory(parent)
+        if directory is None:
+            return None
+
+        return directory[2].get(name)
+
+    def exists(self, path):
+        # The tops of the trees aren't in a directory that we know.
+        return self.__get_entry(path) is not None or \
+               self.__get_directory(path) is not None
+
+    def is_dir(self, path):
+        entry = self.__get_entry(path)
+        if entry is not None:
+            return self.__is_dir(entry)
+
+        return self.__get_directory(path) is not None
+
+    def stat(self, path):
+        """The (ino, mtime, size, is_dir) that we have for a path, or None.
+        Only kept with `with_stat`.
+        """
+
+        if self.__with_stat is False:
+            raise ValueError("The index doesn't keep stat data.")
+
+        return self.__get_entry(path)
+
+    def walk(self, path):
+        """Like `os.walk()`, top-down, over the watched directories below
+        (and including) a path.
+        """
+
+        is_dir = self.__is_dir
+        directories = self.__directories
+        for (dirpath, wd) in self.__i._get_watch_tree(path):
+            directory = directories.get(wd)
+            if directory is None:
+                continue
+
+            dirnames = []
+            filenames = []
+            for (name, entry) in sorted(directory[2].items()):
+                if is_dir(entry) is True:
+                    dirnames.append(name)
+                else:
+                    filenames.append(name)
+
+            yield (dirpath, dirnames, filenames)
+
+    def __len__(self):
+        """The number of entries."""
+
+        return sum(len(directory[2]) for directory in self.__directories.values())
+
+    def apply(self, event, mask):
+        """Bring a directory up to date with an event."""
+
+        if mask & inotify.constants.IN_IGNORED:
+            self.__directories.pop(event[0].wd, None)
+            return
+
+        if not mask & _INDEX_MASK:
+            return
+
+        (header, _, path, filename) = event
+
+        directory = self.__directories.get(header.wd)
+        if directory is None or not filename:
+            return
+
+        entries = directory[2]
+        if mask & (inotify.constants.IN_DELETE | inotify.constants.IN_MOVED_FROM):
+            entries.pop(filename, None)
+        elif self.__with_stat is False:
+            if mask & (inotify.constants.IN_CREATE | inotify.constants.IN_MOVED_TO):
+                entries[filename] = (mask & inotify.constants.IN_ISDIR) != 0
+        else:
+            entry = _get_stat_entry(os.path.join(path, filename))
+            if entry is None:
+                entries.pop(filename, None)
+            else:
+                entries[filename] = entry
+
+        if mask & _INDEX_LISTING_MASK:
+            if self.__with_stat is False:
+                directory[0] = None
+                return
+
+            stamp_s = time.time()
+
+            try:
+                directory[0] = os.stat(path).st_mtime
+            except OSError:
+                return
+
+            directory[1] = stamp_s
+
+    def rescan(self, wd, path):
+        """Compare a directory with what we have and take it again (this needs
+        the stat data). A directory whose modification-time hasn't changed
+        still has the same names, and only its files are looked at. Returns
+        the (mask, name) of the differences, the removals first.
+        """
+
+        directory = self.__directories.get(wd)
+        if directory is None:
+            return []
+
+        (mtime, stamp_s, entries, _) = directory
+
+        try:
+            current_mtime = os.stat(path).st_mtime
+        except OSError:
+            # Its parent will tell.
+            del self.__directories[wd]
+            return []
+
+        changes = []
+        if current_mtime == mtime and stamp_s - mtime >= _INDEX_RACY_S:
+            for (name, entry) in sorted(entries.items()):
+                if entry[3] is True:
+                    continue
+
+                new_entry = _get_stat_entry(os.path.join(path, name))
+                if new_entry is not None and new_entry != entry:
+                    entries[name] = new_entry
+                    changes.append((inotify.constants.IN_MODIFY, name))
+
+            return changes
+
+        new_directory = self.__scan(path)
+        if new_directory is None:
+            del self.__directories[wd]
+            return []
+
+        self.__directories[wd] = new_directory
+        new_entries = new_directory[2]
+
+        for (name, entry) in sorted(entries.items()):
+            new_entry = new_entries.get(name)
+            if new_entry is None or new_entry[0] != entry[0]:
+                mask = inotify.constants.IN_DELETE
+                if entry[3] is True:
+                    mask |= inotify.constants.IN_ISDIR
+
+                changes.append((mask, name))
+
+        for (name, new_entry) in sorted(new_entries.items()):
+            entry = entries.get(name)
+            if entry is None or new_entry[0] != entry[0]:
+                mask = inotify.constants.IN_CREATE
+                if new_entry[3] is True:
+                    mask |= inotify.constants.IN_ISDIR
+
+                changes.append((mask, name))
+            elif new_entry[3] is False and new_entry != entry:
+                changes.append((inotify.constants.IN_MODIFY, name))
+
+        return changes
+
+
+def _get_max_user_watches():
+    """The kernel's limit on the watches of a user, or None if we can't
+    tell.
+    """
+
+    try:
+        with open(_MAX_USER_WATCHES_FILEPATH) as f:
+            return int(f.read())
+    except (IOError, OSError, ValueError):
+        return None
+
+
+class _WatchBudget(object):
+    """The directory watches of a tree, from the least to the most recently
+    active, and how many of them we can have. The tops of the trees are
+    pinned: they're counted but never given up.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.__watches = collections.OrderedDict()
+        self.__pinned = set()
+
+    def add(self, wd, pinned=False):
+        if pinned is True:
+            self.__pinned.add(wd)
+        else:
+            self.__watches[wd] = True
+
+    def touch(self, wd):
+        """Make a watch the most recently active one."""
+
+        watches = self.__watches
+        if watches.pop(wd, None) is not None:
+            watches[wd] = True
+
+    def discard(self, wd):
+        self.__watches.pop(wd, None)
+        self.__pinned.discard(wd)
+
+    def is_full(self):
+        return self.limit is not None and len(self) >= self.limit
+
+    def get_coldest(self):
+        """The least recently active of the watches that we can give up, or
+        None.
+        """
+
+        for wd in self.__watches:
+            return wd
+
+        return None
+
+    def __contains__(self, wd):
+        return wd in self.__watches or wd in self.__pinned
+
+    def __len__(self):
+        return len(self.__watches) + len(self.__pinned)
+
+
+class _DirectoryPoller(object):
+    """The directories that we look at now and then rather than watch, with
+    their modification-times and what was in them. One is only listed again
+    once its modification-time has changed (or was too recent to trust).
+    """
+
+    def __init__(self):
+        # path => [mtime, when we looked, {name: is_dir}]
+        self.__directories = {}
+
+        # path => the watch-descriptor that its made-up events carry. These
+        # count down from -2, as -1 is for overflows.
+        self.__wds = {}
+        self.__next_wd = -2
+
+    def get_wd(self, path):
+        """The (negative) watch-descriptor for the events of a polled
+        directory, which it keeps for as long as we know it.
+        """
+
+        wd = self.__wds.get(path)
+        if wd is None:
+            wd = self.__next_wd
+            self.__next_wd -= 1
+            self.__wds[path] = wd
+
+        return wd
+
+    def add(self, path, dirnames, filenames):
+        stamp_s = time.time()
+
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return
+
+        entries = dict.fromkeys(filenames, False)
+        entries.update(dict.fromkeys(dirnames, True))
+
+        self.__directories[path] = [mtime, stamp_s, entries]
+
+    def pop(self, path):
+        """Stop polling a directory. Returns its {name: is_dir}, or None."""
+
+        directory = self.__directories.pop(path, None)
+        if directory is None:
+            return None
+
+        return directory[2]
+
+    def discard_tree(self, path):
+        prefix = os.path.join(path, '')
+        for directories in (self.__directories, self.__wds):
+            for polled_path in list(directories):
+                if polled_path == path or polled_path.startswith(prefix):
+                    del directories[polled_path]
+
+    def move(self, old_path, new_path):
+        prefix = os.path.join(old_path, '')
+        for directories in (self.__directories, self.__wds):
+            for polled_path in list(directories):
+                if polled_path == old_path or polled_path.startswith(prefix):
+                    directories[new_path + polled_path[len(old_path):]] = \
+                        directories.pop(polled_path)
+
+    def get_changed(self):
+        """The directories that have to be listed again. The ones that have
+        gone are dropped (their parents will tell).
+        """
+
+        changed = []
+        for (path, directory) in list(self.__directories.items()):
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                del self.__directories[path]
+                continue
+
+            if mtime != directory[0] or directory[1] - directory[0] < _INDEX_RACY_S:
+                changed.append(path)
+
+        return changed
+
+    def __contains__(self, path):
+        return path in self.__directories
+
+    def __len__(self):
+        return len(self.__directories)
+
+
+def _diff_entries(entries, dirnames, filenames):
+    """The (mask, name) of the differences between what was in a directory,
+    as {name: is_dir}, and what's in it now, the removals first.
+    """
+
+    new_entries = dict.fromkeys(filenames, False)
+    new_entries.update(dict.fromkeys(dirnames, True))
+
+    changes = []
+    for (name, is_dir) in sorted(entries.items()):
+        if new_entries.get(name) != is_dir:
+            mask = inotify.constants.IN_DELETE
+            if is_dir is True:
+                mask |= inotify.constants.IN_ISDIR
+
+            changes.append((mask, name))
+
+    for (name, is_dir) in sorted(new_entries.items()):
+        if entries.get(name) != is_dir:
+            mask = inotify.constants.IN_CREATE
+            if is_dir is True:
+                mask |= inotify.constants.IN_ISDIR
+
+            changes.append((mask, name))
+
+    return changes
+
+
+def _get_queued_bytes(fd):
+    """How many bytes of events are waiting to be read."""
+
+    buf = array.array('i', [0])
+    fcntl.ioctl(fd, termios.FIONREAD, buf, True)
+
+    return buf[0]
+
+
+def _list_directory(path):
+    """The names of the subdirectories and of everything else in a
+    directory, like `walk` has them.
+    """
+
+    dirnames = []
+    filenames = []
+
+    if scandir is not None:
+        for entry in scandir(path):
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+
+            if is_dir is True:
+                dirnames.append(entry.name)
+            else:
+                filenames.append(entry.name)
+    else:
+        for name in os.listdir(path):
+            if os.path.isdir(os.path.join(path, name)):
+                dirnames.append(name)
+            else:
+                filenames.append(name)
+
+    return (dirnames, filenames)
+
+
+def _write_checkpoint(filename, trees):
+    """Write the directories of our trees, as (root, [(path, ino, mtime,
+    when we looked, [(name, is_dir)])]), to a file. It's written next to
+    the old one and then moved over it.
+    """
+
+    temp_filename = filename + '.tmp'
+    with open(temp_filename, 'wb') as f:
+        f.write(_CHECKPOINT_HEADER.pack(_CHECKPOINT_MAGIC, _CHECKPOINT_VERSION,
+                                        len(trees)))
+
+        for (root, directories) in trees:
+            root_bytes = root.encode('utf8')
+            f.write(_CHECKPOINT_ROOT.pack(len(root_bytes), len(directories)))
+            f.write(root_bytes)
+
+            for (path, ino, mtime, stamp_s, entries) in directories:
+                if mtime is None:
+                    mtime = -1.0
+
+                path_bytes = path.encode('utf8')
+                f.write(_CHECKPOINT_DIRECTORY.pack(len(path_bytes), ino, mtime,
+                                                   stamp_s, len(entries)))
+                f.write(path_bytes)
+
+                for (name, is_dir) in entries:
+                    name_bytes = name.encode('utf8')
+                    f.write(_CHECKPOINT_ENTRY.pack(len(name_bytes), is_dir))
+                    f.write(name_bytes)
+
+    os.rename(temp_filename, filename)
+
+
+def _read_checkpoint(filename):
+    """Read what `_write_checkpoint()` wrote, as {root: directories}. Returns
+    None if it isn't a checkpoint that we can use.
+    """
+
+    with open(filename, 'rb') as f:
+        m = f.read()
+
+    try:
+        (magic, version, num_roots) = _CHECKPOINT_HEADER.unpack_from(m, 0)
+        if magic != _CHECKPOINT_MAGIC or version != _CHECKPOINT_VERSION:
+            return None
+
+        offset = _CHECKPOINT_HEADER.size
+        trees = {}
+        for _ in range(num_roots):
+            (length, num_directories) = _CHECKPOINT_ROOT.unpack_from(m, offset)
+            offset += _CHECKPOINT_ROOT.size
+            root = m[offset:offset + length].decode('utf8')
+            offset += length
+
+            directories = []
+            for _ in range(num_directories):
+                (length, ino, mtime, stamp_s, num_entries) = \
+                    _CHECKPOINT_DIRECTORY.unpack_from(m, offset)
+                offset += _CHECKPOINT_DIRECTORY.size
+                path = m[offset:offset + length].decode('utf8')
+                offset += length
+
+                entries = {}
+                for _ in range(num_entries):
+                    (length, is_dir) = _CHECKPOINT_ENTRY.unpack_from(m, offset)
+                    offset += _CHECKPOINT_ENTRY.size
+                    entries[m[offset:offset + length].decode('utf8')] = is_dir
+                    offset += length
+
+                directories.append((path, ino, mtime, stamp_s, entries))
+
+            trees[root] = directories
+    except (struct.error, UnicodeDecodeError):
+        return None
+
+    return trees
+
+
+class _BaseTree(object):
+    def __init__(self, mask=inotify.constants.IN_ALL_EVENTS,
+                 block_duration_s=_DEFAULT_EPOLL_BLOCK_DURATION_S, ignored_dirs=[],
+                 read_buffer_size=_DEFAULT_READ_BUFFER_SIZE, compact_events=False,
+                 load_workers=None, compact_watches=False, ignored_patterns=None,
+                 ignore_matching_events=False, push_masks=False, recover_overflow=False,
+                 index=False, index_stat=False, checkpoint=None, emit_existing=False,
+                 progressive=False, watch_budget=None,
+                 poll_interval_s=_DEFAULT_POLL_INTERVAL_S, shards=1):
+
+        # No matter what we actually received as the mask, make sure we have
+        # the minimum that we require to curate our list of watches.
+        if mask & (inotify.constants.IN_MASK_CREATE | inotify.constants.IN_MASK_ADD | inotify.constants.IN_ONESHOT):
+            raise ValueError('mask must not contain IN_MASK_CREATE/IN_MASK_ADD/IN_ONESHOT for ' + self.__class__.__name__)
+        if mask & inotify.constants.IN_DONT_FOLLOW:
+            _LOGGER.info('IN_DONT_FOLLOW (or the opposite) currently not implemented for ' + self.__class__.__name__)
+        if mask & inotify.constants.IN_ONLYDIR:
+            _LOGGER.info('IN_ONLYDIR (or the opposite) currently not implemented for ' + self.__class__.__name__)
+        # if we would want to give user the opportunity to get only IS_DIR events this would need to be implemented
+        # in a dedicated way
+        self._consumer_mask = mask & (~inotify.constants.IN_ISDIR)
+        self._mask = mask | _TREE_CURATION_MASK
+
+        ignored_dirs_lookup = {}
+        for parent, child in (os.path.split(ignored.rstrip('/')) for ignored in ignored_dirs):
+            if not parent:
+                parent = '.'
+            if parent in ignored_dirs_lookup:
+                ignored_dirs_lookup[parent].add(child)
+            else:
+                ignored_dirs_lookup[parent] = set((child,))
+        self._ignored_dirs = ignored_dirs_lookup
+
+        self._moved_out_dirs = {}
+        self._moved_in_dirs = {}
+        self._deleted_dirs = {}
+        self._top_level_watches = {}
+
+        if ignored_patterns:
+            self._ignore_matcher = _IgnoreMatcher(ignored_patterns)
+        else:
+            self._ignore_matcher = None
+
+        self._ignore_matching_events = ignore_matching_events
+
+        # The tops of our trees (with a trailing separator), the longest
+        # first, to make paths relative for the ignore patterns.
+        self._root_prefixes = []
+
+        if load_workers is not None and (scandir is None or _HAS_FUTURES is False):
+            _LOGGER.warning("Parallel tree-loading needs scandir and "
+                            "concurrent.futures. Loading serially.")
+            load_workers = None
+
+        if watch_budget is not None:
+            if checkpoint is not None:
+                raise ValueError('watch_budget can not be combined with a '
+                                 'checkpoint for ' + self.__class__.__name__)
+
+            if load_workers is not None:
+                _LOGGER.info("The trees are loaded serially within a watch-budget.")
+                load_workers = None
+
+        self._load_workers = load_workers
+        self._load_stats = {
+            'directories': 0,
+            'seconds': 0.0,
+            'directories_per_s': 0.0,
+            'workers': load_workers or 1,
+            'pruned': 0,
+            'relisted': 0,
+            'pending': 0,
+        }
+
+        # The directories that we can't watch within the budget (the least
+        # recently active ones) are polled instead.
+        if watch_budget is not None:
+            if watch_budget is True:
+                watch_budget = _get_max_user_watches()
+
+            self._budget = _WatchBudget(watch_budget)
+            self._poller = _DirectoryPoller()
+            self._poll_interval_s = poll_interval_s
+            self._next_sweep_s = _monotonic() + poll_interval_s
+            self._budget_stats = {
+                'evicted': 0,
+                'promoted': 0,
+                'sweeps': 0,
+            }
+
+            self._block_duration_s = block_duration_s
+            block_duration_s = self.__get_block_duration
+        else:
+            self._budget = None
+            self._poller = None
+
+        self._i = Inotify(block_duration_s=block_duration_s,
+                          read_buffer_size=read_buffer_size,
+                          compact_events=compact_events,
+                          compact_watches=compact_watches,
+                          shards=shards)
+
+        # Whatever the consumers want, we need to see the directories come
+        # and go.
+        self._push_masks = push_masks
+        self._i._set_pinned_mask(_TREE_CURATION_MASK)
+
+        if index is True or recover_overflow is True or checkpoint is not None:
+            self._index = TreeIndex(self._i, with_stat=index_stat or recover_overflow)
+        else:
+            self._index = None
+
+        self._overflow_recovery = recover_overflow
+        self._synthetic_events = collections.deque()
+
+        # The walks of the trees that we're loading as the events are taken.
+        self._emit_existing = emit_existing
+        self._existing = collections.deque()
+
+        # The walks of the trees that we're loading whenever we'd otherwise
+        # wait for events.
+        self._progressive = progressive
+        self._loading = collections.deque()
+
+        # What those walks couldn't list in this cycle (it might've been
+        # moved ahead of them).
+        self._unlisted = set()
+
+        self._checkpoint = None
+        if checkpoint is not None:
+            try:
+                self._checkpoint = _read_checkpoint(checkpoint)
+            except (IOError, OSError) as e:
+                _LOGGER.info("Could not read the checkpoint. Loading from "
+                             "scratch: [%s] %s", checkpoint, e)
+            else:
+                if self._checkpoint is None:
+                    _LOGGER.warning("Not a checkpoint that we can use. Loading "
+                                    "from scratch: [%s]", checkpoint)
+
+        if compact_events is True:
+            self._get_event_mask = _get_compact_event_mask
+        else:
+            self._get_event_mask = _get_event_mask
+
+    def __directory_deleted(self, full_path):
+        if self._index is not None:
+            for (_, wd) in self._i._get_watch_tree(full_path):
+                self._index.discard(wd)
+
+        if self._poller is not None:
+            # It might've been polled, and so might what was below it.
+            self._poller.discard_tree(full_path)
+            for (path, wd) in self._i._get_watch_tree(full_path):
+                self._budget.discard(wd)
+                self._i._remove_watch(wd, path, superficial=True)
+
+            return
+
+        self._i.remove_watch(full_path, superficial=True)
+
+    def __directory_moved_out(self, full_path, cookie):
+        # We keep the watches until we know whether the directory was moved
+        # within our tree (see `__directory_moved_in()`).
+        self._moved_out_dirs[cookie] = full_path
+
+        # With several shards, we might've seen the other half first.
+        moved_in = self._moved_in_dirs.pop(cookie, None)
+        if moved_in is not None:
+            (new_path, ignore_missing_new_folders) = moved_in
+            if self.__directory_moved_in(new_path, cookie) is False:
+                self.__directory_created(new_path, ignore_missing_new_folders)
+
+    def __directory_moved_in(self, full_path, cookie):
+        """Re-path the watches of a directory that was moved within our tree.
+        Returns False if the directory wasn't moved from a watched location.
+        """
+
+        old_path = self._moved_out_dirs.pop(cookie, None)
+        if old_path is None:
+            return False
+
+        if self._poller is not None:
+            self._poller.move(old_path, full_path)
+
+        moved = self._i._move_watches(old_path, full_path)
+        if not moved:
+            return False
+
+        _LOGGER.debug("A directory has been moved within our tree. We're "
+                      "keeping its watches: [%s] => [%s]", old_path, full_path)
+
+        if self._loading or self._existing or self._unlisted:
+            # The walk won't find it where it was. The watches that are
+            # already there are kept.
+            self._load_tree(full_path)
+
+        ignored_dirs = self._ignored_dirs
+        if ignored_dirs or self._ignore_matcher is not None:
+            for (path, _) in moved:
+                parent, name = os.path.split(path)
+                if parent in ignored_dirs and name in ignored_dirs[parent]:
+                    self.__remove_watch_tree(path)
+                elif self._is_ignored(path) is True:
+                    self._load_stats['pruned'] += 1
+                    self.__remove_watch_tree(path)
+
+            self.__load_unignored(old_path, full_path, moved)
+
+        return True
+
+    def __load_unignored(self, old_path, full_path, moved):
+        """Load the subdirectories of a directory that was moved from
+        `old_path` to `full_path` that were ignored at the old location but
+        aren't at the new one.
+        """
+
+        ignored_dirs = self._ignored_dirs
+        get_watch_wd = self._i._get_watch_wd
+
+        candidates = []
+
+        old_prefix = old_path + os.sep
+        for (parent, names) in list(ignored_dirs.items()):
+            if parent == old_path or parent.startswith(old_prefix):
+                new_parent = full_path + parent[len(old_path):]
+                candidates.extend(os.path.join(new_parent, name) for name in names)
+
+        # What the patterns pruned isn't recorded, so we have to look.
+        if self._ignore_matcher is not None:
+            for (path, _) in moved:
+                if get_watch_wd(path) is None:
+                    continue
+
+                try:
+                    (dirnames, _) = _list_directory(path)
+                except OSError:
+                    continue
+
+                old_parent = old_path + path[len(full_path):]
+                for name in dirnames:
+                    if self._is_ignored(os.path.join(old_parent, name)) is True:
+                        candidates.append(os.path.join(path, name))
+
+        for path in candidates:
+            parent, name = os.path.split(path)
+            if parent in ignored_dirs and name in ignored_dirs[parent]:
+                continue
+            elif get_watch_wd(path) is not None or self._is_ignored(path) is True:
+                continue
+            elif get_watch_wd(parent) is None or os.path.isdir(path) is False:
+                continue
+
+            _LOGGER.debug("A directory that was ignored is no longer after a "
+                          "move: [%s]", path)
+
+            self._load_tree(path)
+
+    def __remove_watch_tree(self, full_path):
+        if self._poller is not None:
+            self._poller.discard_tree(full_path)
+
+        for (path, wd) in self._i._get_watch_tree(full_path):
+            if self._index is not None:
+                self._index.discard(wd)
+
+            if self._budget is not None:
+                self._budget.discard(wd)
+
+            try:
+                self._i._remove_watch(wd, path, superficial=False)
+            except inotify.calls.InotifyError as ex:
+                # for the unlikely case the moved diretory is deleted
+                # and automatically unregistered before we try to
+                # unregister....
+                pass
+
+    def __directory_created(self, full_path, ignore_missing_new_folders=False):
+        if ignore_missing_new_folders is False or os.path.exists(full_path) is True:
+            _LOGGER.debug("A directory has been created. We're "
+                          "adding a watch on it (because we're "
+                          "being recursive): [%s]", full_path)
+
+            self._load_tree(full_path)
+
+    def _flush_moved_out_dirs(self):
+        """Stop watching the directories that were moved out of our tree.
+        The two halves of a move are queued together, so we call this at the
+        end of every cycle.
+        """
+
+        self._unlisted.clear()
+
+        moved_in_dirs = self._moved_in_dirs
+        if moved_in_dirs:
+            # From outside of our tree.
+            for (full_path, ignore_missing_new_folders) in moved_in_dirs.values():
+                self.__directory_created(full_path, ignore_missing_new_folders)
+
+            moved_in_dirs.clear()
+
+        moved_out_dirs = self._moved_out_dirs
+        if not moved_out_dirs:
+            return
+
+        for full_path in moved_out_dirs.values():
+            _LOGGER.debug("A directory has been moved out of our tree. "
+                          "We're removing its watches: [%s]", full_path)
+
+            self.__remove_watch_tree(full_path)
+
+        moved_out_dirs.clear()
+
+
+    def _get_terminal_events(self, terminal_events):
+        """We recover from an overflow rather than give up on it."""
+
+        if self._overflow_recovery is False:
+            return terminal_events
+
+        return tuple(type_name
+                     for type_name in terminal_events
+                     if type_name != 'IN_Q_OVERFLOW')
+
+    def _recover_overflow(self, ignore_missing_new_folders=False):
+        """Find out what changed while events were being lost by comparing
+        the watched directories with our index of them. The watches stay
+        in place; only the directories that came or went are picked-up or
+        dropped. Returns the events that we made up for the changes, which
+        may repeat some that are still queued.
+        """
+
+        _LOGGER.warning("The event queue has overflowed. We're rescanning "
+                        "the tree for what we've missed.")
+
+        index = self._index
+        get_watch_path = self._i._get_watch_path
+        compact_events = self._i.compact_events
+
+        removed = []
+        added = []
+        for wd in index.wds():
+            path = get_watch_path(wd)
+            if path is None:
+                index.discard(wd)
+                continue
+
+            for (mask, name) in index.rescan(wd, path):
+                event = _make_event(wd, mask, path, name, compact_events)
+                if mask & inotify.constants.IN_DELETE:
+                    removed.append(event)
+                else:
+                    added.append(event)
+
+        # A directory that was moved within the tree looks like one that was
+        # removed and one that was created, so the old watches have to go
+        # first.
+        for event in removed:
+            if event[0].mask & inotify.constants.IN_ISDIR:
+                self.__remove_watch_tree(os.path.join(event[2], event[3]))
+
+        recovered = removed
+        for event in added:
+            recovered.append(event)
+
+            if event[0].mask & inotify.constants.IN_ISDIR:
+                recovered.extend(self.__watch_created_directory(
+                                    event, ignore_missing_new_folders))
+
+        _LOGGER.info("Recovered (%d) events from the overflow.", len(recovered))
+
+        return recovered
+
+    def __watch_created_directory(self, event, ignore_missing_new_folders=False):
+        """Watch a directory that we've made-up an *IN_CREATE* for, and make
+        up the events for whatever is in it, too.
+        """
+
+        self._handle_event(event, ignore_missing_new_folders)
+
+        index = self._index
+        compact_events = self._i.compact_events
+
+        events = []
+        full_path = os.path.join(event[2], event[3])
+        for (path, wd) in self._i._get_watch_tree(full_path):
+            for (name, is_dir) in index.get_entries(wd):
+                mask = inotify.constants.IN_CREATE
+                if is_dir is True:
+                    mask |= inotify.constants.IN_ISDIR
+
+                events.append(_make_event(wd, mask, path, name, compact_events))
+
+        return events
+
+    def _take_synthetic_events(self, mask=inotify.constants.IN_ALL_EVENTS):
+        """The events that we made up (e.g. for what changed since the
+        checkpoint) and that are yet to be delivered.
+        """
+
+        synthetic_events = self._synthetic_events
+        if not synthetic_events:
+            return []
+
+        events = list(synthetic_events)
+        synthetic_events.clear()
+
+        return self.__get_deliverable(events, self._consumer_mask & mask)
+
+    def _take_existing_events(self, mask=inotify.constants.IN_ALL_EVENTS):
+        """Walk on to the next directory of the trees that we're still
+        loading that has something to deliver, and return the *IN_CREATE*s
+        that we made up for what's in it ([] once we're done). The kernel's
+        queue is drained as we go, so that it doesn't overflow in the
+        meantime.
+        """
+
+        existing = self._existing
+        consumer_mask = self._consumer_mask & mask
+        compact_events = self._i.compact_events
+
+        dir_mask = inotify.constants.IN_CREATE | inotify.constants.IN_ISDIR
+        file_mask = inotify.constants.IN_CREATE
+
+        while existing:
+            try:
+                (dirpath, wd, dirnames, filenames, _) = next(existing[0])
+            except StopIteration:
+                existing.popleft()
+                continue
+
+            self._i._read_available()
+
+            events = [_make_event(wd, dir_mask, dirpath, name, compact_events)
+                      for name in dirnames]
+
+            events.extend(_make_event(wd, file_mask, dirpath, name, compact_events)
+                          for name in filenames)
+
+            events = self.__get_deliverable(events, consumer_mask)
+            if events:
+                return events
+
+        return []
+
+    def _take_polled_events(self, ignore_missing_new_folders=False,
+                            mask=inotify.constants.IN_ALL_EVENTS):
+        """If it's time, look at the directories that we poll rather than
+        watch, and return the events that we made up for what changed in
+        them (curated like any others).
+        """
+
+        if self._poller is None or _monotonic() < self._next_sweep_s:
+            return []
+
+        events = self.__sweep()
+        self._next_sweep_s = _monotonic() + self._poll_interval_s
+
+        if not events:
+            return []
+
+        return self._process_batch(events, ignore_missing_new_folders, mask)
+
+    def __sweep(self):
+        """List the polled directories that changed again. Something that
+        changed is active, so it's watched again if the budget allows (and
+        then looked at once more, so that nothing falls in-between).
+        """
+
+        poller = self._poller
+        index = self._index
+        compact_events = self._i.compact_events
+        mask = self._mask | inotify.constants.IN_ONLYDIR
+
+        self._budget_stats['sweeps'] += 1
+
+        events = []
+        for path in poller.get_changed():
+            entries = poller.pop(path)
+            if entries is None:
+                continue
+
+            try:
+                (dirnames, filenames) = _list_directory(path)
+            except OSError:
+                # Its parent will tell.
+                continue
+
+            changes = _diff_entries(entries, dirnames, filenames)
+            if changes:
+                wd = self.__add_budgeted_watch(path, mask)
+                if wd is not None:
+                    self._budget_stats['promoted'] += 1
+
+                    try:
+                        (dirnames, filenames) = _list_directory(path)
+                    except OSError:
+                        continue
+
+                    changes = _diff_entries(entries, dirnames, filenames)
+                    if index is not None:
+                        index.add_directory(wd, path, dirnames, filenames)
+            else:
+                wd = None
+
+            if wd is None:
+                poller.add(path, dirnames, filenames)
+                wd = poller.get_wd(path)
+
+            for (event_mask, name) in changes:
+                events.append(_make_event(wd, event_mask, path, name, compact_events))
+
+        return events
+
+    def __get_block_duration(self):
+        """Don't block past the next sweep."""
+
+        block_duration_s = self._block_duration_s
+        if callable(block_duration_s):
+            block_duration_s = block_duration_s()
+
+        return max(0, min(block_duration_s, self._next_sweep_s - _monotonic()))
+
+    def _get_max_wait(self):
+        """How long we can wait for events before there's something else to
+        do, or None.
+        """
+
+        if self._poller is None:
+            return None
+
+        return max(0, self._next_sweep_s - _monotonic())
+
+    @property
+    def budget_stats(self):
+        """How many directories are watched and polled within the
+        watch-budget, and how many were evicted from and promoted back to the
+        watches.
+        """
+
+        if self._budget is None:
+            return None
+
+        stats = dict(self._budget_stats)
+        stats['budget'] = self._budget.limit
+        stats['watched'] = len(self._budget)
+        stats['polled'] = len(self._poller)
+
+        return stats
+
+    def __get_deliverable(self, events, consumer_mask):
+        get_event_mask = self._get_event_mask
+        events = [e for e in events if get_event_mask(e) & consumer_mask]
+
+        if self._ignore_matching_events is True and self._ignore_matcher is not None:
+            events = [e for e in events
+                      if self.__is_event_ignored(e, get_event_mask(e)) is False]
+
+        return events
+
+    def _get_relative_path(self, full_path):
+        for prefix in self._root_prefixes:
+            if full_path.startswith(prefix):
+                return full_path[len(prefix):]
+            elif full_path == prefix[:-1]:
+                return ''
+
+        return full_path
+
+    def _is_ignored(self, full_path, is_dir=True):
+        """Whether a path matches our ignore patterns."""
+
+        matcher = self._ignore_matcher
+        return matcher is not None and \
+               matcher.matches(self._get_relative_path(full_path), is_dir)
+
+    def __is_event_ignored(self, event, mask):
+        filename = event[3]
+        if not filename:
+            return False
+
+        return self._is_ignored(os.path.join(event[2], filename),
+                                (mask & inotify.constants.IN_ISDIR) != 0)
+
+    def _handle_event(self, event, ignore_missing_new_folders=False):
+        """Curate our watches for a directory event."""
+
+        (header, type_names, path, filename) = event
+
+        full_path = os.path.join(path, filename)
+
+        if (header.mask & inotify.constants.IN_MOVED_TO)\
+         or (header.mask & inotify.constants.IN_CREATE):
+            # todo: as long as the "Path already being watche/not in watch list" warnings
+            # instead of exceptions are in place, it should really be default to also log
+            # only a warning if target folder does not exists in tree autodiscover mode.
+            # - but probably better to implement that with try/catch around add_watch
+            # when errno fix is merged and also this should normally not be an argument
+            # to event_gen but to InotifyTree(s) constructor (at least set default there)
+            # to not steal someones use case to specify this differently for each event_gen 
+            # call?? Even more this expression is simply wrong.
+            if path in self._ignored_dirs and filename in self._ignored_dirs[path]:
+                pass
+            elif self._is_ignored(full_path) is True:
+                # A directory that was moved here is unwatched along with the
+                # ones that were moved out.
+                _LOGGER.debug("Not watching an ignored directory: [%s]", full_path)
+                self._load_stats['pruned'] += 1
+            elif header.mask & inotify.constants.IN_MOVED_TO \
+             and self.__directory_moved_in(full_path, header.cookie) is True:
+                pass
+            elif header.mask & inotify.constants.IN_MOVED_TO and self._i.shards != 1:
+                # The two halves of a move can come from different shards, in
+                # either order, so we wait for the end of the cycle.
+                self._moved_in_dirs[header.cookie] = (full_path, ignore_missing_new_folders)
+            else:
+                self.__directory_created(full_path, ignore_missing_new_folders)
+
+        elif header.mask & inotify.constants.IN_DELETE:
+            _LOGGER.debug("A directory has been removed. We're "
+                          "being recursive, but it would have "
+                          "automatically been deregistered: [%s]",
+                          full_path)
+
+            # todo: it would be appropriate to ensure the the watch is not removed
+            # that far that following events from the child fd are suppressed
+            # before the watch on the child disappeared
+            # also we have to take in mind that the subdirectory could be on
+            # ignore list (currently that is handled by the remove_watch but a
+            # debug message is emitted then what is not fine)
+
+            # The watch would've already been cleaned-up internally.
+            self.__directory_deleted(full_path)
+        elif header.mask & inotify.constants.IN_MOVED_FROM:
+            _LOGGER.debug("A directory has been renamed. We're "
+                          "being recursive, we will keep its watches "
+                          "if the IN_MOVED_TO is within our tree "
+                          "or remove them at the end of the cycle: "
+                          "[%s]", full_path)
+
+            self.__directory_moved_out(full_path, header.cookie)
+
+    def event_gen(self, ignore_missing_new_folders=False, **kwargs):
+        """This is a secondary generator that wraps the principal one, and
+        adds/removes watches as directories are added/removed.
+
+        If we're doing anything funky and allowing the events to queue while a
+        rename occurs then the folder may no longer exist. In this case, set
+        `ignore_missing_new_folders`.
+        """
+
+        # We need the end of every cycle to finish the moves.
+        yield_nones = kwargs.pop('yield_nones', True)
+
+        # We filter after we've seen the directory events.
+        consumer_mask = self._consumer_mask & kwargs.pop('mask', inotify.constants.IN_ALL_EVENTS)
+
+        ignore_matching_events = self._ignore_matching_events and \
+                                 self._ignore_matcher is not None
+
+        kwargs['terminal_events'] = self._get_terminal_events(
+                                        kwargs.get('terminal_events', _DEFAULT_TERMINAL_EVENTS))
+
+        events = self._i._event_gen(yield_nones=True, **kwargs)
+        if self._push_masks is True:
+            events = self._i._consuming(consumer_mask, events)
+
+        for event in self._take_synthetic_events(consumer_mask):
+            yield event
+
+        while self._existing:
+            for event in self._take_existing_events(consumer_mask):
+                yield event
+
+        index = self._index
+        budget = self._budget
+        overflow_recovery = self._overflow_recovery
+        get_event_mask = self._get_event_mask
+        for event in events:
+            if event is not None:
+                mask = get_event_mask(event)
+                recovered = None
+                if budget is not None:
+                    budget.touch(event[0].wd)
+
+                if index is not None:
+                    if overflow_recovery is True and \
+                       mask & inotify.constants.IN_Q_OVERFLOW:
+                        recovered = self._recover_overflow(ignore_missing_new_folders)
+                    else:
+                        index.apply(event, mask)
+
+                if mask & inotify.constants.IN_ISDIR:
+                    self._handle_event(event, ignore_missing_new_folders)
+
+                if mask & consumer_mask:
+                    if ignore_matching_events is False or \
+                       self.__is_event_ignored(event, mask) is False:
+                        yield event
+
+                if recovered:
+                    for event in self.__get_deliverable(recovered, consumer_mask):
+                        yield event
+            else:
+                self._flush_moved_out_dirs()
+
+                for polled_event in self._take_polled_events(
+                                        ignore_missing_new_folders, consumer_mask):
+                    yield polled_event
+
+                if yield_nones is True:
+                    yield event
+
+        self._flush_moved_out_dirs()
+
+    def _process_batch(self, batch, ignore_missing_new_folders=False,
+                       mask=inotify.constants.IN_ALL_EVENTS):
+        """Curate our watches for a batch of events and return what is left
+        for the consumer.
+        """
+
+        get_event_mask = self._get_event_mask
+
+        batch_mask = 0
+        for e in batch:
+            batch_mask |= get_event_mask(e)
+
+        consumer_mask = self._consumer_mask & mask
+        index = self._index
+
+        budget = self._budget
+        if budget is not None:
+            for e in batch:
+                budget.touch(e[0].wd)
+
+        if batch_mask & inotify.constants.IN_ISDIR or index is not None:
+            # Once a watch is removed, the events that were queued for it
+            # behind the removal are dropped, and once a directory is moved,
+            # the events behind the move get the new path, just like
+            # `event_gen()` does.
+            get_watch_path = self._i._get_watch_path
+            changed_mask = inotify.constants.IN_DELETE | \
+                           inotify.constants.IN_MOVED_TO | \
+                           inotify.constants.IN_MOVED_FROM
+            changed = False
+
+            delivered = []
+            for e in batch:
+                mask = get_event_mask(e)
+                if changed is True and e[0].wd != -1:
+                    e = self.__update_event_path(e, get_watch_path)
+                    if e is None:
+                        continue
+
+                if index is not None:
+                    if self._overflow_recovery is True and \
+                       mask & inotify.constants.IN_Q_OVERFLOW:
+                        if mask & consumer_mask:
+                            delivered.append(e)
+
+                        for recovered in self._recover_overflow(ignore_missing_new_folders):
+                            if get_event_mask(recovered) & consumer_mask:
+                                delivered.append(recovered)
+
+                        changed = True
+                        continue
+
+                    index.apply(e, mask)
+
+                if mask & inotify.constants.IN_ISDIR:
+                    self._handle_event(e, ignore_missing_new_folders)
+                    if mask & changed_mask:
+                        changed = True
+
+                if mask & consumer_mask:
+                    delivered.append(e)
+
+            self._flush_moved_out_dirs()
+
+            batch = delivered
+        elif batch_mask & ~consumer_mask:
+            batch = [e for e in batch if get_event_mask(e) & consumer_mask]
+
+        if self._ignore_matching_events is True and self._ignore_matcher is not None:
+            batch = [e for e in batch
+                     if self.__is_event_ignored(e, get_event_mask(e)) is False]
+
+        return batch
+
+    def __update_event_path(self, event, get_watch_path):
+        path = get_watch_path(event[0].wd)
+        if path is None:
+            return None
+
+        if isinstance(event, InotifyEvent):
+            if event.path != path:
+                event.path = path
+                event._full_path = None
+
+            return event
+
+        if event[2] != path:
+            return (event[0], event[1], path, event[3])
+
+        return event
+
+    def read_batch(self, ignore_missing_new_folders=False, **kwargs):
+        """Like `Inotify.read_batch()` but with the watches being curated
+        like in `event_gen()`.
+        """
+
+        # We filter after we've seen the directory events.
+        mask = kwargs.pop('mask', inotify.constants.IN_ALL_EVENTS)
+        kwargs['terminal_events'] = self._get_terminal_events(
+                                        kwargs.get('terminal_events', _DEFAULT_TERMINAL_EVENTS))
+
+        synthetic_events = self._take_synthetic_events(mask) or \
+                           self._take_existing_events(mask)
+        if synthetic_events:
+            return synthetic_events
+
+        batch = self._i.read_batch(**kwargs)
+        batch = self._process_batch(batch, ignore_missing_new_folders, mask)
+
+        return batch + self._take_polled_events(ignore_missing_new_folders, mask)
+
+    def poll(self, timeout_s=None):
+        """Like `Inotify.poll()`, but also True if there's something that we
+        made up to deliver or the polled directories are due a sweep. As the
+        events have yet to be curated, `read_events()` may still come up
+        empty.
+        """
+
+        i = self._i
+        deadline_s = _get_deadline(timeout_s)
+
+        while True:
+            if self._synthetic_events or self._existing or \
+               i.poll(0) is True or self._get_max_wait() == 0:
+                return True
+
+            if i._run_idle_step() is True:
+                continue
+
+            if i._wait(deadline_s, self._get_max_wait()) is False:
+                return False
+
+    def read_events(self, max_events=None, timeout_s=None,
+                    ignore_missing_new_folders=False, **kwargs):
+        """Like `Inotify.read_events()` but with the watches being curated
+        like in `event_gen()`.
+        """
+
+        i = self._i
+        deadline_s = _get_deadline(timeout_s)
+
+        kwargs['timeout_s'] = 0
+
+        while True:
+            batch = self.read_batch(ignore_missing_new_folders, **kwargs)
+            if batch:
+                break
+
+            if i._run_idle_step() is True:
+                continue
+
+            # We might have to sweep the polled directories before then.
+            if i._wait(deadline_s, self._get_max_wait()) is False:
+                return []
+
+        # The rest is delivered ahead of anything else next time.
+        if max_events is not None and len(batch) > max_events:
+            self._synthetic_events.extendleft(reversed(batch[max_events:]))
+            batch = batch[:max_events]
+
+        return batch
+
+    def event_gen_batches(self, ignore_missing_new_folders=False, **kwargs):
+        """Like `Inotify.event_gen_batches()` but with the watches being
+        curated like in `event_gen()`.
+        """
+
+        mask = kwargs.pop('mask', inotify.constants.IN_ALL_EVENTS)
+        kwargs['terminal_events'] = self._get_terminal_events(
+                                        kwargs.get('terminal_events', _DEFAULT_TERMINAL_EVENTS))
+
+        batches = self._i._event_gen_batches(**kwargs)
+        if self._push_masks is True:
+            batches = self._i._consuming(self._consumer_mask & mask, batches)
+
+        synthetic_events = self._take_synthetic_events(mask)
+        if synthetic_events:
+            yield synthetic_events
+
+        while self._existing:
+            synthetic_events = self._take_existing_events(mask)
+            if synthetic_events:
+                yield synthetic_events
+
+        for batch in batches:
+            if batch is not None:
+                batch = self._process_batch(batch, ignore_missing_new_folders, mask)
+                if batch:
+                    yield batch
+
+            polled_batch = self._take_polled_events(ignore_missing_new_folders, mask)
+            if polled_batch:
+                yield polled_batch
+            elif batch is None:
+                yield batch
+
+    @property
+    def inotify(self):
+        return self._i
+
+    def _load_initial_tree(self, path):
+        """Load one of the trees that we were constructed with, and account
+        for it in the load statistics.
+        """
+
+        prefix = os.path.join(path, '')
+        self._root_prefixes.append(prefix)
+        self._root_prefixes.sort(key=len, reverse=True)
+
+        if self._checkpoint is not None and path in self._checkpoint:
+            directories = self._checkpoint.pop(path)
+        elif self._emit_existing is True:
+            # The rest is walked as the events are taken.
+            steps = self.__stream_tree(path)
+            step = next(steps)
+            self._existing.append(itertools.chain([step], steps))
+
+            return step[4]
+        elif self._progressive is True:
+            # The rest is walked whenever we'd otherwise wait for events.
+            steps = self.__stream_tree(path)
+            step = next(steps)
+            if not self._loading:
+                self._i._set_idle_step(self.__load_step)
+
+            self._loading.append(steps)
+
+            return step[4]
+        else:
+            directories = None
+
+        start_s = _monotonic()
+
+        if directories is not None:
+            added_watches = self.__load_checkpointed_tree(path, directories)
+        else:
+            added_watches = self._load_tree(path, workers=self._load_workers)
+
+        elapsed_s = _monotonic() - start_s
+
+        self.__account_load(len(added_watches), elapsed_s)
+
+        _LOGGER.debug("Loaded tree in (%.3f) seconds with (%d) workers: "
+                      "(%d) directories [%s]", elapsed_s,
+                      self._load_stats['workers'], len(added_watches), path)
+
+        return added_watches
+
+    def __account_load(self, num_directories, elapsed_s):
+        stats = self._load_stats
+        stats['directories'] += num_directories
+        stats['seconds'] += elapsed_s
+        if stats['seconds'] > 0:
+            stats['directories_per_s'] = stats['directories'] / stats['seconds']
+
+    def __stream_tree(self, path):
+        """Walk a tree like `_walk_tree()`, and account for it in the load
+        statistics as we go.
+        """
+
+        stats = self._load_stats
+        steps = self._walk_tree(path)
+        pending = 0
+        while True:
+            start_s = _monotonic()
+
+            try:
+                step = next(steps)
+            except StopIteration:
+                # Whatever we couldn't list.
+                stats['pending'] -= pending
+                return
+
+            self.__account_load(len(step[4]), _monotonic() - start_s)
+
+            # The one that we've listed had been watched already.
+            pending += len(step[4]) - 1
+            stats['pending'] += len(step[4]) - 1
+
+            yield step
+
+    def __load_step(self):
+        """List the next few directories of the trees that we're loading
+        progressively. Returns True if there's more to do.
+        """
+
+        loading = self._loading
+        remaining = _PROGRESSIVE_LOAD_STEP
+        while loading and remaining > 0:
+            try:
+                next(loading[0])
+            except StopIteration:
+                loading.popleft()
+                continue
+
+            remaining -= 1
+
+        if loading:
+            return True
+
+        _LOGGER.debug("Finished loading progressively: (%d) directories in "
+                      "(%.3f) seconds", self._load_stats['directories'],
+                      self._load_stats['seconds'])
+
+        return False
+
+    @property
+    def load_progress(self):
+        """(loaded, pending): the directories that we've watched and listed,
+        and those that we've watched but are still to list.
+        """
+
+        stats = self._load_stats
+        pending = max(0, stats['pending'])
+        return (stats['directories'] - pending, pending)
+
+    @property
+    def loading(self):
+        """Whether we're still walking any of the trees."""
+
+        return bool(self._loading or self._existing)
+
+    @property
+    def index(self):
+        """The `TreeIndex` of the tree, if we keep one."""
+
+        return self._index
+
+    def __load_checkpointed_tree(self, root, directories):
+        """Watch a tree from its checkpoint. Only the directories whose
+        mtime (or inode) changed are listed again, and the differences are
+        queued as made-up events.
+        """
+
+        try:
+            st = os.stat(root)
+        except OSError:
+            st = None
+
+        if st is None or not directories or directories[0][1] != st.st_ino:
+            _LOGGER.warning("The checkpoint doesn't match the tree. Loading "
+                            "it from scratch: [%s]", root)
+
+            return self._load_tree(root, workers=self._load_workers)
+
+        i = self._i
+        index = self._index
+        mask = self._mask | inotify.constants.IN_ONLYDIR
+        compact_events = i.compact_events
+        synthetic_events = self._synthetic_events
+        ignored_dirs = self._ignored_dirs
+
+        added_watches = []
+        wds = {}
+        subdirs = {}
+
+        root_path = directories[0][0]
+        for (path, ino, mtime, stamp_s, entries) in directories:
+            if path != root_path:
+                (parent, name) = os.path.split(path)
+
+                # Gone, or below something that is (we've said so already).
+                if name not in subdirs.get(parent, ()):
+                    continue
+
+                if parent in ignored_dirs and name in ignored_dirs[parent]:
+                    continue
+                elif self._is_ignored(path) is True:
+                    self._load_stats['pruned'] += 1
+                    continue
+
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+
+                if st.st_ino != ino:
+                    # Replaced.
+                    parent_wd = wds[parent]
+                    synthetic_events.append(
+                        _make_event(parent_wd,
+                                    inotify.constants.IN_DELETE | inotify.constants.IN_ISDIR,
+                                    parent, name, compact_events))
+
+                    event = _make_event(parent_wd,
+                                        inotify.constants.IN_CREATE | inotify.constants.IN_ISDIR,
+                                        parent, name, compact_events)
+
+                    synthetic_events.append(event)
+                    synthetic_events.extend(self.__watch_created_directory(event))
+                    added_watches.extend(i._get_watch_tree(path))
+                    continue
+
+            # We watch before we look, so that nothing falls in-between.
+            wd = i.add_watch(path, mask)
+            added_watches.append((path, wd))
+            wds[path] = wd
+
+            if mtime == st.st_mtime and stamp_s - mtime >= _INDEX_RACY_S:
+                dirnames = [name for (name, is_dir) in entries.items() if is_dir]
+                filenames = [name for (name, is_dir) in entries.items() if not is_dir]
+                index.add_directory(wd, path, dirnames, filenames, st)
+                subdirs[path] = set(dirnames)
+                continue
+
+            self._load_stats['relisted'] += 1
+
+            (dirnames, filenames) = _list_directory(path)
+            index.add_directory(wd, path, dirnames, filenames, st)
+
+            current = dict.fromkeys(filenames, False)
+            current.update(dict.fromkeys(dirnames, True))
+
+            for name in sorted(entries):
+                if current.get(name) != entries[name]:
+                    event_mask = inotify.constants.IN_DELETE
+                    if entries[name] is True:
+                        event_mask |= inotify.constants.IN_ISDIR
+
+                    synthetic_events.append(
+                        _make_event(wd, event_mask, path, name, compact_events))
+
+            found = set()
+            for name in sorted(current):
+                if entries.get(name) == current[name]:
+                    if current[name] is True:
+                        found.add(name)
+
+                    continue
+
+                event_mask = inotify.constants.IN_CREATE
+                if current[name] is True:
+                    event_mask |= inotify.constants.IN_ISDIR
+
+                event = _make_event(wd, event_mask, path, name, compact_events)
+                synthetic_events.append(event)
+
+                if current[name] is True:
+                    synthetic_events.extend(self.__watch_created_directory(event))
+                    added_watches.extend(i._get_watch_tree(os.path.join(path, name)))
+
+            subdirs[path] = found
+
+        # A subdirectory without a record of its own (e.g. it hadn't been
+        # walked yet when the checkpoint was written) is listed and watched
+        # from scratch. We can't tell what changed in it.
+        for parent in list(subdirs):
+            for name in sorted(subdirs[parent]):
+                path = os.path.join(parent, name)
+                if path in wds or i._get_watch_wd(path) is not None:
+                    continue
+                elif parent in ignored_dirs and name in ignored_dirs[parent]:
+                    continue
+                elif self._is_ignored(path) is True:
+                    self._load_stats['pruned'] += 1
+                    continue
+                elif os.path.isdir(path) is False:
+                    continue
+
+                _LOGGER.debug("No record of a directory in the checkpoint: "
+                              "[%s]", path)
+
+                self._load_stats['relisted'] += 1
+                added_watches.extend(self._load_tree(path))
+
+        _LOGGER.debug("Loaded tree from its checkpoint: (%d) directories, (%d) "
+                      "listed again, (%d) changes [%s]", len(added_watches),
+                      self._load_stats['relisted'], len(synthetic_events), root)
+
+        return added_watches
+
+    def save_checkpoint(self, filename):
+        """Write the directories of our trees and what is in them to a file,
+        to start from with `checkpoint` the next time. It's kept current by
+        the events, so call it after you've been through them.
+        """
+
+        index = self._index
+        if index is None:
+            raise ValueError("A checkpoint needs the tree-index (index=True).")
+
+        trees = []
+        for root in self._top_level_watches:
+            directories = []
+            for (path, wd) in self._i._get_watch_tree(root):
+                directory = index.get_directory(wd)
+                if directory is not None:
+                    (ino, mtime, stamp_s, entries) = directory
+                    directories.append((path, ino, mtime, stamp_s, entries))
+
+            trees.append((root, directories))
+
+        _write_checkpoint(filename, trees)
+
+    @property
+    def load_stats(self):
+        """How many directories the initial tree-load watched, how long that
+        took, and with how many workers. "pruned" counts the directories that
+        weren't watched because of `ignored_patterns` (also those that came
+        along later), and "relisted" those that had changed since the
+        checkpoint.
+        """
+
+        return dict(self._load_stats)
+
+    def _load_tree(self, path, workers=None):
+        if workers is not None:
+            return self._load_tree_parallel(path, workers)
+
+        added_watches = []
+        for (_, _, _, _, added) in self._walk_tree(path):
+            added_watches.extend(added)
+
+        return added_watches
+
+    def __get_add_watch(self):
+        """While we're still walking any of the trees, the curation can
+        get to a directory before the walk does (it was created or moved
+        there), so the walk takes the watches that are there as they are.
+        """
+
+        if self._budget is not None:
+            return self.__add_loaded_watch
+        elif self._loading or self._existing or self._unlisted:
+            return self.__add_watch_once
+
+        return self._i.add_watch
+
+    def __walk_failed(self, e):
+        if self._loading or self._existing:
+            self._unlisted.add(e.filename)
+
+    def __add_watch_once(self, path, mask):
+        wd = self._i._get_watch_wd(path)
+        if wd is not None:
+            return wd
+
+        return self._i.add_watch(path, mask)
+
+    def __add_loaded_watch(self, path, mask):
+        # Nothing that we're just loading is any more active than what's
+        # watched already.
+        return self.__add_budgeted_watch(path, mask, evict=False)
+
+    def __add_budgeted_watch(self, path, mask, evict=True):
+        """Watch a directory, and give up the least recently active watches
+        to stay within the budget (if `evict`). Returns None if it has to be
+        polled instead.
+        """
+
+        i = self._i
+        budget = self._budget
+
+        wd = i._get_watch_wd(path)
+        if wd is not None:
+            return wd
+
+        pinned = os.path.join(path, '') in self._root_prefixes
+
+        while pinned is False and budget.is_full():
+            if evict is False or self.__evict_coldest() is False:
+                return None
+
+        try:
+            wd = i.add_watch(path, mask)
+        except inotify.calls.InotifyError as e:
+            if e.errno != ENOSPC:
+                raise
+
+            # The kernel's limit is for all of the user's watches, so this is
+            # as many as we're going to get.
+            _LOGGER.warning("Out of watches at (%d). Polling the least "
+                            "recently active directories from here on.",
+                            len(budget))
+
+            budget.limit = len(budget)
+            if evict is False or self.__evict_coldest() is False:
+                return None
+
+            try:
+                wd = i.add_watch(path, mask)
+            except inotify.calls.InotifyError as e:
+                if e.errno != ENOSPC:
+                    raise
+
+                return None
+
+        budget.add(wd, pinned)
+        self._poller.pop(path)
+
+        return wd
+
+    def __evict_coldest(self):
+        """Poll the least recently active of our watched directories rather
+        than watch it. Returns False if there's nothing that we can give up.
+        """
+
+        wd = self._budget.get_coldest()
+        if wd is None:
+            return False
+
+        self._budget.discard(wd)
+
+        i = self._i
+        path = i._get_watch_path(wd)
+
+        if self._index is not None:
+            self._index.discard(wd)
+
+        try:
+            i._remove_watch(wd, path)
+        except inotify.calls.InotifyError:
+            # It's just gone.
+            pass
+
+        # Whatever is still queued for the watch is dropped with it, so we
+        # take what's there now as where the sweeps start from.
+        try:
+            (dirnames, filenames) = _list_directory(path)
+        except OSError:
+            pass
+        else:
+            self._poller.add(path, dirnames, filenames)
+
+        self._budget_stats['evicted'] += 1
+
+        return True
+
+    def _walk_tree(self, path):
+        """Watch a tree as we walk it. Yields (dirpath, wd, dirnames,
+        filenames, added_watches) for every directory, where the names are
+        everything in it (ignored or not) and the watches are those that were
+        added for it (the first time, the one on the top as well).
+        """
+
+        i = self._i
+        mask = self._mask | inotify.constants.IN_ONLYDIR
+        if self._budget is not None:
+            # It's been created or moved here, or it's one of the tops.
+            wd = self.__add_budgeted_watch(path, mask)
+        else:
+            wd = self.__get_add_watch()(path, mask)
+
+        top = (path, wd)
+        added_watches = [top]
+        ignored_dirs = self._ignored_dirs
+        matcher = self._ignore_matcher
+        index = self._index
+
+        # todo: check whether and how to handle symlinks to directories
+        for dirpath, subdirs, files in walk(path, onerror=self.__walk_failed):
+            dirpath_wd = i._get_watch_wd(dirpath)
+            dirnames = list(subdirs)
+            add_watch = self.__get_add_watch()
+
+            if dirpath_wd is None and self._poller is not None:
+                self._poller.add(dirpath, dirnames, files)
+            elif index is not None:
+                index.add_directory(dirpath_wd, dirpath, dirnames, files)
+
+            if subdirs:
+                num_subdirs = len(subdirs)
+                pos_subdirs = 0
+                ignored_subdirs = ignored_dirs.get(dirpath)
+                if ignored_subdirs or matcher is not None:
+                    if matcher is not None:
+                        relative_dirpath = self._get_relative_path(dirpath)
+
+                    while pos_subdirs < num_subdirs:
+                        subdir = subdirs[pos_subdirs]
+                        if ignored_subdirs and subdir in ignored_subdirs:
+                            del subdirs[pos_subdirs]
+                            num_subdirs -= 1
+                            continue
+                        if matcher is not None and \
+                           matcher.matches(os.path.join(relative_dirpath, subdir), True):
+                            del subdirs[pos_subdirs]
+                            num_subdirs -= 1
+                            self._load_stats['pruned'] += 1
+                            continue
+                        path = os.path.join(dirpath, subdir)
+                        wd = add_watch(path, mask)
+                        added_watches.append((path, wd))
+                        pos_subdirs += 1
+                else:
+                    while pos_subdirs < num_subdirs:
+                        subdir = subdirs[pos_subdirs]
+                        path = os.path.join(dirpath, subdir)
+                        wd = add_watch(path, mask)
+                        added_watches.append((path, wd))
+                        pos_subdirs += 1
+
+            yield (dirpath, dirpath_wd, dirnames, files, added_watches)
+            added_watches = []
+
+        # We couldn't list the top.
+        if added_watches:
+            yield (top[0], top[1], [], [], added_watches)
+
+    def __scan_directory(self, dirpath, mask):
+        """Watch the subdirectories of a directory. Returns the new watches
+        and the subdirectories to descend into (symlinks are watched but, like
+        with `walk`, not descended into).
+        """
+
+        i = self._i
+        ignored_subdirs = self._ignored_dirs.get(dirpath)
+        matcher = self._ignore_matcher
+        index = self._index
+        added_watches = []
+        descend = []
+        pruned = 0
+        dirnames = []
+        filenames = []
+
+        try:
+            entries = list(scandir(dirpath))
+        except OSError:
+            # Like `walk`, skip what we can't list.
+            return (dirpath, added_watches, descend, pruned)
+
+        if matcher is not None:
+            relative_dirpath = self._get_relative_path(dirpath)
+
+        for entry in entries:
+            try:
+                if entry.is_dir() is False:
+                    filenames.append(entry.name)
+                    continue
+            except OSError:
+                continue
+
+            dirnames.append(entry.name)
+
+            if ignored_subdirs and entry.name in ignored_subdirs:
+                continue
+
+            if matcher is not None and \
+               matcher.matches(os.path.join(relative_dirpath, entry.name), True):
+                pruned += 1
+                continue
+
+            path = os.path.join(dirpath, entry.name)
+            wd = i.add_watch(path, mask)
+            added_watches.append((path, wd))
+
+            try:
+                is_symlink = entry.is_symlink()
+            except OSError:
+                is_symlink = True
+
+            if is_symlink is False:
+                descend.append(path)
+
+        if index is not None:
+            index.add_directory(i._get_watch_wd(dirpath), dirpath, dirnames, filenames)
+
+        return (dirpath, added_watches, descend, pruned)
+
+    def __scan_directories(self, dirpaths, mask):
+        """Scan directories and, up to a limit, their subdirectories. Returns
+        the results of `__scan_directory()` and the subdirectories that are
+        left to be scanned.
+        """
+
+        results = []
+        stack = list(dirpaths)
+        while stack and len(results) < _LOAD_DIRECTORIES_PER_TASK:
+            result = self.__scan_directory(stack.pop(), mask)
+            results.append(result)
+            stack.extend(result[2])
+
+        return (results, stack)
+
+    def _load_tree_parallel(self, path, workers):
+        """Like `_load_tree()`, but scan the subtrees with several threads
+        (ctypes releases the GIL for the add-watch calls). The result is in
+        the same order that `_load_tree()` would return.
+        """
+
+        mask = self._mask | inotify.constants.IN_ONLYDIR
+        wd = self._i.add_watch(path, mask)
+
+        found = {}
+        descend = {}
+
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        try:
+            futures = set([executor.submit(self.__scan_directories, [path], mask)])
+            while futures:
+                done, futures = concurrent.futures.wait(
+                                    futures,
+                                    return_when=concurrent.futures.FIRST_COMPLETED)
+
+                for future in done:
+                    (results, remaining) = future.result()
+                    for (dirpath, added_watches, subdirs, pruned) in results:
+                        found[dirpath] = added_watches
+                        descend[dirpath] = subdirs
+                        self._load_stats['pruned'] += pruned
+
+                    # Spread what is left over the idle workers.
+                    step = max(1, len(remaining) // workers)
+                    for j in range(0, len(remaining), step):
+                        futures.add(executor.submit(self.__scan_directories,
+                                                    remaining[j:j + step], mask))
+        finally:
+            executor.shutdown(wait=True)
+
+        # Put the watches into the top-down order of `walk`.
+        added_watches = [(path, wd)]
+        stack = [path]
+        while stack:
+            dirpath = stack.pop()
+            added_watches.extend(found[dirpath])
+            stack.extend(reversed(descend[dirpath]))
+
+        return added_watches
+
+class InotifyTree(_BaseTree):
+    """Recursively watch a path."""
+
+    def __init__(self, path, mask=inotify.constants.IN_ALL_EVENTS,
+                 block_duration_s=_DEFAULT_EPOLL_BLOCK_DURATION_S, ignored_dirs=[],
+                 read_buffer_size=_DEFAULT_READ_BUFFER_SIZE, compact_events=False,
+                 load_workers=None, compact_watches=False, ignored_patterns=None,
+                 ignore_matching_events=False, push_masks=False, recover_overflow=False,
+                 index=False, index_stat=False, checkpoint=None, emit_existing=False,
+                 progressive=False, watch_budget=None,
+                 poll_interval_s=_DEFAULT_POLL_INTERVAL_S, shards=1):
+        super(InotifyTree, self).__init__(mask=mask, block_duration_s=block_duration_s,
+              ignored_dirs=ignored_dirs, read_buffer_size=read_buffer_size,
+              compact_events=compact_events, load_workers=load_workers,
+              compact_watches=compact_watches, ignored_patterns=ignored_patterns,
+              ignore_matching_events=ignore_matching_events, push_masks=push_masks,
+              recover_overflow=recover_overflow, index=index, index_stat=index_stat,
+              checkpoint=checkpoint, emit_existing=emit_existing, progressive=progressive,
+              watch_budget=watch_budget, poll_interval_s=poll_interval_s, shards=shards)
+
+        self.__load_tree(path)
+
+    def __load_tree(self, path):
+        _LOGGER.debug("Adding initial watches on tree: [%s]", path)
+        tl_watch_path, tl_watch_desc = self._load_initial_tree(path)[0]
+        self._top_level_watches[tl_watch_path] = tl_watch_desc
+
+
+class InotifyTrees(_BaseTree):
+    """Recursively watch over a list of trees."""
+
+    def __init__(self, paths, mask=inotify.constants.IN_ALL_EVENTS,
+                 block_duration_s=_DEFAULT_EPOLL_BLOCK_DURATION_S, ignored_dirs=[],
+                 read_buffer_size=_DEFAULT_READ_BUFFER_SIZE, compact_events=False,
+                 load_workers=None, compact_watches=False, ignored_patterns=None,
+                 ignore_matching_events=False, push_masks=False, recover_overflow=False,
+                 index=False, index_stat=False, checkpoint=None, emit_existing=False,
+                 progressive=False, watch_budget=None,
+                 poll_interval_s=_DEFAULT_POLL_INTERVAL_S, shards=1):
+        super(InotifyTrees, self).__init__(mask=mask, block_duration_s=block_duration_s,
+              ignored_dirs=ignored_dirs, read_buffer_size=read_buffer_size,
+              compact_events=compact_events, load_workers=load_workers,
+              compact_watches=compact_watches, ignored_patterns=ignored_patterns,
+              ignore_matching_events=ignore_matching_events, push_masks=push_masks,
+              recover_overflow=recover_overflow, index=index, index_stat=index_stat,
+              checkpoint=checkpoint, emit_existing=emit_existing, progressive=progressive,
+              watch_budget=watch_budget, poll_interval_s=poll_interval_s, shards=shards)
+
+        self.__load_trees(paths)
+
+    def __load_trees(self, paths):
+        _LOGGER.debug("Adding initial watches on trees: [%s]", ",".join(map(str, paths)))
+        for path in paths:
+            tl_watch_path, tl_watch_desc = self._load_initial_tree(path)[0]
+            self._top_level_watches[tl_watch_path] = tl_watch_desc
+
+
+class BackgroundReader(object):
+    """Continuously drain an `Inotify` (or one of the trees) on a dedicated
+    thread into a bounded queue, so that a slow consumer doesn't make the
+    kernel queue overflow. When our queue is full, `overflow_policy` decides:
+
+    - OVERFLOW_BLOCK: wait for the consumer (the kernel queue backs up).
+    - OVERFLOW_DROP_OLDEST: drop the oldest queued event.
+    - OVERFLOW_DROP_NEWEST: drop the new event.
+    - OVERFLOW_COALESCE: merge the new event into a queued event for the same
+      path and filename (the masks are OR-ed) or else drop the oldest.
+
+    The remaining arguments are passed to `event_gen_batches()`. The adapter
+    must not be used by anyone else while the reader is running.
+    """
+
+    def __init__(self, adapter, max_size=_DEFAULT_QUEUE_MAX_SIZE,
+                 overflow_policy=OVERFLOW_BLOCK, **kwargs):
+        if overflow_policy not in _OVERFLOW_POLICIES:
+            raise ValueError("overflow_policy must be one of: %s" % (", ".join(_OVERFLOW_POLICIES),))
+
+        if max_size < 1:
+            raise ValueError("max_size must be at least one")
+
+        self.__adapter = adapter
+        self.__max_size = max_size
+        self.__overflow_policy = overflow_policy
+        self.__kwargs = kwargs
+
+        # With coalescing, the queue holds single-item lists that we can
+        # update in-place, and we index the latest one for every key.
+        self.__queue = collections.deque()
+        self.__coalesce_index = {}
+
+        self.__condition = threading.Condition()
+        self.__thread = None
+        self.__stopped = False
+        self.__exception = None
+
+        self.__stats = {
+            'received': 0,
+            'delivered': 0,
+            'dropped_oldest': 0,
+            'dropped_newest': 0,
+            'coalesced': 0,
+            'blocked': 0,
+        }
+
+    def start(self):
+        self.__thread = threading.Thread(target=self.__run, name='inotify-reader')
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop(self, timeout_s=None):
+        """Stop reading. This may take up to the block-duration of the
+        adapter.
+        """
+
+        with self.__condition:
+            self.__stopped = True
+            self.__condition.notify_all()
+
+        if self.__thread is not None:
+            self.__thread.join(timeout_s)
+
+    def __run(self):
+        kwargs = dict(self.__kwargs, yield_nones=True)
+
+        try:
+            for batch in self.__adapter.event_gen_batches(**kwargs):
+                if self.__stopped is True:
+                    break
+
+                if batch is not None:
+                    self.__put(batch)
+        except Exception as e:
+            _LOGGER.exception("Background reader failed.")
+
+            with self.__condition:
+                self.__exception = e
+                self.__condition.notify_all()
+        else:
+            with self.__condition:
+                self.__stopped = True
+                self.__condition.notify_all()
+
+    def __put(self, batch):
+        queue = self.__queue
+        max_size = self.__max_size
+        policy = self.__overflow_policy
+        coalesce_index = self.__coalesce_index
+        stats = self.__stats
+
+        with self.__condition:
+            stats['received'] += len(batch)
+
+            for event in batch:
+                if len(queue) >= max_size:
+                    if policy == OVERFLOW_BLOCK:
+                        stats['blocked'] += 1
+                        while len(queue) >= max_size and self.__stopped is False:
+                            self.__condition.wait()
+
+                        if self.__stopped is True:
+                            return
+                    elif policy == OVERFLOW_DROP_NEWEST:
+                        stats['dropped_newest'] += 1
+                        continue
+                    elif policy == OVERFLOW_COALESCE:
+                        key = _get_event_key(event)
+                        slot = coalesce_index.get(key)
+                        if slot is not None:
+                            slot[0] = _merge_events(slot[0], event)
+                            stats['coalesced'] += 1
+                            continue
+
+                        self.__pop()
+                        stats['dropped_oldest'] += 1
+                    else:
+                        self.__pop()
+                        stats['dropped_oldest'] += 1
+
+                if policy == OVERFLOW_COALESCE:
+                    slot = [event]
+                    coalesce_index[_get_event_key(event)] = slot
+                    queue.append(slot)
+                else:
+                    queue.append(event)
+
+            self.__condition.notify_all()
+
+    def __pop(self):
+        if self.__overflow_policy != OVERFLOW_COALESCE:
+            return self.__queue.popleft()
+
+        slot = self.__queue.popleft()
+        event = slot[0]
+
+        key = _get_event_key(event)
+        if self.__coalesce_index.get(key) is slot:
+            del self.__coalesce_index[key]
+
+        return event
+
+    def get_batch(self, max_events=None, timeout_s=None):
+        """Return up to `max_events` queued events (all by default), waiting
+        for up to `timeout_s` seconds (forever by default) for the first
+        one. If the reader failed, its exception is raised once the queue
+        has been emptied.
+        """
+
+        queue = self.__queue
+
+        with self.__condition:
+            if not queue:
+                if timeout_s is None:
+                    while not queue and self.__exception is None and self.__stopped is False:
+                        self.__condition.wait()
+                else:
+                    deadline_s = _monotonic() + timeout_s
+                    while not queue and self.__exception is None and self.__stopped is False:
+                        remaining_s = deadline_s - _monotonic()
+                        if remaining_s <= 0:
+                            break
+
+                        self.__condition.wait(remaining_s)
+
+            if not queue and self.__exception is not None:
+                raise self.__exception
+
+            if max_events is None or max_events > len(queue):
+                max_events = len(queue)
+
+            batch = [self.__pop() for _ in range(max_events)]
+
+            self.__stats['delivered'] += len(batch)
+            self.__condition.notify_all()
+
+        return batch
+
+    def event_gen(self, timeout_s=None, yield_nones=True):
+        """Yield the queued events one after another. If `timeout_s` is
+        provided, we'll break when no event is received for that many
+        seconds. A None is yielded after every empty second otherwise.
+        """
+
+        while True:
+            if timeout_s is None:
+                batch = self.get_batch(timeout_s=_DEFAULT_EPOLL_BLOCK_DURATION_S)
+            else:
+                batch = self.get_batch(timeout_s=timeout_s)
+
+            if batch:
+                for event in batch:
+                    yield event
+            elif timeout_s is not None or (self.__stopped is True and not self.__queue):
+                break
+            elif yield_nones is True:
+                yield None
+
+    @property
+    def stats(self):
+        """Counters for what was received, delivered, dropped, coalesced and
+        how often the reader had to block, plus the current queue-size.
+        """
+
+        with self.__condition:
+            stats = dict(self.__stats)
+            stats['queued'] = len(self.__queue)
+
+        return stats
+
+
+class EventHub(object):
+    """Serve any number of adapters (`Inotify` or the trees) and foreign
+    descriptors (sockets, eventfds, pipes, ...) from a single epoll, so that
+    one thread can take care of all of them. An adapter's events are passed
+    to its callback a batch (list) at a time, and a descriptor's readiness
+    as `callback(fd, epoll_mask)`. What's registered without a callback is
+    delivered by `event_gen()` instead, as `(adapter, event)` or
+    `(fd, epoll_mask)`.
+
+    Either drive the hub yourself, with `run_once()` or `event_gen()`, or
+    `start()` a thread to do it. An adapter mustn't be read by anyone else
+    while it's registered.
+    """
+
+    def __init__(self, block_duration_s=_DEFAULT_EPOLL_BLOCK_DURATION_S):
+        self.__block_duration_s = block_duration_s
+        self.__epoll = select.epoll()
+
+        # (fd) -> (adapter, inotify, callback, kwargs)
+        self.__adapters = {}
+
+        # (fd) -> callback
+        self.__fds = {}
+
+        # The adapters that had something the last time that we looked, and
+        # that might still have (e.g. more of a tree that's being loaded).
+        self.__hot = set()
+
+        self.__queue = collections.deque()
+
+        # Written to by `stop()` to wake the hub.
+        (self.__wake_fd, self.__wake_write_fd) = os.pipe()
+        flags = fcntl.fcntl(self.__wake_fd, fcntl.F_GETFL)
+        fcntl.fcntl(self.__wake_fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self.__epoll.register(self.__wake_fd, select.EPOLLIN)
+
+        self.__thread = None
+        self.__stopped = False
+        self.__exception = None
+
+        self.__stats = {
+            'cycles': 0,
+            'dispatched': 0,
+            'events': 0,
+        }
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        if self.__wake_fd is None:
+            return
+
+        self.__epoll.close()
+        os.close(self.__wake_fd)
+        os.close(self.__wake_write_fd)
+        self.__wake_fd = None
+
+    def __get_fd(self, source):
+        if isinstance(source, _BaseTree):
+            return source.inotify.fileno()
+
+        if hasattr(source, 'fileno'):
+            return source.fileno()
+
+        return source
+
+    def add_adapter(self, adapter, callback=None, **kwargs):
+        """Serve an `Inotify` or a tree. The remaining arguments are passed
+        to its `read_batch()` (e.g. `mask` or `ignore_missing_new_folders`).
+        """
+
+        if isinstance(adapter, _BaseTree):
+            i = adapter.inotify
+        else:
+            i = adapter
+
+        fd = i.fileno()
+        if fd in self.__adapters or fd in self.__fds:
+            raise ValueError("Already registered: %r" % (adapter,))
+
+        self.__epoll.register(fd, select.EPOLLIN)
+        self.__adapters[fd] = (adapter, i, callback, kwargs)
+
+        # There might already be something for it.
+        self.__hot.add(fd)
+
+    def add_fd(self, fd, callback=None, epoll_mask=select.EPOLLIN):
+        """Serve a foreign descriptor (or anything with a `fileno()`). The
+        descriptor is level-triggered, so whatever made it ready must have
+        been consumed by the time that we look again.
+        """
+
+        fd = self.__get_fd(fd)
+        if fd in self.__adapters or fd in self.__fds:
+            raise ValueError("Already registered: %r" % (fd,))
+
+        self.__epoll.register(fd, epoll_mask)
+        self.__fds[fd] = callback
+
+    def remove(self, source):
+        """Stop serving an adapter or a descriptor. Whatever of it is still
+        queued for `event_gen()` is dropped.
+        """
+
+        fd = self.__get_fd(source)
+        if self.__adapters.pop(fd, None) is None and \
+           self.__fds.pop(fd, False) is False:
+            raise ValueError("Not registered: %r" % (source,))
+
+        self.__epoll.unregister(fd)
+        self.__hot.discard(fd)
+
+        queue = self.__queue
+        if queue:
+            kept = [(s, e) for (s, e) in queue if s is not source and s != fd]
+            queue.clear()
+            queue.extend(kept)
+
+    def __dispatch_adapter(self, fd):
+        """Returns True if the adapter had anything."""
+
+        try:
+            (adapter, i, callback, kwargs) = self.__adapters[fd]
+        except KeyError:
+            # Removed in the meantime.
+            return False
+
+        # We drain ourselves so that the adapter doesn't poll again.
+        i._read_available()
+        batch = adapter.read_batch(timeout_s=0, **kwargs)
+        if not batch:
+            self.__hot.discard(fd)
+            return False
+
+        self.__hot.add(fd)
+        self.__stats['events'] += len(batch)
+
+        if callback is None:
+            self.__queue.extend((adapter, event) for event in batch)
+        else:
+            callback(batch)
+
+        return True
+
+    def __dispatch_fd(self, fd, epoll_mask):
+        try:
+            callback = self.__fds[fd]
+        except KeyError:
+            return
+
+        if callback is None:
+            self.__queue.append((fd, epoll_mask))
+        else:
+            callback(fd, epoll_mask)
+
+    def __get_due(self):
+        """Return the adapters that we have to look at whether they're
+        readable or not, and how long we may otherwise wait for.
+        """
+
+        due = set(self.__hot)
+        max_wait_s = None
+
+        for (fd, (adapter, i, _, _)) in list(self.__adapters.items()):
+            # Trees may be loading or have polled directories to sweep.
+            if i._run_idle_step() is True:
+                due.add(fd)
+                continue
+
+            adapter_max_wait_s = adapter._get_max_wait()
+            if adapter_max_wait_s is None:
+                continue
+            elif adapter_max_wait_s <= 0:
+                due.add(fd)
+            elif max_wait_s is None or adapter_max_wait_s < max_wait_s:
+                max_wait_s = adapter_max_wait_s
+
+        return (due, max_wait_s)
+
+    def run_once(self, timeout_s=None):
+        """Wait for up to `timeout_s` seconds (the block-duration by default)
+        for any of the sources to become ready, and dispatch whatever is.
+        Returns the number of sources that were dispatched.
+        """
+
+        if timeout_s is None:
+            timeout_s = self.__block_duration_s
+
+        (due, max_wait_s) = self.__get_due()
+        if due:
+            timeout_s = 0
+        elif max_wait_s is not None:
+            timeout_s = min(timeout_s, max_wait_s)
+
+        try:
+            ready = self.__epoll.poll(timeout_s)
+        except IOError as e:
+            if e.errno != EINTR:
+                raise
+
+            ready = []
+
+        self.__stats['cycles'] += 1
+
+        dispatched = 0
+        for (fd, epoll_mask) in ready:
+            if fd == self.__wake_fd:
+                try:
+                    os.read(fd, 4096)
+                except OSError as e:
+                    if e.errno != EAGAIN:
+                        raise
+            elif fd in self.__adapters:
+                due.add(fd)
+            else:
+                self.__dispatch_fd(fd, epoll_mask)
+                dispatched += 1
+
+        for fd in due:
+            if self.__dispatch_adapter(fd) is True:
+                dispatched += 1
+
+        self.__stats['dispatched'] += dispatched
+        return dispatched
+
+    def run(self):
+        """Dispatch until `stop()` is called."""
+
+        while self.__stopped is False:
+            self.run_once()
+
+    def start(self):
+        self.__stopped = False
+
+        self.__thread = threading.Thread(target=self.__run, name='inotify-hub')
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop(self, timeout_s=None):
+        """Stop dispatching, and wake the hub if it's waiting."""
+
+        self.__stopped = True
+        os.write(self.__wake_write_fd, b'\0')
+
+        if self.__thread is not None:
+            self.__thread.join(timeout_s)
+
+    def __run(self):
+        try:
+            self.run()
+        except Exception as e:
+            _LOGGER.exception("Event hub failed.")
+            self.__exception = e
+
+    @property
+    def exception(self):
+        """What stopped the thread, if anything did."""
+
+        return self.__exception
+
+    def event_gen(self, timeout_s=None, yield_nones=True):
+        """Dispatch, and yield what's for the sources that don't have a
+        callback. If `timeout_s` is provided, we'll break when nothing is
+        yielded for that many seconds. A None is yielded after every empty
+        cycle otherwise.
+        """
+
+        queue = self.__queue
+
+        last_hit_s = _monotonic()
+        while self.__stopped is False:
+            if not queue:
+                self.run_once()
+
+            if queue:
+                while queue:
+                    yield queue.popleft()
+
+                last_hit_s = _monotonic()
+                continue
+
+            if timeout_s is not None:
+                time_since_event_s = _monotonic() - last_hit_s
+                if time_since_event_s > timeout_s:
+                    break
+
+            if yield_nones is True:
+                yield None
+
+    @property
+    def stats(self):
+        """Counters for the cycles, the dispatches and the adapters' events,
+        plus what's registered and what's queued.
+        """
+
+        stats = dict(self.__stats)
+        stats['adapters'] = len(self.__adapters)
+        stats['fds'] = len(self.__fds)
+        stats['queued'] = len(self.__queue)
+
+        return stats
+
+
+class EventDispatcher(object):
+    """Fan events out to a `concurrent.futures` thread- or process-pool.
+    Events are sharded by watch-descriptor (SHARD_BY_WD, so events for a
+    directory are handled in order) or by the hash of their path and filename
+    (SHARD_BY_PATH, so events for a file are handled in order); the events of
+    one shard are handled one after another, different shards concurrently.
+
+    At most `max_in_flight` events are queued or running at any time;
+    `dispatch()` blocks beyond that. If no `executor` is given, we create (and
+    own) a thread-pool with `workers` threads. With a process-pool, `handler`
+    must be picklable.
+    """
+
+    def __init__(self, adapter, handler, executor=None, workers=_DEFAULT_DISPATCH_WORKERS,
+                 num_shards=None, shard_by=SHARD_BY_WD,
+                 max_in_flight=_DEFAULT_DISPATCH_MAX_IN_FLIGHT):
+        if shard_by not in (SHARD_BY_WD, SHARD_BY_PATH):
+            raise ValueError("shard_by must be SHARD_BY_WD or SHARD_BY_PATH")
+
+        if executor is None:
+            if _HAS_FUTURES is False:
+                raise EnvironmentError("concurrent.futures is not available. Please install 'futures'.")
+
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+            self.__owns_executor = True
+        else:
+            self.__owns_executor = False
+
+        if num_shards is None:
+            num_shards = workers
+
+        self.__adapter = adapter
+        self.__handler = handler
+        self.__executor = executor
+        self.__shard_by = shard_by
+        self.__max_in_flight = max_in_flight
+
+        # The events waiting in each shard, and whether one is running.
+        self.__shards = [collections.deque() for _ in range(num_shards)]
+        self.__running = [False] * num_shards
+
+        self.__condition = threading.Condition()
+        self.__in_flight = 0
+        self.__stopped = False
+
+        self.__stats = {
+            'dispatched': 0,
+            'completed': 0,
+            'failed': 0,
+        }
+
+    def __get_shard(self, event):
+        if self.__shard_by == SHARD_BY_WD:
+            if isinstance(event, InotifyEvent):
+                key = event.wd
+            else:
+                key = event[0].wd
+        else:
+            key = hash(_get_event_key(event))
+
+        return key % len(self.__shards)
+
+    def dispatch(self, event):
+        """Queue an event to its shard, blocking while `max_in_flight` events
+        are outstanding.
+        """
+
+        shard = self.__get_shard(event)
+
+        with self.__condition:
+            while self.__in_flight >= self.__max_in_flight:
+                self.__condition.wait()
+
+            self.__in_flight += 1
+            self.__stats['dispatched'] += 1
+
+            if self.__running[shard] is True:
+                self.__shards[shard].append(event)
+                return
+
+            self.__running[shard] = True
+
+        self.__submit(shard, event)
+
+    def __submit(self, shard, event):
+        future = self.__executor.submit(self.__handler, event)
+        future.add_done_callback(lambda f: self.__done(shard, f))
+
+    def __done(self, shard, future):
+        if future.exception() is not None:
+            _LOGGER.error("Event handler failed: %r", future.exception())
+            failed = True
+        else:
+            failed = False
+
+        with self.__condition:
+            self.__in_flight -= 1
+            if failed is True:
+                self.__stats['failed'] += 1
+            else:
+                self.__stats['completed'] += 1
+
+            waiting = self.__shards[shard]
+            if waiting:
+                event = waiting.popleft()
+            else:
+                event = None
+                self.__running[shard] = False
+
+            self.__condition.notify_all()
+
+        if event is not None:
+            self.__submit(shard, event)
+
+    def run(self, **kwargs):
+        """Dispatch the events of the adapter until `stop()` is called. The
+        arguments are passed to `event_gen_batches()`.
+        """
+
+        kwargs['yield_nones'] = True
+        for batch in self.__adapter.event_gen_batches(**kwargs):
+            if self.__stopped is True:
+                break
+
+            if batch is not None:
+                for event in batch:
+                    self.dispatch(event)
+
+    def stop(self):
+        """Make `run()` return (after up to the block-duration)."""
+
+        self.__stopped = True
+
+    def join(self, timeout_s=None):
+        """Wait until all of the dispatched events have been handled. Returns
+        False on timeout.
+        """
+
+        with self.__condition:
+            if timeout_s is None:
+                while self.__in_flight > 0:
+                    self.__condition.wait()
+            else:
+                deadline_s = _monotonic() + timeout_s
+                while self.__in_flight > 0:
+                    remaining_s = deadline_s - _monotonic()
+                    if remaining_s <= 0:
+                        return False
+
+                    self.__condition.wait(remaining_s)
+
+        return True
+
+    def close(self):
+        """Wait for the outstanding events and shut our own pool down."""
+
+        self.join()
+
+        if self.__owns_executor is True:
+            self.__executor.shutdown()
+
+    @property
+    def stats(self):
+        with self.__condition:
+            stats = dict(self.__stats)
+            stats['in_flight'] = self.__in_flight
+
+        return stats
+
+
+class EventCoalescer(object):
+    """Merge bursts of events for the same path and filename into one event
+    (the masks are OR-ed). An event is emitted once nothing more has arrived
+    for it for `quiet_s` seconds, or `max_latency_s` seconds after its first
+    event, whichever comes first.
+
+    `cancel_rules` is a sequence of (first mask, then mask) pairs. When an
+    event with any of the "then" bits arrives for a pending event that has any
+    of the "first" bits, both are dropped. By default a file that is created
+    and deleted within the window is never reported.
+
+    At most `max_pending` paths are held; beyond that, the oldest is emitted
+    early. A `now_s` passed to `add()` or `flush_due()` is on the monotonic
+    clock, like the default.
+    """
+
+    def __init__(self, quiet_s=_DEFAULT_COALESCE_QUIET_S,
+                 max_latency_s=_DEFAULT_COALESCE_MAX_LATENCY_S,
+                 max_pending=_DEFAULT_QUEUE_MAX_SIZE,
+                 cancel_rules=_DEFAULT_CANCEL_RULES):
+        if max_pending < 1:
+            raise ValueError("max_pending must be at least one")
+
+        self.__quiet_s = quiet_s
+        self.__max_latency_s = max_latency_s
+        self.__max_pending = max_pending
+        self.__cancel_rules = tuple(cancel_rules)
+
+        # In the order of the first event: key -> [event, first_s, last_s,
+        # mask of the first event]
+        self.__pending = collections.OrderedDict()
+
+        self.__stats = {
+            'received': 0,
+            'emitted': 0,
+            'merged': 0,
+            'cancelled': 0,
+            'evicted': 0,
+        }
+
+    def add(self, event, now_s=None):
+        """Take an event. Returns the events that had to be emitted early to
+        stay within `max_pending` (usually none).
+        """
+
+        if now_s is None:
+            now_s = _monotonic()
+
+        pending = self.__pending
+        stats = self.__stats
+        stats['received'] += 1
+
+        key = _get_event_key(event)
+        entry = pending.get(key)
+        if entry is not None:
+            mask = _get_any_event_mask(event)
+            pending_mask = _get_any_event_mask(entry[0])
+
+            for first_mask, then_mask in self.__cancel_rules:
+                if not (pending_mask & first_mask and mask & then_mask):
+                    continue
+
+                # Only what we've seen come into existence can vanish without
+                # a trace. Otherwise (e.g. a file that was there, deleted,
+                # created and deleted again), it's the last event that counts.
+                if entry[3] & first_mask:
+                    del pending[key]
+                    stats['cancelled'] += 2
+                else:
+                    entry[0] = event
+                    entry[2] = now_s
+                    stats['merged'] += 1
+
+                return []
+
+            entry[0] = _merge_events(entry[0], event)
+            entry[2] = now_s
+            stats['merged'] += 1
+            return []
+
+        evicted = []
+        while len(pending) >= self.__max_pending:
+            (_, old_entry) = pending.popitem(last=False)
+            evicted.append(old_entry[0])
+
+        if evicted:
+            stats['evicted'] += len(evicted)
+            stats['emitted'] += len(evicted)
+
+        pending[key] = [event, now_s, now_s, _get_any_event_mask(event)]
+        return evicted
+
+    def flush_due(self, now_s=None):
+        """Return the pending events that are quiet, or have waited long
+        enough, in the order of their first event.
+        """
+
+        if now_s is None:
+            now_s = _monotonic()
+
+        pending = self.__pending
+        quiet_s = self.__quiet_s
+        max_latency_s = self.__max_latency_s
+
+        due = [key
+               for (key, (_, first_s, last_s, _)) in pending.items()
+               if now_s - last_s >= quiet_s or now_s - first_s >= max_latency_s]
+
+        events = [pending.pop(key)[0] for key in due]
+        self.__stats['emitted'] += len(events)
+        return events
+
+    def flush(self):
+        """Return all pending events."""
+
+        events = [entry[0] for entry in self.__pending.values()]
+        self.__pending.clear()
+
+        self.__stats['emitted'] += len(events)
+        return events
+
+    def event_gen(self, events, yield_nones=True):
+        """Coalesce the output of an `event_gen()`. The source must yield
+        Nones (the default), since that is when we emit what is due; its
+        block-duration should not be longer than `quiet_s`. Whatever is
+        pending when the source ends is emitted.
+        """
+
+        for event in events:
+            if event is None:
+                for due_event in self.flush_due():
+                    yield due_event
+
+                if yield_nones is True:
+                    yield None
+            else:
+                for evicted_event in self.add(event):
+                    yield evicted_event
+
+        for event in self.flush():
+            yield event
+
+    @property
+    def stats(self):
+        """Counters for what was received, emitted, merged, cancelled and
+        emitted early, the number of pending paths and the compression ratio
+        (received per emitted event; None until something is emitted).
+        """
+
+        stats = dict(self.__stats)
+        stats['pending'] = len(self.__pending)
+
+        if stats['emitted'] > 0:
+            stats['compression_ratio'] = float(stats['received']) / stats['emitted']
+        else:
+            stats['compression_ratio'] = None
+
+        return stats
+
+
+class MovePairer(object):
+    """Join every IN_MOVED_FROM with the IN_MOVED_TO that has the same cookie
+    into one `MoveEvent`. An IN_MOVED_TO without a partner (something moved
+    in from outside) is passed through right away, and an IN_MOVED_FROM that
+    isn't matched within `timeout_s` seconds (something moved out) is passed
+    through then, or as soon as another event for the same path and filename
+    comes along (so that, e.g., a file that's moved out and created again
+    isn't reported the other way around). At most `max_pending` moves are
+    held; beyond that, the oldest is passed through early. All other events
+    pass straight through. A `now_s` passed to `add()` or `flush_due()` is on
+    the monotonic clock, like the default.
+    """
+
+    def __init__(self, timeout_s=_DEFAULT_MOVE_TIMEOUT_S,
+                 max_pending=_DEFAULT_MOVE_MAX_PENDING):
+        if max_pending < 1:
+            raise ValueError("max_pending must be at least one")
+
+        self.__timeout_s = timeout_s
+        self.__max_pending = max_pending
+
+        # In the order of arrival: cookie -> (event, received_s)
+        self.__pending = collections.OrderedDict()
+
+        # (path, filename) -> cookie of the pending move
+        self.__cookies_by_key = {}
+
+        self.__stats = {
+            'received': 0,
+            'paired': 0,
+            'moved_out': 0,
+            'moved_in': 0,
+            'evicted': 0,
+        }
+
+    def add(self, event, now_s=None):
+        """Take an event and return what is to be emitted (the event itself,
+        a `MoveEvent`, and/or expired moves, in order).
+        """
+
+        if now_s is None:
+            now_s = _monotonic()
+
+        self.__stats['received'] += 1
+
+        events = self.flush_due(now_s)
+
+        if isinstance(event, InotifyEvent):
+            mask = event.mask
+            cookie = event.cookie
+        else:
+            (mask, cookie) = (event[0].mask, event[0].cookie)
+
+        # Something that was moved away from here goes out before whatever
+        # happens to the name next (unless it's its own partner).
+        key = _get_event_key(event)
+        held_cookie = self.__cookies_by_key.get(key)
+        if held_cookie is not None and \
+           (held_cookie != cookie or not mask & inotify.constants.IN_MOVED_TO):
+            events.append(self.__pop(held_cookie))
+            self.__stats['moved_out'] += 1
+
+        if mask & inotify.constants.IN_MOVED_FROM:
+            pending = self.__pending
+            while len(pending) >= self.__max_pending:
+                events.append(self.__pop(next(iter(pending))))
+                self.__stats['evicted'] += 1
+                self.__stats['moved_out'] += 1
+
+            pending[cookie] = (event, now_s)
+            self.__cookies_by_key[key] = cookie
+        elif mask & inotify.constants.IN_MOVED_TO:
+            entry = self.__pending.pop(cookie, None)
+            if entry is not None:
+                self.__forget(entry[0], cookie)
+            if entry is None:
+                self.__stats['moved_in'] += 1
+                events.append(event)
+            else:
+                self.__stats['paired'] += 1
+                events.append(MoveEvent(entry[0], event))
+        else:
+            events.append(event)
+
+        return events
+
+    def __forget(self, event, cookie):
+        key = _get_event_key(event)
+        if self.__cookies_by_key.get(key) == cookie:
+            del self.__cookies_by_key[key]
+
+    def __pop(self, cookie):
+        (event, _) = self.__pending.pop(cookie)
+        self.__forget(event, cookie)
+
+        return event
+
+    def flush_due(self, now_s=None):
+        """Return the moves that have waited for their partner for too
+        long.
+        """
+
+        if now_s is None:
+            now_s = _monotonic()
+
+        pending = self.__pending
+        expiry_s = now_s - self.__timeout_s
+
+        events = []
+        while pending:
+            cookie = next(iter(pending))
+            (event, received_s) = pending[cookie]
+            if received_s > expiry_s:
+                break
+
+            events.append(self.__pop(cookie))
+
+        self.__stats['moved_out'] += len(events)
+        return events
+
+    def flush(self):
+        """Return all unmatched moves."""
+
+        events = [event for (event, _) in self.__pending.values()]
+        self.__pending.clear()
+        self.__cookies_by_key.clear()
+
+        self.__stats['moved_out'] += len(events)
+        return events
+
+    def event_gen(self, events, yield_nones=True):
+        """Pair the moves in the output of an `event_gen()`. Unmatched moves
+        are only passed through on a None or with the next event, so the
+        source should yield Nones (the default). Whatever is pending when the
+        source ends is passed through.
+        """
+
+        for event in events:
+            if event is None:
+                for due_event in self.flush_due():
+                    yield due_event
+
+                if yield_nones is True:
+                    yield None
+            else:
+                for new_event in self.add(event):
+                    yield new_event
+
+        for event in self.flush():
+            yield event
+
+    @property
+    def stats(self):
+        stats = dict(self.__stats)
+        stats['pending'] = len(self.__pending)
+
+        return stats
@@ -0,0 +1,172 @@
+"""asyncio counterparts of the adapters. The inotify descriptor is watched
+with `loop.add_reader()`, so there is no polling thread and no block-duration.
+"""
+
+import asyncio
+import collections
+import logging
+
+import inotify.adapters
+import inotify.constants
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def _set_readable(future):
+    if not future.done():
+        future.set_result(True)
+
+
+def _get_running_loop():
+    try:
+        return asyncio.get_running_loop()
+    except AttributeError:
+        return asyncio.get_event_loop()
+
+
+class _AsyncMixin(object):
+    """Supplies `next_batch()` and `async for` on top of the non-blocking
+    drain of an `Inotify`.
+    """
+
+    def _async_init(self, i):
+        self.__i = i
+        self.__pending = collections.deque()
+        self.__waiter = None
+        self.__closed = False
+
+    def _take_async_batch(self, i, terminal_events, mask, **kwargs):
+        return i._take_batch(terminal_events=terminal_events, mask=mask)
+
+    async def __wait_readable(self, timeout_s):
+        """Wait for the descriptor to become readable. Returns False on
+        timeout.
+        """
+
+        loop = _get_running_loop()
+        fd = self.__i.fileno()
+
+        waiter = loop.create_future()
+        loop.add_reader(fd, _set_readable, waiter)
+        self.__waiter = waiter
+
+        try:
+            if timeout_s is None:
+                await waiter
+            else:
+                await asyncio.wait_for(waiter, timeout_s)
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self.__waiter = None
+            loop.remove_reader(fd)
+
+        return True
+
+    async def next_batch(self, timeout_s=None,
+                         terminal_events=inotify.adapters._DEFAULT_TERMINAL_EVENTS,
+                         mask=inotify.constants.IN_ALL_EVENTS, **kwargs):
+        """Wait for events and return everything from one drain as a list. If
+        `timeout_s` is given and nothing arrives in that many seconds, an
+        empty list is returned.
+        """
+
+        pending = self.__pending
+        if pending:
+            batch = list(pending)
+            pending.clear()
+            return batch
+
+        i = self.__i
+
+        if timeout_s is not None:
+            deadline_s = _get_running_loop().time() + timeout_s
+
+        while self.__closed is False:
+            i._read_available()
+            batch = self._take_async_batch(i, terminal_events, mask, **kwargs)
+            if batch:
+                return batch
+
+            # Rather than wait, get on with whatever the tree is loading (and
+            # let the loop breathe in-between).
+            if i._run_idle_step() is True:
+                await asyncio.sleep(0)
+                continue
+
+            if timeout_s is None:
+                remaining_s = None
+            else:
+                remaining_s = deadline_s - _get_running_loop().time()
+                if remaining_s <= 0:
+                    break
+
+            # We might have to get back to something else (like a sweep of
+            # the polled directories) before then.
+            max_wait_s = self._get_max_wait()
+            if max_wait_s is not None and \
+               (remaining_s is None or max_wait_s < remaining_s):
+                await self.__wait_readable(max_wait_s)
+            elif await self.__wait_readable(remaining_s) is False:
+                break
+
+        return []
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        pending = self.__pending
+        while not pending:
+            if self.__closed is True:
+                raise StopAsyncIteration
+
+            pending.extend(await self.next_batch())
+
+        return pending.popleft()
+
+    def close(self):
+        """Stop iterating and wake-up anyone who is waiting."""
+
+        self.__closed = True
+
+        waiter = self.__waiter
+        if waiter is not None:
+            _set_readable(waiter)
+
+
+class AsyncInotify(_AsyncMixin, inotify.adapters.Inotify):
+    def __init__(self, *args, **kwargs):
+        super(AsyncInotify, self).__init__(*args, **kwargs)
+        self._async_init(self)
+
+
+class _AsyncTreeMixin(_AsyncMixin):
+    def _take_async_batch(self, i, terminal_events, mask,
+                          ignore_missing_new_folders=False):
+        synthetic_events = self._take_synthetic_events(mask) or \
+                           self._take_existing_events(mask)
+        if synthetic_events:
+            return synthetic_events
+
+        # We filter after we've seen the directory events.
+        batch = i._take_batch(terminal_events=self._get_terminal_events(terminal_events))
+        batch = self._process_batch(batch, ignore_missing_new_folders, mask)
+
+        return batch + self._take_polled_events(ignore_missing_new_folders, mask)
+
+
+class AsyncInotifyTree(_AsyncTreeMixin, inotify.adapters.InotifyTree):
+    """Recursively watch a path."""
+
+    def __init__(self, *args, **kwargs):
+        super(AsyncInotifyTree, self).__init__(*args, **kwargs)
+        self._async_init(self._i)
+
+
+class AsyncInotifyTrees(_AsyncTreeMixin, inotify.adapters.InotifyTrees):
+    """Recursively watch over a list of trees."""
+
+    def __init__(self, *args, **kwargs):
+        super(AsyncInotifyTrees, self).__init__(*args, **kwargs)
+        self._async_init(self._i)
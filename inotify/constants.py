@@ -50,6 +50,10 @@ IN_ONESHOT     = 0x80000000 # Only send event once.
 
 IN_ISDIR       = 0x40000000 # Event occurred against dir.
 
+# set by the adapters (a bit that inotify doesn't use):
+
+IN_SYNTHETIC   = 0x00100000 # Event was made-up, not read from the kernel.
+
 ## All events sent by kernel
 
 IN_ALL_EVENTS  = (IN_ALL_EVENTS_WATCH | IN_UNMOUNT | IN_Q_OVERFLOW | IN_IGNORED)
@@ -92,6 +96,10 @@ MASK_LOOKUP = {
     0x20000000: 'IN_MASK_ADD',
     0x40000000: 'IN_ISDIR',
     0x80000000: 'IN_ONESHOT',
+
+    ## Adapter flags.
+
+    0x00100000: 'IN_SYNTHETIC',
 }
 
 # Do not optimize away the unspecified combinations for IN_ISDIR
@@ -101,3 +109,22 @@ MASK_LOOKUP = {
 MASK_LOOKUP_COMB = dict(((em|dm, [en]+dn)
                          for em, en in MASK_LOOKUP.items() if em & IN_ALL_EVENTS
                          for dm, dn in ((0, []), (IN_ISDIR, ['IN_ISDIR']))))
+
+## Immutable type-names for the masks returned by the kernel.
+
+# In the same order as MASK_LOOKUP_COMB: the event bits in ascending order and
+# IN_ISDIR last (but for our own IN_SYNTHETIC). Masks can be resolved
+# bit-by-bit against this.
+MASK_LOOKUP_BITS = tuple(sorted((em, en) for em, en in MASK_LOOKUP.items()
+                                if em & IN_ALL_EVENTS)) + \
+                   ((IN_ISDIR, 'IN_ISDIR'),
+                    (IN_SYNTHETIC, 'IN_SYNTHETIC'))
+
+# Precomputed for every single event (and no event at all, for a bare
+# IN_ISDIR) optionally combined with IN_IGNORED and/or IN_ISDIR.
+MASK_LOOKUP_NAMES = dict((mask, tuple(name for bit, name in MASK_LOOKUP_BITS
+                                      if mask & bit))
+                         for mask in set(em | im | dm
+                                         for em in [0] + [em for em, _ in MASK_LOOKUP_BITS[:-2]]
+                                         for im in (0, IN_IGNORED)
+                                         for dm in (0, IN_ISDIR)))
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import unittest
+
+import inotify.constants
+import inotify.adapters
+import inotify.test_support
+
+if sys.version_info >= (3, 5):
+    import asyncio
+    import inotify.async_adapters
+
+
+def _run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+@unittest.skipIf(sys.version_info < (3, 5), "Needs asyncio with async/await")
+class TestAsyncInotify(unittest.TestCase):
+    def __init__(self, *args, **kwargs):
+        self.maxDiff = None
+
+        super(TestAsyncInotify, self).__init__(*args, **kwargs)
+
+    def test__next_batch(self):
+        with inotify.test_support.temp_path() as path:
+            i = inotify.async_adapters.AsyncInotify()
+            i.add_watch(path, inotify.constants.IN_CREATE)
+
+            async def consume():
+                with open(os.path.join(path, 'seen_new_file'), 'w'):
+                    pass
+
+                batch = await i.next_batch(timeout_s=1)
+                empty = await i.next_batch(timeout_s=0.1)
+                return (batch, empty)
+
+            (batch, empty) = _run(consume())
+
+            expected = [
+                (inotify.adapters._INOTIFY_EVENT(wd=1, mask=256, cookie=0, len=16), ('IN_CREATE',), path, 'seen_new_file'),
+            ]
+
+            self.assertEquals(batch, expected)
+            self.assertEquals(empty, [])
+
+    def test__async_iteration(self):
+        with inotify.test_support.temp_path() as path:
+            i = inotify.async_adapters.AsyncInotify()
+            i.add_watch(path, inotify.constants.IN_CREATE)
+
+            async def create_files():
+                for name in ('file1', 'file2', 'file3'):
+                    await asyncio.sleep(0.01)
+                    with open(os.path.join(path, name), 'w'):
+                        pass
+
+            async def consume():
+                asyncio.ensure_future(create_files())
+
+                filenames = []
+                async for (_, _, _, filename) in i:
+                    filenames.append(filename)
+                    if len(filenames) == 3:
+                        i.close()
+
+                return filenames
+
+            self.assertEquals(_run(consume()), ['file1', 'file2', 'file3'])
+
+
+@unittest.skipIf(sys.version_info < (3, 5), "Needs asyncio with async/await")
+class TestAsyncInotifyTree(unittest.TestCase):
+    def test__automatic_new_watches(self):
+        with inotify.test_support.temp_path() as path:
+            path1 = os.path.join(path, 'aa')
+
+            i = inotify.async_adapters.AsyncInotifyTree(path, mask=inotify.constants.IN_CREATE)
+
+            async def consume():
+                os.mkdir(path1)
+                batch1 = await i.next_batch(timeout_s=1)
+
+                with open(os.path.join(path1, 'seen_new_file'), 'w'):
+                    pass
+
+                batch2 = await i.next_batch(timeout_s=1)
+                return batch1 + batch2
+
+            events = _run(consume())
+
+            expected = [
+                (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073742080, cookie=0, len=16), ('IN_CREATE', 'IN_ISDIR'), path, 'aa'),
+                (inotify.adapters._INOTIFY_EVENT(wd=2, mask=256, cookie=0, len=16), ('IN_CREATE',), path1, 'seen_new_file'),
+            ]
+
+            self.assertEquals(events, expected)
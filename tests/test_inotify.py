@@ -7,7 +7,17 @@ if sys.version_info < (2, 7):
 else:
     import unittest
 import errno
+import fcntl
+import select
 import shutil
+import struct
+import threading
+import time
+
+try:
+    import concurrent.futures
+except ImportError:
+    pass
 
 import inotify.constants
 import inotify.adapters
@@ -38,23 +48,23 @@ def setUpModule():
         events = list(i.event_gen(timeout_s=1, yield_nones=False))
 
         expected_na = [
-            (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741856, cookie=0, len=16), ['IN_OPEN', 'IN_ISDIR'], path, subdirname),
-            (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741840, cookie=0, len=16), ['IN_CLOSE_NOWRITE', 'IN_ISDIR'], path, subdirname),
+            (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741856, cookie=0, len=16), ('IN_OPEN', 'IN_ISDIR'), path, subdirname),
+            (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741840, cookie=0, len=16), ('IN_CLOSE_NOWRITE', 'IN_ISDIR'), path, subdirname),
         ]
         expected_wa = [
-            (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741856, cookie=0, len=16), ['IN_OPEN', 'IN_ISDIR'], path, subdirname),
-            (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741825, cookie=0, len=16), ['IN_ACCESS', 'IN_ISDIR'], path, subdirname),
-            (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741840, cookie=0, len=16), ['IN_CLOSE_NOWRITE', 'IN_ISDIR'], path, subdirname),
+            (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741856, cookie=0, len=16), ('IN_OPEN', 'IN_ISDIR'), path, subdirname),
+            (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741825, cookie=0, len=16), ('IN_ACCESS', 'IN_ISDIR'), path, subdirname),
+            (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741840, cookie=0, len=16), ('IN_CLOSE_NOWRITE', 'IN_ISDIR'), path, subdirname),
         ]
         expected_ws = [
-                (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073742336, cookie=0, len=16), ['IN_DELETE', 'IN_ISDIR'], path, subdirname),
-                (inotify.adapters._INOTIFY_EVENT(wd=2, mask=1024, cookie=0, len=0), ['IN_DELETE_SELF'], inner_path, ''),
-                (inotify.adapters._INOTIFY_EVENT(wd=2, mask=32768, cookie=0, len=0), ['IN_IGNORED'], inner_path, ''),
+                (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073742336, cookie=0, len=16), ('IN_DELETE', 'IN_ISDIR'), path, subdirname),
+                (inotify.adapters._INOTIFY_EVENT(wd=2, mask=1024, cookie=0, len=0), ('IN_DELETE_SELF',), inner_path, ''),
+                (inotify.adapters._INOTIFY_EVENT(wd=2, mask=32768, cookie=0, len=0), ('IN_IGNORED',), inner_path, ''),
         ]
         expected_ns = [
-                (inotify.adapters._INOTIFY_EVENT(wd=2, mask=1024, cookie=0, len=0), ['IN_DELETE_SELF'], inner_path, ''),
-                (inotify.adapters._INOTIFY_EVENT(wd=2, mask=32768, cookie=0, len=0), ['IN_IGNORED'], inner_path, ''),
-                (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073742336, cookie=0, len=16), ['IN_DELETE', 'IN_ISDIR'], path, subdirname),
+                (inotify.adapters._INOTIFY_EVENT(wd=2, mask=1024, cookie=0, len=0), ('IN_DELETE_SELF',), inner_path, ''),
+                (inotify.adapters._INOTIFY_EVENT(wd=2, mask=32768, cookie=0, len=0), ('IN_IGNORED',), inner_path, ''),
+                (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073742336, cookie=0, len=16), ('IN_DELETE', 'IN_ISDIR'), path, subdirname),
         ]
         global _HAS_DIRECTORY_ACCESS_EVENTS
         global _HAS_STRONG_PARENT_AFTER_CHILD
@@ -107,9 +117,9 @@ class TestInotify(unittest.TestCase):
             events = self.__read_all_events(i)
 
             expected = [
-                (inotify.adapters._INOTIFY_EVENT(wd=1, mask=256, cookie=0, len=16), ['IN_CREATE'], inner_path, 'filename'),
-                (inotify.adapters._INOTIFY_EVENT(wd=1, mask=32, cookie=0, len=16), ['IN_OPEN'], inner_path, 'filename'),
-                (inotify.adapters._INOTIFY_EVENT(wd=1, mask=8, cookie=0, len=16), ['IN_CLOSE_WRITE'], inner_path, 'filename'),
+                (inotify.adapters._INOTIFY_EVENT(wd=1, mask=256, cookie=0, len=16), ('IN_CREATE',), inner_path, 'filename'),
+                (inotify.adapters._INOTIFY_EVENT(wd=1, mask=32, cookie=0, len=16), ('IN_OPEN',), inner_path, 'filename'),
+                (inotify.adapters._INOTIFY_EVENT(wd=1, mask=8, cookie=0, len=16), ('IN_CLOSE_WRITE',), inner_path, 'filename'),
             ]
 
             self.assertEquals(events, expected)
@@ -129,9 +139,9 @@ class TestInotify(unittest.TestCase):
             events = self.__read_all_events(i)
 
             expected = [
-                (inotify.adapters._INOTIFY_EVENT(wd=1, mask=256, cookie=0, len=16), ['IN_CREATE'], inner_path, u'filename料夾'),
-                (inotify.adapters._INOTIFY_EVENT(wd=1, mask=32, cookie=0, len=16), ['IN_OPEN'], inner_path, u'filename料夾'),
-                (inotify.adapters._INOTIFY_EVENT(wd=1, mask=8, cookie=0, len=16), ['IN_CLOSE_WRITE'], inner_path, u'filename料夾'),
+                (inotify.adapters._INOTIFY_EVENT(wd=1, mask=256, cookie=0, len=16), ('IN_CREATE',), inner_path, u'filename料夾'),
+                (inotify.adapters._INOTIFY_EVENT(wd=1, mask=32, cookie=0, len=16), ('IN_OPEN',), inner_path, u'filename料夾'),
+                (inotify.adapters._INOTIFY_EVENT(wd=1, mask=8, cookie=0, len=16), ('IN_CLOSE_WRITE',), inner_path, u'filename料夾'),
             ]
 
             self.assertEquals(events, expected)
@@ -163,25 +173,25 @@ class TestInotify(unittest.TestCase):
             expected = [
                 (
                     inotify.adapters._INOTIFY_EVENT(wd=1, mask=256, cookie=0, len=16),
-                    ['IN_CREATE'],
+                    ('IN_CREATE',),
                     path1,
                     'seen_new_file'
                 ),
                 (
                     inotify.adapters._INOTIFY_EVENT(wd=1, mask=32, cookie=0, len=16),
-                    ['IN_OPEN'],
+                    ('IN_OPEN',),
                     path1,
                     'seen_new_file'
                 ),
                 (
                     inotify.adapters._INOTIFY_EVENT(wd=1, mask=8, cookie=0, len=16),
-                    ['IN_CLOSE_WRITE'],
+                    ('IN_CLOSE_WRITE',),
                     path1,
                     'seen_new_file'
                 ),
                 (
                     inotify.adapters._INOTIFY_EVENT(wd=1, mask=512, cookie=0, len=16),
-                    ['IN_DELETE'],
+                    ('IN_DELETE',),
                     path1,
                     'seen_new_file'
                 )
@@ -218,500 +228,2249 @@ class TestInotify(unittest.TestCase):
 #
 #        self.assertEquals(names, all_names)
 
-    def test__exception_errno(self):
-        with inotify.test_support.temp_path() as path:
-            i = inotify.adapters.Inotify()
-            errnum = None
-            path1 = os.path.join(path, 'abc')
-            try:
-                i.add_watch(path1)
-            except inotify.calls.InotifyError as ex:
-                errnum = ex.errno
-            self.assertEquals(errnum, errno.ENOENT)
+    def test__get_event_names_combinations(self):
+        i = inotify.adapters.Inotify()
 
-class TestInotifyTree(unittest.TestCase):
-    def __init__(self, *args, **kwargs):
-        self.maxDiff = None
+        names = i._get_event_names(inotify.constants.IN_DELETE_SELF | inotify.constants.IN_IGNORED)
+        self.assertEquals(names, ('IN_DELETE_SELF', 'IN_IGNORED'))
 
-        super(TestInotifyTree, self).__init__(*args, **kwargs)
+        names = i._get_event_names(inotify.constants.IN_CREATE | inotify.constants.IN_ISDIR)
+        self.assertEquals(names, ('IN_CREATE', 'IN_ISDIR'))
 
-    @classmethod
-    def setUpClass(cls):
-        global _HAS_DIRECTORY_ACCESS_EVENTS
-        cls._HAS_DIRECTORY_ACCESS_EVENTS = _HAS_DIRECTORY_ACCESS_EVENTS
-        global _HAS_STRONG_PARENT_AFTER_CHILD
-        cls._HAS_STRONG_PARENT_AFTER_CHILD = _HAS_STRONG_PARENT_AFTER_CHILD
+        # Combinations that weren't precomputed are resolved and cached.
+        mask = inotify.constants.IN_MODIFY | inotify.constants.IN_ATTRIB | \
+               inotify.constants.IN_IGNORED | inotify.constants.IN_ISDIR
+        names = i._get_event_names(mask)
+        self.assertEquals(names, ('IN_MODIFY', 'IN_ATTRIB', 'IN_IGNORED', 'IN_ISDIR'))
+        self.assertTrue(i._get_event_names(mask) is names)
 
-    def __read_all_events(self, i):
-        events = list(i.event_gen(timeout_s=1, yield_nones=False))
-        return events
+        self.assertEquals(i._get_event_names(0), ())
 
-    def test__cycle(self):
+    def test__bulk_drain(self):
         with inotify.test_support.temp_path() as path:
-            path1 = os.path.join(path, 'aa')
-            os.mkdir(path1)
+            i = inotify.adapters.Inotify(read_buffer_size=4096)
+            i.add_watch(path, inotify.constants.IN_CREATE)
 
-            path2 = os.path.join(path, 'bb')
-            os.mkdir(path2)
+            fd = i._Inotify__inotify_fd
+            self.assertTrue(fcntl.fcntl(fd, fcntl.F_GETFL) & os.O_NONBLOCK)
+            self.assertTrue(fcntl.fcntl(fd, fcntl.F_GETFD) & fcntl.FD_CLOEXEC)
 
-            i = inotify.adapters.InotifyTree(path)
+            names = ['%s_%04d' % ('x' * 64, n) for n in range(500)]
+            for name in names:
+                with open(os.path.join(path, name), 'w'):
+                    pass
 
-            watches = i._i._Inotify__watches
-            w2, w3 = watches[path1], watches[path2]
+            # A single wakeup drains everything that is queued, even though
+            # it is far more than fits in one read.
+            events = list(i._handle_inotify_event(fd))
+            self.assertEquals([filename for (_, _, _, filename) in events], names)
 
-            with open(os.path.join(path, 'seen_new_file1'), 'w'):
-                pass
+            self.assertEquals(list(i._handle_inotify_event(fd)), [])
 
-            with open(os.path.join(path1, 'seen_new_file2'), 'w'):
-                pass
+    def test__abandoned_events_are_kept(self):
+        with inotify.test_support.temp_path() as path:
+            i = inotify.adapters.Inotify()
+            i.add_watch(path, inotify.constants.IN_CREATE)
 
-            with open(os.path.join(path2, 'seen_new_file3'), 'w'):
-                pass
+            for name in ('file1', 'file2', 'file3'):
+                with open(os.path.join(path, name), 'w'):
+                    pass
 
-            os.remove(os.path.join(path, 'seen_new_file1'))
-            os.remove(os.path.join(path1, 'seen_new_file2'))
-            os.remove(os.path.join(path2, 'seen_new_file3'))
+            fd = i._Inotify__inotify_fd
+            g = i._handle_inotify_event(fd)
+            self.assertEquals(next(g)[3], 'file1')
+            g.close()
 
-            os.rmdir(path1)
-            os.rmdir(path2)
+            events = list(i._handle_inotify_event(fd))
 
-            events = self.__read_all_events(i)
+            expected = [
+                (inotify.adapters._INOTIFY_EVENT(wd=1, mask=256, cookie=0, len=16), ('IN_CREATE',), path, 'file2'),
+                (inotify.adapters._INOTIFY_EVENT(wd=1, mask=256, cookie=0, len=16), ('IN_CREATE',), path, 'file3'),
+            ]
 
-            if self._HAS_DIRECTORY_ACCESS_EVENTS:
-                expected = [
-                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741856, cookie=0, len=0), ['IN_OPEN', 'IN_ISDIR'], path, ''),
-                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741825, cookie=0, len=0), ['IN_ACCESS', 'IN_ISDIR'], path, ''),
-                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741840, cookie=0, len=0), ['IN_CLOSE_NOWRITE', 'IN_ISDIR'], path, ''),
-                ]
-                _access_dir_a = [
-                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741856, cookie=0, len=16), ['IN_OPEN', 'IN_ISDIR'], path, 'aa'),
-                    (inotify.adapters._INOTIFY_EVENT(wd=w2, mask=1073741856, cookie=0, len=0), ['IN_OPEN', 'IN_ISDIR'], path1, ''),
-                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741825, cookie=0, len=16), ['IN_ACCESS', 'IN_ISDIR'], path, 'aa'),
-                    (inotify.adapters._INOTIFY_EVENT(wd=w2, mask=1073741825, cookie=0, len=0), ['IN_ACCESS', 'IN_ISDIR'], path1, ''),
-                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741825, cookie=0, len=16), ['IN_ACCESS', 'IN_ISDIR'], path, 'aa'),
-                    (inotify.adapters._INOTIFY_EVENT(wd=w2, mask=1073741825, cookie=0, len=0), ['IN_ACCESS', 'IN_ISDIR'], path1, ''),
-                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741840, cookie=0, len=16), ['IN_CLOSE_NOWRITE', 'IN_ISDIR'], path, 'aa'),
-                    (inotify.adapters._INOTIFY_EVENT(wd=w2, mask=1073741840, cookie=0, len=0), ['IN_CLOSE_NOWRITE', 'IN_ISDIR'], path1, ''),
-                ]
-                _access_dir_b = [
-                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741856, cookie=0, len=16), ['IN_OPEN', 'IN_ISDIR'], path, 'bb'),
-                    (inotify.adapters._INOTIFY_EVENT(wd=w3, mask=1073741856, cookie=0, len=0), ['IN_OPEN', 'IN_ISDIR'], path2, ''),
-                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741825, cookie=0, len=16), ['IN_ACCESS', 'IN_ISDIR'], path, 'bb'),
-                    (inotify.adapters._INOTIFY_EVENT(wd=w3, mask=1073741825, cookie=0, len=0), ['IN_ACCESS', 'IN_ISDIR'], path2, ''),
-                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741825, cookie=0, len=16), ['IN_ACCESS', 'IN_ISDIR'], path, 'bb'),
-                    (inotify.adapters._INOTIFY_EVENT(wd=w3, mask=1073741825, cookie=0, len=0), ['IN_ACCESS', 'IN_ISDIR'], path2, ''),
-                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741840, cookie=0, len=16), ['IN_CLOSE_NOWRITE', 'IN_ISDIR'], path, 'bb'),
-                    (inotify.adapters._INOTIFY_EVENT(wd=w3, mask=1073741840, cookie=0, len=0), ['IN_CLOSE_NOWRITE', 'IN_ISDIR'], path2, ''),
-                ]
-            else:
-                expected = [
-                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741856, cookie=0, len=0), ['IN_OPEN', 'IN_ISDIR'], path, ''),
-                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741840, cookie=0, len=0), ['IN_CLOSE_NOWRITE', 'IN_ISDIR'], path, ''),
-                ]
-                _access_dir_a = [
-                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741856, cookie=0, len=16), ['IN_OPEN', 'IN_ISDIR'], path, 'aa'),
-                    (inotify.adapters._INOTIFY_EVENT(wd=w2, mask=1073741856, cookie=0, len=0), ['IN_OPEN', 'IN_ISDIR'], path1, ''),
-                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741840, cookie=0, len=16), ['IN_CLOSE_NOWRITE', 'IN_ISDIR'], path, 'aa'),
-                    (inotify.adapters._INOTIFY_EVENT(wd=w2, mask=1073741840, cookie=0, len=0), ['IN_CLOSE_NOWRITE', 'IN_ISDIR'], path1, ''),
-                ]
-                _access_dir_b = [
-                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741856, cookie=0, len=16), ['IN_OPEN', 'IN_ISDIR'], path, 'bb'),
-                    (inotify.adapters._INOTIFY_EVENT(wd=w3, mask=1073741856, cookie=0, len=0), ['IN_OPEN', 'IN_ISDIR'], path2, ''),
-                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741840, cookie=0, len=16), ['IN_CLOSE_NOWRITE', 'IN_ISDIR'], path, 'bb'),
-                    (inotify.adapters._INOTIFY_EVENT(wd=w3, mask=1073741840, cookie=0, len=0), ['IN_CLOSE_NOWRITE', 'IN_ISDIR'], path2, ''),
-                ]
+            self.assertEquals(events, expected)
 
-            # we can't be sure about the order the watches were registered
-            expected += (_access_dir_a + _access_dir_b if w2 < w3 
-                        else _access_dir_b + _access_dir_a)
+    def test__read_batch(self):
+        with inotify.test_support.temp_path() as path:
+            i = inotify.adapters.Inotify()
+            i.add_watch(path)
 
-            expected += [
-                (inotify.adapters._INOTIFY_EVENT(wd=1, mask=256, cookie=0, len=16), ['IN_CREATE'], path, 'seen_new_file1'),
-                (inotify.adapters._INOTIFY_EVENT(wd=1, mask=32, cookie=0, len=16), ['IN_OPEN'], path, 'seen_new_file1'),
-                (inotify.adapters._INOTIFY_EVENT(wd=1, mask=8, cookie=0, len=16), ['IN_CLOSE_WRITE'], path, 'seen_new_file1'),
+            with open(os.path.join(path, 'seen_new_file'), 'w'):
+                pass
 
-                (inotify.adapters._INOTIFY_EVENT(wd=w2, mask=256, cookie=0, len=16), ['IN_CREATE'], path1, 'seen_new_file2'),
-                (inotify.adapters._INOTIFY_EVENT(wd=w2, mask=32, cookie=0, len=16), ['IN_OPEN'], path1, 'seen_new_file2'),
-                (inotify.adapters._INOTIFY_EVENT(wd=w2, mask=8, cookie=0, len=16), ['IN_CLOSE_WRITE'], path1, 'seen_new_file2'),
+            os.remove(os.path.join(path, 'seen_new_file'))
 
-                (inotify.adapters._INOTIFY_EVENT(wd=w3, mask=256, cookie=0, len=16), ['IN_CREATE'], path2, 'seen_new_file3'),
-                (inotify.adapters._INOTIFY_EVENT(wd=w3, mask=32, cookie=0, len=16), ['IN_OPEN'], path2, 'seen_new_file3'),
-                (inotify.adapters._INOTIFY_EVENT(wd=w3, mask=8, cookie=0, len=16), ['IN_CLOSE_WRITE'], path2, 'seen_new_file3'),
+            batch = i.read_batch(timeout_s=1, mask=inotify.constants.IN_CREATE | inotify.constants.IN_DELETE)
 
-                (inotify.adapters._INOTIFY_EVENT(wd=1, mask=512, cookie=0, len=16), ['IN_DELETE'], path, 'seen_new_file1'),
-                (inotify.adapters._INOTIFY_EVENT(wd=w2, mask=512, cookie=0, len=16), ['IN_DELETE'], path1, 'seen_new_file2'),
-                (inotify.adapters._INOTIFY_EVENT(wd=w3, mask=512, cookie=0, len=16), ['IN_DELETE'], path2, 'seen_new_file3'),
+            expected = [
+                (inotify.adapters._INOTIFY_EVENT(wd=1, mask=256, cookie=0, len=16), ('IN_CREATE',), path, 'seen_new_file'),
+                (inotify.adapters._INOTIFY_EVENT(wd=1, mask=512, cookie=0, len=16), ('IN_DELETE',), path, 'seen_new_file'),
             ]
 
-            if self._HAS_STRONG_PARENT_AFTER_CHILD:
-                expected += [
-                    (inotify.adapters._INOTIFY_EVENT(wd=w2, mask=1024, cookie=0, len=0), ['IN_DELETE_SELF'], path1, ''),
-                    (inotify.adapters._INOTIFY_EVENT(wd=w2, mask=32768, cookie=0, len=0), ['IN_IGNORED'], path1, ''),
-                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073742336, cookie=0, len=16), ['IN_DELETE', 'IN_ISDIR'], path, 'aa'),
+            self.assertEquals(batch, expected)
+            self.assertEquals(i.read_batch(timeout_s=0), [])
 
-                    (inotify.adapters._INOTIFY_EVENT(wd=w3, mask=1024, cookie=0, len=0), ['IN_DELETE_SELF'], path2, ''),
-                    (inotify.adapters._INOTIFY_EVENT(wd=w3, mask=32768, cookie=0, len=0), ['IN_IGNORED'], path2, ''),
-                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073742336, cookie=0, len=16), ['IN_DELETE', 'IN_ISDIR'], path, 'bb'),
-                ]
-            else:
-                expected += [
-                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073742336, cookie=0, len=16), ['IN_DELETE', 'IN_ISDIR'], path, 'aa'),
-                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073742336, cookie=0, len=16), ['IN_DELETE', 'IN_ISDIR'], path, 'bb'),
-                    (inotify.adapters._INOTIFY_EVENT(wd=w2, mask=1024, cookie=0, len=0), ['IN_DELETE_SELF'], path1, ''),
-                    (inotify.adapters._INOTIFY_EVENT(wd=w2, mask=32768, cookie=0, len=0), ['IN_IGNORED'], path1, ''),
+    def test__read_events(self):
+        with inotify.test_support.temp_path() as path:
+            i = inotify.adapters.Inotify()
+            i.add_watch(path, inotify.constants.IN_CREATE)
 
-                    (inotify.adapters._INOTIFY_EVENT(wd=w3, mask=1024, cookie=0, len=0), ['IN_DELETE_SELF'], path2, ''),
-                    (inotify.adapters._INOTIFY_EVENT(wd=w3, mask=32768, cookie=0, len=0), ['IN_IGNORED'], path2, ''),
-                ]
+            self.assertFalse(i.poll(0))
 
-            self.assertEquals(events, expected)
+            # Nothing is there, so we wait (but only until the deadline).
+            start_s = time.time()
+            self.assertEquals(i.read_events(timeout_s=0.1), [])
+            self.assertTrue(time.time() - start_s >= 0.1)
 
-    def test__renames(self):
+            for name in ('file1', 'file2', 'file3'):
+                with open(os.path.join(path, name), 'w'):
+                    pass
 
-        # Since we're not reading the events one at a time in a loop and
-        # removing or renaming folders will flush any queued events, we have to
-        # group things in order to check things first before such operations.
+            self.assertTrue(i.poll(1))
+
+            # Queued events are returned without waiting; the rest is kept.
+            batch = i.read_events(max_events=2, timeout_s=0)
+            self.assertEquals([filename for (_, _, _, filename) in batch], ['file1', 'file2'])
+
+            self.assertTrue(i.poll(0))
 
+            batch = i.read_events(timeout_s=0)
+            self.assertEquals([filename for (_, _, _, filename) in batch], ['file3'])
+
+            self.assertFalse(i.poll(0))
+            self.assertEquals(i.read_events(timeout_s=0), [])
+
+    def test__read_events_terminal_event(self):
         with inotify.test_support.temp_path() as path:
-            i = inotify.adapters.InotifyTree(path)
+            i = inotify.adapters.Inotify()
+            i.add_watch(path, inotify.constants.IN_CREATE | inotify.constants.IN_DELETE)
 
-            old_path = os.path.join(path, 'old_folder')
-            new_path = os.path.join(path, 'new_folder')
+            for name in ('file1', 'file2', 'file3'):
+                with open(os.path.join(path, name), 'w'):
+                    pass
 
-            os.mkdir(old_path)
+            os.remove(os.path.join(path, 'file1'))
 
-            events1 = self.__read_all_events(i)
+            # The events that are held back are still delivered before the
+            # terminal one.
+            filenames = []
+            for _ in range(3):
+                batch = i.read_events(max_events=1, timeout_s=1, terminal_events=('IN_DELETE',))
+                filenames.extend(filename for (_, _, _, filename) in batch)
 
-            if self._HAS_DIRECTORY_ACCESS_EVENTS:
-                expected = [
-                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741856, cookie=0, len=0), ['IN_OPEN', 'IN_ISDIR'], path, ''),
-                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741825, cookie=0, len=0), ['IN_ACCESS', 'IN_ISDIR'], path, ''),
-                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741840, cookie=0, len=0), ['IN_CLOSE_NOWRITE', 'IN_ISDIR'], path, ''),
-                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073742080, cookie=0, len=16), ['IN_CREATE', 'IN_ISDIR'], path, 'old_folder'),
-                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741856, cookie=0, len=16), ['IN_OPEN', 'IN_ISDIR'], path, 'old_folder'),
-                    (inotify.adapters._INOTIFY_EVENT(wd=2, mask=1073741856, cookie=0, len=0), ['IN_OPEN', 'IN_ISDIR'], old_path, ''),
-                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741825, cookie=0, len=16), ['IN_ACCESS', 'IN_ISDIR'], path, 'old_folder'),
-                    (inotify.adapters._INOTIFY_EVENT(wd=2, mask=1073741825, cookie=0, len=0), ['IN_ACCESS', 'IN_ISDIR'], old_path, ''),
-                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741825, cookie=0, len=16), ['IN_ACCESS', 'IN_ISDIR'], path, 'old_folder'),
-                    (inotify.adapters._INOTIFY_EVENT(wd=2, mask=1073741825, cookie=0, len=0), ['IN_ACCESS', 'IN_ISDIR'], old_path, ''),
-                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741840, cookie=0, len=16), ['IN_CLOSE_NOWRITE', 'IN_ISDIR'], path, 'old_folder'),
-                    (inotify.adapters._INOTIFY_EVENT(wd=2, mask=1073741840, cookie=0, len=0), ['IN_CLOSE_NOWRITE', 'IN_ISDIR'], old_path, ''),
-                ]
-            else:
-                expected = [
-                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741856, cookie=0, len=0), ['IN_OPEN', 'IN_ISDIR'], path, ''),
-                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741840, cookie=0, len=0), ['IN_CLOSE_NOWRITE', 'IN_ISDIR'], path, ''),
-                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073742080, cookie=0, len=16), ['IN_CREATE', 'IN_ISDIR'], path, 'old_folder'),
-                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741856, cookie=0, len=16), ['IN_OPEN', 'IN_ISDIR'], path, 'old_folder'),
-                    (inotify.adapters._INOTIFY_EVENT(wd=2, mask=1073741856, cookie=0, len=0), ['IN_OPEN', 'IN_ISDIR'], old_path, ''),
-                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741840, cookie=0, len=16), ['IN_CLOSE_NOWRITE', 'IN_ISDIR'], path, 'old_folder'),
-                    (inotify.adapters._INOTIFY_EVENT(wd=2, mask=1073741840, cookie=0, len=0), ['IN_CLOSE_NOWRITE', 'IN_ISDIR'], old_path, ''),
-                ]
+            self.assertEquals(filenames, ['file1', 'file2', 'file3'])
 
-            self.assertEquals(events1, expected)
+            with self.assertRaises(inotify.adapters.TerminalEventException) as cm:
+                i.read_events(timeout_s=0, terminal_events=('IN_DELETE',))
 
+            self.assertEquals(cm.exception.event[3], 'file1')
 
-            os.rename(old_path, new_path)
+    def test__overflow_stats(self):
+        i = inotify.adapters.Inotify()
+        i._Inotify__watch_table.add('/some/watched/path', 1)
 
-            events2 = self.__read_all_events(i)
+        filename = b'seen_new_file'.ljust(16, b'\0')
+        events = struct.pack(inotify.adapters._HEADER_STRUCT_FORMAT,
+                             1, inotify.constants.IN_CREATE, 0, len(filename)) + filename + \
+                 struct.pack(inotify.adapters._HEADER_STRUCT_FORMAT,
+                             -1, inotify.constants.IN_Q_OVERFLOW, 0, 0)
 
-            if self._HAS_DIRECTORY_ACCESS_EVENTS:
-                expected = [
-                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741888, cookie=events2[1][0].cookie, len=16), ['IN_MOVED_FROM', 'IN_ISDIR'], path, 'old_folder'),
-                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741952, cookie=events2[0][0].cookie, len=16), ['IN_MOVED_TO', 'IN_ISDIR'], path, 'new_folder'),
-                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741856, cookie=0, len=16), ['IN_OPEN', 'IN_ISDIR'], path, 'new_folder'),
-                    (inotify.adapters._INOTIFY_EVENT(wd=3, mask=1073741856, cookie=0, len=0), ['IN_OPEN', 'IN_ISDIR'], new_path, ''),
-                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741825, cookie=0, len=16), ['IN_ACCESS', 'IN_ISDIR'], path, 'new_folder'),
-                    (inotify.adapters._INOTIFY_EVENT(wd=3, mask=1073741825, cookie=0, len=0), ['IN_ACCESS', 'IN_ISDIR'], new_path, ''),
-                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741825, cookie=0, len=16), ['IN_ACCESS', 'IN_ISDIR'], path, 'new_folder'),
-                    (inotify.adapters._INOTIFY_EVENT(wd=3, mask=1073741825, cookie=0, len=0), ['IN_ACCESS', 'IN_ISDIR'], new_path, ''),
-                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741840, cookie=0, len=16), ['IN_CLOSE_NOWRITE', 'IN_ISDIR'], path, 'new_folder'),
-                    (inotify.adapters._INOTIFY_EVENT(wd=3, mask=1073741840, cookie=0, len=0), ['IN_CLOSE_NOWRITE', 'IN_ISDIR'], new_path, ''),
-                ]
-            else:
-                expected = [
-                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741888, cookie=events2[1][0].cookie, len=16), ['IN_MOVED_FROM', 'IN_ISDIR'], path, 'old_folder'),
-                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741952, cookie=events2[0][0].cookie, len=16), ['IN_MOVED_TO', 'IN_ISDIR'], path, 'new_folder'),
-                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741856, cookie=0, len=16), ['IN_OPEN', 'IN_ISDIR'], path, 'new_folder'),
-                    (inotify.adapters._INOTIFY_EVENT(wd=3, mask=1073741856, cookie=0, len=0), ['IN_OPEN', 'IN_ISDIR'], new_path, ''),
-                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741840, cookie=0, len=16), ['IN_CLOSE_NOWRITE', 'IN_ISDIR'], path, 'new_folder'),
-                    (inotify.adapters._INOTIFY_EVENT(wd=3, mask=1073741840, cookie=0, len=0), ['IN_CLOSE_NOWRITE', 'IN_ISDIR'], new_path, ''),
-                ]
+        (read_fd, write_fd) = os.pipe()
+        fcntl.fcntl(read_fd, fcntl.F_SETFL, fcntl.fcntl(read_fd, fcntl.F_GETFL) | os.O_NONBLOCK)
 
-            self.assertEquals(events2, expected)
+        try:
+            os.write(write_fd, events)
+            i._handle_inotify_event(read_fd)
+        finally:
+            os.close(read_fd)
+            os.close(write_fd)
 
+        # The overflow is put back and raised on the next call.
+        batch = i._take_batch()
+        self.assertEquals([filename for (_, _, _, filename) in batch], ['seen_new_file'])
 
-            with open(os.path.join(new_path, 'old_filename'), 'w'):
-                pass
+        with self.assertRaises(inotify.adapters.TerminalEventException):
+            i._take_batch()
 
-            os.rename(
-                os.path.join(new_path, 'old_filename'),
-                os.path.join(new_path, 'new_filename'))
+        self.assertEquals(i.shard_stats[0]['overflows'], 1)
 
-            os.remove(os.path.join(path, 'new_folder', 'new_filename'))
-            os.rmdir(os.path.join(path, 'new_folder'))
+    def test__read_batch_terminal_event(self):
+        with inotify.test_support.temp_path() as path:
+            i = inotify.adapters.Inotify()
+            i.add_watch(path, inotify.constants.IN_CREATE | inotify.constants.IN_DELETE)
 
-            events3 = self.__read_all_events(i)
+            with open(os.path.join(path, 'seen_new_file'), 'w'):
+                pass
 
-            expected = [
-                (inotify.adapters._INOTIFY_EVENT(wd=3, mask=256, cookie=0, len=16), ['IN_CREATE'], new_path, 'old_filename'),
-                (inotify.adapters._INOTIFY_EVENT(wd=3, mask=32, cookie=0, len=16), ['IN_OPEN'], new_path, 'old_filename'),
-                (inotify.adapters._INOTIFY_EVENT(wd=3, mask=8, cookie=0, len=16), ['IN_CLOSE_WRITE'], new_path, 'old_filename'),
+            os.remove(os.path.join(path, 'seen_new_file'))
 
-                (inotify.adapters._INOTIFY_EVENT(wd=3, mask=64, cookie=events3[3][0].cookie, len=16), ['IN_MOVED_FROM'], new_path, 'old_filename'),
-                (inotify.adapters._INOTIFY_EVENT(wd=3, mask=128, cookie=events3[4][0].cookie, len=16), ['IN_MOVED_TO'], new_path, 'new_filename'),
+            # The events before the terminal one are delivered first.
+            batch = i.read_batch(timeout_s=1, terminal_events=('IN_DELETE',))
 
-                (inotify.adapters._INOTIFY_EVENT(wd=3, mask=512, cookie=0, len=16), ['IN_DELETE'], new_path, 'new_filename'),
+            expected = [
+                (inotify.adapters._INOTIFY_EVENT(wd=1, mask=256, cookie=0, len=16), ('IN_CREATE',), path, 'seen_new_file'),
             ]
 
-            if self._HAS_STRONG_PARENT_AFTER_CHILD:
-                expected += [
-                    (inotify.adapters._INOTIFY_EVENT(wd=3, mask=1024, cookie=0, len=0), ['IN_DELETE_SELF'], new_path, ''),
-                    (inotify.adapters._INOTIFY_EVENT(wd=3, mask=32768, cookie=0, len=0), ['IN_IGNORED'], new_path, ''),
-                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073742336, cookie=0, len=16), ['IN_DELETE', 'IN_ISDIR'], path, 'new_folder'),
-                ]
-            else:
-                expected += [
-                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073742336, cookie=0, len=16), ['IN_DELETE', 'IN_ISDIR'], path, 'new_folder'),
-                    (inotify.adapters._INOTIFY_EVENT(wd=3, mask=1024, cookie=0, len=0), ['IN_DELETE_SELF'], new_path, ''),
-                    (inotify.adapters._INOTIFY_EVENT(wd=3, mask=32768, cookie=0, len=0), ['IN_IGNORED'], new_path, ''),
-                ]
-
-            self.assertEquals(events3, expected)
+            self.assertEquals(batch, expected)
 
-    def test__automatic_new_watches_on_new_paths(self):
+            with self.assertRaises(inotify.adapters.TerminalEventException) as cm:
+                i.read_batch(timeout_s=0, terminal_events=('IN_DELETE',))
 
-        # Tests that watches are actively established as new folders are
-        # created.
+            self.assertEquals(cm.exception.event[3], 'seen_new_file')
 
+    def test__event_gen_batches(self):
         with inotify.test_support.temp_path() as path:
-            i = inotify.adapters.InotifyTree(path)
-
-            path1 = os.path.join(path, 'folder1')
-            path2 = os.path.join(path1, 'folder2')
+            i = inotify.adapters.Inotify()
+            i.add_watch(path, inotify.constants.IN_CREATE)
 
-            os.mkdir(path1)
+            for name in ('file1', 'file2'):
+                with open(os.path.join(path, name), 'w'):
+                    pass
 
-            events = self.__read_all_events(i)
+            batches = list(i.event_gen_batches(timeout_s=1, yield_nones=False))
 
-            if self._HAS_DIRECTORY_ACCESS_EVENTS:
-                expected = [
-                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741856, cookie=0, len=0), ['IN_OPEN', 'IN_ISDIR'], path, ''),
-                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741825, cookie=0, len=0), ['IN_ACCESS', 'IN_ISDIR'], path, ''),
-                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741840, cookie=0, len=0), ['IN_CLOSE_NOWRITE', 'IN_ISDIR'], path, ''),
-                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073742080, cookie=0, len=16), ['IN_CREATE', 'IN_ISDIR'], path, 'folder1'),
-                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741856, cookie=0, len=16), ['IN_OPEN', 'IN_ISDIR'], path, 'folder1'),
-                    (inotify.adapters._INOTIFY_EVENT(wd=2, mask=1073741856, cookie=0, len=0), ['IN_OPEN', 'IN_ISDIR'], path1, ''),
-                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741825, cookie=0, len=16), ['IN_ACCESS', 'IN_ISDIR'], path, 'folder1'),
-                    (inotify.adapters._INOTIFY_EVENT(wd=2, mask=1073741825, cookie=0, len=0), ['IN_ACCESS', 'IN_ISDIR'], path1, ''),
-                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741825, cookie=0, len=16), ['IN_ACCESS', 'IN_ISDIR'], path, 'folder1'),
-                    (inotify.adapters._INOTIFY_EVENT(wd=2, mask=1073741825, cookie=0, len=0), ['IN_ACCESS', 'IN_ISDIR'], path1, ''),
-                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741840, cookie=0, len=16), ['IN_CLOSE_NOWRITE', 'IN_ISDIR'], path, 'folder1'),
-                    (inotify.adapters._INOTIFY_EVENT(wd=2, mask=1073741840, cookie=0, len=0), ['IN_CLOSE_NOWRITE', 'IN_ISDIR'], path1, ''),
-                ]
-            else:
-                expected = [
-                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741856, cookie=0, len=0), ['IN_OPEN', 'IN_ISDIR'], path, ''),
-                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741840, cookie=0, len=0), ['IN_CLOSE_NOWRITE', 'IN_ISDIR'], path, ''),
-                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073742080, cookie=0, len=16), ['IN_CREATE', 'IN_ISDIR'], path, 'folder1'),
-                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741856, cookie=0, len=16), ['IN_OPEN', 'IN_ISDIR'], path, 'folder1'),
-                    (inotify.adapters._INOTIFY_EVENT(wd=2, mask=1073741856, cookie=0, len=0), ['IN_OPEN', 'IN_ISDIR'], path1, ''),
-                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741840, cookie=0, len=16), ['IN_CLOSE_NOWRITE', 'IN_ISDIR'], path, 'folder1'),
-                    (inotify.adapters._INOTIFY_EVENT(wd=2, mask=1073741840, cookie=0, len=0), ['IN_CLOSE_NOWRITE', 'IN_ISDIR'], path1, ''),
-                ]
+            expected = [[
+                (inotify.adapters._INOTIFY_EVENT(wd=1, mask=256, cookie=0, len=16), ('IN_CREATE',), path, 'file1'),
+                (inotify.adapters._INOTIFY_EVENT(wd=1, mask=256, cookie=0, len=16), ('IN_CREATE',), path, 'file2'),
+            ]]
 
-            self.assertEquals(events, expected)
+            self.assertEquals(batches, expected)
 
+    def test__compact_events(self):
+        with inotify.test_support.temp_path() as path:
+            i = inotify.adapters.Inotify(compact_events=True)
+            i.add_watch(path)
 
-            os.mkdir(path2)
+            with open(os.path.join(path, 'seen_new_file'), 'w'):
+                pass
 
             events = self.__read_all_events(i)
 
-            if self._HAS_DIRECTORY_ACCESS_EVENTS:
-                expected = [
-                    (inotify.adapters._INOTIFY_EVENT(wd=2, mask=1073742080, cookie=0, len=16), ['IN_CREATE', 'IN_ISDIR'], path1, 'folder2'),
-                    (inotify.adapters._INOTIFY_EVENT(wd=2, mask=1073741856, cookie=0, len=16), ['IN_OPEN', 'IN_ISDIR'], path1, 'folder2'),
-                    (inotify.adapters._INOTIFY_EVENT(wd=3, mask=1073741856, cookie=0, len=0), ['IN_OPEN', 'IN_ISDIR'], path2, ''),
-                    (inotify.adapters._INOTIFY_EVENT(wd=2, mask=1073741825, cookie=0, len=16), ['IN_ACCESS', 'IN_ISDIR'], path1, 'folder2'),
-                    (inotify.adapters._INOTIFY_EVENT(wd=3, mask=1073741825, cookie=0, len=0), ['IN_ACCESS', 'IN_ISDIR'], path2, ''),
-                    (inotify.adapters._INOTIFY_EVENT(wd=2, mask=1073741825, cookie=0, len=16), ['IN_ACCESS', 'IN_ISDIR'], path1, 'folder2'),
-                    (inotify.adapters._INOTIFY_EVENT(wd=3, mask=1073741825, cookie=0, len=0), ['IN_ACCESS', 'IN_ISDIR'], path2, ''),
-                    (inotify.adapters._INOTIFY_EVENT(wd=2, mask=1073741840, cookie=0, len=16), ['IN_CLOSE_NOWRITE', 'IN_ISDIR'], path1, 'folder2'),
-                    (inotify.adapters._INOTIFY_EVENT(wd=3, mask=1073741840, cookie=0, len=0), ['IN_CLOSE_NOWRITE', 'IN_ISDIR'], path2, ''),
-                ]
-            else:
-                expected = [
-                    (inotify.adapters._INOTIFY_EVENT(wd=2, mask=1073742080, cookie=0, len=16), ['IN_CREATE', 'IN_ISDIR'], path1, 'folder2'),
-                    (inotify.adapters._INOTIFY_EVENT(wd=2, mask=1073741856, cookie=0, len=16), ['IN_OPEN', 'IN_ISDIR'], path1, 'folder2'),
-                    (inotify.adapters._INOTIFY_EVENT(wd=3, mask=1073741856, cookie=0, len=0), ['IN_OPEN', 'IN_ISDIR'], path2, ''),
-                    (inotify.adapters._INOTIFY_EVENT(wd=2, mask=1073741840, cookie=0, len=16), ['IN_CLOSE_NOWRITE', 'IN_ISDIR'], path1, 'folder2'),
-                    (inotify.adapters._INOTIFY_EVENT(wd=3, mask=1073741840, cookie=0, len=0), ['IN_CLOSE_NOWRITE', 'IN_ISDIR'], path2, ''),
-                ]
+            expected = [
+                (inotify.adapters._INOTIFY_EVENT(wd=1, mask=256, cookie=0, len=16), ('IN_CREATE',), path, 'seen_new_file'),
+                (inotify.adapters._INOTIFY_EVENT(wd=1, mask=32, cookie=0, len=16), ('IN_OPEN',), path, 'seen_new_file'),
+                (inotify.adapters._INOTIFY_EVENT(wd=1, mask=8, cookie=0, len=16), ('IN_CLOSE_WRITE',), path, 'seen_new_file'),
+            ]
 
             self.assertEquals(events, expected)
 
+            e = events[0]
+            self.assertTrue(isinstance(e, inotify.adapters.InotifyEvent))
+            self.assertEquals(e.mask, inotify.constants.IN_CREATE)
+            self.assertEquals(e.filename_bytes, b'seen_new_file')
+            self.assertEquals(e.full_path, os.path.join(path, 'seen_new_file'))
 
-            with open(os.path.join(path2,'filename'), 'w'):
+            (header, type_names, event_path, filename) = e
+            self.assertEquals(header.wd, 1)
+            self.assertEquals(type_names, ('IN_CREATE',))
+            self.assertEquals(event_path, path)
+            self.assertEquals(filename, 'seen_new_file')
+
+            # Nothing is decoded before it's asked for.
+            with open(os.path.join(path, 'seen_new_file'), 'w'):
                 pass
 
-            events = self.__read_all_events(i)
+            e = self.__read_all_events(i)[0]
+            self.assertEquals(e.mask, inotify.constants.IN_OPEN)
+            self.assertTrue(e._header is None)
+            self.assertTrue(e._type_names is None)
+            self.assertTrue(e._filename is None)
 
-            expected = [
-                (inotify.adapters._INOTIFY_EVENT(wd=3, mask=256, cookie=0, len=16), ['IN_CREATE'], path2, 'filename'),
-                (inotify.adapters._INOTIFY_EVENT(wd=3, mask=32, cookie=0, len=16), ['IN_OPEN'], path2, 'filename'),
-                (inotify.adapters._INOTIFY_EVENT(wd=3, mask=8, cookie=0, len=16), ['IN_CLOSE_WRITE'], path2, 'filename'),
-            ]
+            # ..and indexing only decodes the item that it's asked for.
+            self.assertEquals(e[3], 'seen_new_file')
+            self.assertEquals(e[-2], path)
+            self.assertTrue(e._header is None)
+            self.assertTrue(e._type_names is None)
 
-            self.assertEquals(events, expected)
+            self.assertEquals(e[0].wd, 1)
+            self.assertEquals(e[1:3], (('IN_OPEN',), path))
 
-    def test__automatic_new_watches_on_existing_paths(self):
+            with self.assertRaises(IndexError):
+                e[4]
 
-        # Tests whether the watches are recursively established when we
-        # initialize.
+    def __get_kernel_masks(self, i):
+        masks = {}
+        with open('/proc/self/fdinfo/%d' % i.fileno()) as f:
+            for line in f:
+                if line.startswith('inotify '):
+                    fields = dict(field.split(':', 1) for field in line.split()[1:])
+                    masks[int(fields['wd'])] = int(fields['mask'], 16)
+
+        return masks
 
+    def test__consumer_masks(self):
         with inotify.test_support.temp_path() as path:
-            path1 = os.path.join(path, 'folder1')
-            path2 = os.path.join(path1, 'folder2')
+            file_path = os.path.join(path, 'seen_file')
+            with open(file_path, 'w') as f:
+                f.write('x')
 
-            os.mkdir(path1)
-            os.mkdir(path2)
+            i = inotify.adapters.Inotify()
+            i.add_watch(path)
 
-            i = inotify.adapters.InotifyTree(path)
+            self.assertEquals(i.consumer_mask, None)
+            self.assertEquals(self.__get_kernel_masks(i),
+                              { 1: inotify.constants.IN_ALL_EVENTS_WATCH })
 
-            with open(os.path.join(path2,'filename'), 'w'):
+            handle = i.add_consumer(inotify.constants.IN_CLOSE_WRITE)
+
+            self.assertEquals(i.consumer_mask, inotify.constants.IN_CLOSE_WRITE)
+            self.assertEquals(self.__get_kernel_masks(i),
+                              { 1: inotify.constants.IN_CLOSE_WRITE })
+
+            # Not even generated.
+            with open(file_path) as f:
+                f.read()
+
+            self.assertEquals(self.__read_all_events(i), [])
+
+            with open(file_path, 'w'):
                 pass
 
-            events = self.__read_all_events(i)
+            names = [type_names for (_, type_names, _, _) in self.__read_all_events(i)]
+            self.assertEquals(names, [('IN_CLOSE_WRITE',)])
 
-            if self._HAS_DIRECTORY_ACCESS_EVENTS:
-                expected = [
-                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741856, cookie=0, len=0), ['IN_OPEN', 'IN_ISDIR'], path, ''),
-                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741825, cookie=0, len=0), ['IN_ACCESS', 'IN_ISDIR'], path, ''),
-                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741840, cookie=0, len=0), ['IN_CLOSE_NOWRITE', 'IN_ISDIR'], path, ''),
-                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741856, cookie=0, len=16), ['IN_OPEN', 'IN_ISDIR'], path, 'folder1'),
-                    (inotify.adapters._INOTIFY_EVENT(wd=2, mask=1073741856, cookie=0, len=0), ['IN_OPEN', 'IN_ISDIR'], path1, ''),
-                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741825, cookie=0, len=16), ['IN_ACCESS', 'IN_ISDIR'], path, 'folder1'),
-                    (inotify.adapters._INOTIFY_EVENT(wd=2, mask=1073741825, cookie=0, len=0), ['IN_ACCESS', 'IN_ISDIR'], path1, ''),
-                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741825, cookie=0, len=16), ['IN_ACCESS', 'IN_ISDIR'], path, 'folder1'),
-                    (inotify.adapters._INOTIFY_EVENT(wd=2, mask=1073741825, cookie=0, len=0), ['IN_ACCESS', 'IN_ISDIR'], path1, ''),
-                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741840, cookie=0, len=16), ['IN_CLOSE_NOWRITE', 'IN_ISDIR'], path, 'folder1'),
-                    (inotify.adapters._INOTIFY_EVENT(wd=2, mask=1073741840, cookie=0, len=0), ['IN_CLOSE_NOWRITE', 'IN_ISDIR'], path1, ''),
-                    (inotify.adapters._INOTIFY_EVENT(wd=2, mask=1073741856, cookie=0, len=16), ['IN_OPEN', 'IN_ISDIR'], path1, 'folder2'),
-                    (inotify.adapters._INOTIFY_EVENT(wd=3, mask=1073741856, cookie=0, len=0), ['IN_OPEN', 'IN_ISDIR'], path2, ''),
-                    (inotify.adapters._INOTIFY_EVENT(wd=2, mask=1073741825, cookie=0, len=16), ['IN_ACCESS', 'IN_ISDIR'], path1, 'folder2'),
-                    (inotify.adapters._INOTIFY_EVENT(wd=3, mask=1073741825, cookie=0, len=0), ['IN_ACCESS', 'IN_ISDIR'], path2, ''),
-                    (inotify.adapters._INOTIFY_EVENT(wd=2, mask=1073741825, cookie=0, len=16), ['IN_ACCESS', 'IN_ISDIR'], path1, 'folder2'),
-                    (inotify.adapters._INOTIFY_EVENT(wd=3, mask=1073741825, cookie=0, len=0), ['IN_ACCESS', 'IN_ISDIR'], path2, ''),
-                    (inotify.adapters._INOTIFY_EVENT(wd=2, mask=1073741840, cookie=0, len=16), ['IN_CLOSE_NOWRITE', 'IN_ISDIR'], path1, 'folder2'),
-                    (inotify.adapters._INOTIFY_EVENT(wd=3, mask=1073741840, cookie=0, len=0), ['IN_CLOSE_NOWRITE', 'IN_ISDIR'], path2, ''),
-                    (inotify.adapters._INOTIFY_EVENT(wd=3, mask=256, cookie=0, len=16), ['IN_CREATE'], path2, 'filename'),
-                    (inotify.adapters._INOTIFY_EVENT(wd=3, mask=32, cookie=0, len=16), ['IN_OPEN'], path2, 'filename'),
-                    (inotify.adapters._INOTIFY_EVENT(wd=3, mask=8, cookie=0, len=16), ['IN_CLOSE_WRITE'], path2, 'filename'),
-                ]
-            else:
-                expected = [
-                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741856, cookie=0, len=0), ['IN_OPEN', 'IN_ISDIR'], path, ''),
-                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741840, cookie=0, len=0), ['IN_CLOSE_NOWRITE', 'IN_ISDIR'], path, ''),
-                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741856, cookie=0, len=16), ['IN_OPEN', 'IN_ISDIR'], path, 'folder1'),
-                    (inotify.adapters._INOTIFY_EVENT(wd=2, mask=1073741856, cookie=0, len=0), ['IN_OPEN', 'IN_ISDIR'], path1, ''),
-                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741840, cookie=0, len=16), ['IN_CLOSE_NOWRITE', 'IN_ISDIR'], path, 'folder1'),
-                    (inotify.adapters._INOTIFY_EVENT(wd=2, mask=1073741840, cookie=0, len=0), ['IN_CLOSE_NOWRITE', 'IN_ISDIR'], path1, ''),
-                    (inotify.adapters._INOTIFY_EVENT(wd=2, mask=1073741856, cookie=0, len=16), ['IN_OPEN', 'IN_ISDIR'], path1, 'folder2'),
-                    (inotify.adapters._INOTIFY_EVENT(wd=3, mask=1073741856, cookie=0, len=0), ['IN_OPEN', 'IN_ISDIR'], path2, ''),
-                    (inotify.adapters._INOTIFY_EVENT(wd=2, mask=1073741840, cookie=0, len=16), ['IN_CLOSE_NOWRITE', 'IN_ISDIR'], path1, 'folder2'),
-                    (inotify.adapters._INOTIFY_EVENT(wd=3, mask=1073741840, cookie=0, len=0), ['IN_CLOSE_NOWRITE', 'IN_ISDIR'], path2, ''),
-                    (inotify.adapters._INOTIFY_EVENT(wd=3, mask=256, cookie=0, len=16), ['IN_CREATE'], path2, 'filename'),
-                    (inotify.adapters._INOTIFY_EVENT(wd=3, mask=32, cookie=0, len=16), ['IN_OPEN'], path2, 'filename'),
-                    (inotify.adapters._INOTIFY_EVENT(wd=3, mask=8, cookie=0, len=16), ['IN_CLOSE_WRITE'], path2, 'filename'),
-                ]
+            # The masks are restored once the last consumer goes.
+            i.remove_consumer(handle)
+            self.assertEquals(i.consumer_mask, None)
+            self.assertEquals(self.__get_kernel_masks(i),
+                              { 1: inotify.constants.IN_ALL_EVENTS_WATCH })
 
-            self.assertEquals(events, expected)
+            # ..and narrowed again for the next one.
+            handle = i.add_consumer(inotify.constants.IN_OPEN)
+            self.assertEquals(self.__get_kernel_masks(i),
+                              { 1: inotify.constants.IN_OPEN })
 
-    def test__exclude_subdirectories(self):
+            i.add_consumer(inotify.constants.IN_CLOSE_WRITE)
+            self.assertEquals(self.__get_kernel_masks(i),
+                              { 1: inotify.constants.IN_OPEN | inotify.constants.IN_CLOSE_WRITE })
 
-        # Tests whether the skip_dires parameter works as expected
+            # New watches get the narrowed mask, too.
+            path1 = os.path.join(path, 'aa')
+            os.mkdir(path1)
+            i.add_watch(path1, inotify.constants.IN_CREATE | inotify.constants.IN_OPEN)
+            self.assertEquals(self.__get_kernel_masks(i)[2], inotify.constants.IN_OPEN)
 
+    def test__push_masks(self):
         with inotify.test_support.temp_path() as path:
-            for foldernum1 in range(1,5):
-                path1 = os.path.join(path, 'folder%d' % foldernum1)
-                os.mkdir(path1)
-                for foldernum2 in range(1,5):
-                    path2 = os.path.join(path1, 'subfolder%d' % foldernum2)
-                    os.mkdir(path2)
-                    for foldernum3 in range(1,3):
-                        path3 = os.path.join(path2, 'subsubfolder%d' % foldernum3)
-                        os.mkdir(path3)
+            file_path = os.path.join(path, 'seen_file')
+            with open(file_path, 'w') as f:
+                f.write('x')
 
-            ignored_dirs = (os.path.join(path, 'folder1'),
-                            os.path.join(path, 'folder2', 'subfolder2'),
-                            os.path.join(path, 'folder2', 'subfolder3'),
-                            os.path.join(path, 'folder2', 'subfolder4', 'subsubfolder2'),
-                            os.path.join(path, 'folder3'),
-                            os.path.join(path, 'folder4'),
-            )
+            i = inotify.adapters.Inotify(push_masks=True, block_duration_s=0.1)
+            i.add_watch(path)
 
-            expected_watches = (path, os.path.join(path, 'folder2'),
-                                os.path.join(path, 'folder2', 'subfolder1'),
-                                os.path.join(path, 'folder2', 'subfolder1', 'subsubfolder1'),
-                                os.path.join(path, 'folder2', 'subfolder1', 'subsubfolder2'),
-                                os.path.join(path, 'folder2', 'subfolder4'),
-                                os.path.join(path, 'folder2', 'subfolder4', 'subsubfolder1'),
-            )
+            events = i.event_gen(mask=inotify.constants.IN_CLOSE_WRITE)
 
-            i = inotify.adapters.InotifyTree(path, ignored_dirs=ignored_dirs)
-            events = self.__read_all_events(i)
+            # We're a consumer once we've started.
+            self.assertEquals(next(events), None)
+            self.assertEquals(self.__get_kernel_masks(i),
+                              { 1: inotify.constants.IN_CLOSE_WRITE })
 
-            watches = i._i._Inotify__watches
-            self.assertEquals(sorted(watches.keys()), sorted(expected_watches))
+            events.close()
 
-            discovered_subdirs_expects = { path: [] }
+            # Anyone else gets everything again.
+            self.assertEquals(self.__get_kernel_masks(i),
+                              { 1: inotify.constants.IN_ALL_EVENTS_WATCH })
 
-            if self._HAS_DIRECTORY_ACCESS_EVENTS:
-                expected = [
-                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741856, cookie=0, len=0), ['IN_OPEN', 'IN_ISDIR'], path, ''),
-                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741825, cookie=0, len=0), ['IN_ACCESS', 'IN_ISDIR'], path, ''),
-                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741840, cookie=0, len=0), ['IN_CLOSE_NOWRITE', 'IN_ISDIR'], path, ''),
-                ]
-                for dirpath, dirwd in sorted(watches.items(), key=lambda tup: tup[1])[1:]:
-                    parentpath, dirname = os.path.split(dirpath)
-                    parentwd = watches[parentpath]
-                    expects = [
-                        (inotify.adapters._INOTIFY_EVENT(wd=parentwd, mask=1073741856, cookie=0, len=16), ['IN_OPEN', 'IN_ISDIR'], parentpath, dirname),
-                        (inotify.adapters._INOTIFY_EVENT(wd=dirwd, mask=1073741856, cookie=0, len=0), ['IN_OPEN', 'IN_ISDIR'], dirpath, ''),
-                        (inotify.adapters._INOTIFY_EVENT(wd=parentwd, mask=1073741825, cookie=0, len=16), ['IN_ACCESS', 'IN_ISDIR'], parentpath, dirname),
-                        (inotify.adapters._INOTIFY_EVENT(wd=dirwd, mask=1073741825, cookie=0, len=0), ['IN_ACCESS', 'IN_ISDIR'], dirpath, ''),
-                        (inotify.adapters._INOTIFY_EVENT(wd=parentwd, mask=1073741825, cookie=0, len=16), ['IN_ACCESS', 'IN_ISDIR'], parentpath, dirname),
-                        (inotify.adapters._INOTIFY_EVENT(wd=dirwd, mask=1073741825, cookie=0, len=0), ['IN_ACCESS', 'IN_ISDIR'], dirpath, ''),
-                        (inotify.adapters._INOTIFY_EVENT(wd=parentwd, mask=1073741840, cookie=0, len=16), ['IN_CLOSE_NOWRITE', 'IN_ISDIR'], parentpath, dirname),
-                        (inotify.adapters._INOTIFY_EVENT(wd=dirwd, mask=1073741840, cookie=0, len=0), ['IN_CLOSE_NOWRITE', 'IN_ISDIR'], dirpath, ''),
-                    ]
-                    discovered_subdirs_expects[parentpath].append((dirpath, expects))
-                    discovered_subdirs_expects[dirpath] = []
-            else:
-                expected = [
-                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741856, cookie=0, len=0), ['IN_OPEN', 'IN_ISDIR'], path, ''),
-                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741840, cookie=0, len=0), ['IN_CLOSE_NOWRITE', 'IN_ISDIR'], path, ''),
-                ]
-                for dirpath, dirwd in sorted(watches.items(), key=lambda tup: tup[1])[1:]:
-                    parentpath, dirname = os.path.split(dirpath)
-                    parentwd = watches[parentpath]
-                    expects = [
-                        (inotify.adapters._INOTIFY_EVENT(wd=parentwd, mask=1073741856, cookie=0, len=16), ['IN_OPEN', 'IN_ISDIR'], parentpath, dirname),
-                        (inotify.adapters._INOTIFY_EVENT(wd=dirwd, mask=1073741856, cookie=0, len=0), ['IN_OPEN', 'IN_ISDIR'], dirpath, ''),
-                        (inotify.adapters._INOTIFY_EVENT(wd=parentwd, mask=1073741840, cookie=0, len=16), ['IN_CLOSE_NOWRITE', 'IN_ISDIR'], parentpath, dirname),
-                        (inotify.adapters._INOTIFY_EVENT(wd=dirwd, mask=1073741840, cookie=0, len=0), ['IN_CLOSE_NOWRITE', 'IN_ISDIR'], dirpath, ''),
-                    ]
-                    discovered_subdirs_expects[parentpath].append((dirpath, expects))
-                    discovered_subdirs_expects[dirpath] = []
+            with open(os.path.join(path, 'seen_new_file'), 'w'):
+                pass
 
-            for dirpath, expects in discovered_subdirs_expects[path]:
-                expected += expects
-                for dirpath, expects in discovered_subdirs_expects[dirpath]:
-                    expected += expects
-                    for dirpath, expects in discovered_subdirs_expects[dirpath]:
-                        expected += expects
+            os.remove(os.path.join(path, 'seen_new_file'))
 
-            self.assertEquals(events, expected)
+            batch = i.read_batch(timeout_s=1, mask=inotify.constants.IN_CREATE | inotify.constants.IN_DELETE)
+            self.assertEquals([type_names for (_, type_names, _, _) in batch],
+                              [('IN_CREATE',), ('IN_DELETE',)])
+
+    def test__overflow(self):
+        with inotify.test_support.temp_path() as path:
+            i = inotify.adapters.Inotify()
+            i.add_watch(path, inotify.constants.IN_CREATE)
+
+            with open('/proc/sys/fs/inotify/max_queued_events') as f:
+                max_queued_events = int(f.read())
+
+            for n in range(max_queued_events + 1):
+                with open(os.path.join(path, 'file%d' % n), 'w'):
+                    pass
+
+            try:
+                for _ in i.event_gen(timeout_s=1, yield_nones=False):
+                    pass
+            except inotify.adapters.TerminalEventException as ex:
+                (type_name,) = ex.args
+                e = ex.event
+            else:
+                self.fail("The overflow wasn't raised.")
+
+            self.assertEquals(type_name, 'IN_Q_OVERFLOW')
+            self.assertEquals(e[0].wd, -1)
+            self.assertEquals(e[2], '')
+
+    def test__exception_errno(self):
+        with inotify.test_support.temp_path() as path:
+            i = inotify.adapters.Inotify()
+            errnum = None
+            path1 = os.path.join(path, 'abc')
+            try:
+                i.add_watch(path1)
+            except inotify.calls.InotifyError as ex:
+                errnum = ex.errno
+            self.assertEquals(errnum, errno.ENOENT)
+
+class TestIgnoreMatcher(unittest.TestCase):
+    def test__matches(self):
+        import re
+
+        m = inotify.adapters._IgnoreMatcher([
+                '# comment', '',
+                'node_modules', '*.pyc', 'build/out', 'cache/', '**/tmp/**',
+                re.compile(r'x\d+')])
+
+        expected = [
+            ('node_modules', True, True),
+            ('a/b/node_modules', True, True),
+            ('a/node_modules_x', True, False),
+            ('a/b.pyc', False, True),
+            ('build/out', True, True),
+            ('a/build/out', True, False),
+            ('cache', True, True),
+            ('cache', False, False),
+            ('a/cache', True, True),
+            ('q/tmp/z', False, True),
+            ('q/tmp', True, False),
+            ('x12/a', True, True),
+            ('ax12', True, False),
+        ]
+
+        actual = [(relative_path, is_dir, m.matches(relative_path, is_dir))
+                  for (relative_path, is_dir, _) in expected]
+
+        self.assertEquals(actual, expected)
+
+        self.assertRaises(ValueError, inotify.adapters._IgnoreMatcher, ['!keep'])
+
+
+class TestWatchTable(unittest.TestCase):
+    def __check_table(self, t):
+        t.add('/aa', 1)
+        t.add('/aa/bb', 2)
+        t.add('/aa/bb/cc', 3)
+        t.add('/aa/dd', 4)
+        t.add('relative', 5)
+
+        self.assertEquals(len(t), 5)
+        self.assertEquals(t.get_wd('/aa/bb'), 2)
+        self.assertEquals(t.get_wd('/aa/b'), None)
+        self.assertEquals(t.get_path(3), '/aa/bb/cc')
+        self.assertEquals(t.get_path(5), 'relative')
+        self.assertEquals(sorted(t.get_tree('/aa/bb')), [('/aa/bb', 2), ('/aa/bb/cc', 3)])
+        self.assertEquals(sorted(t.get_tree('/aa/bb/')), [('/aa/bb', 2), ('/aa/bb/cc', 3)])
+
+        moved = t.move('/aa/bb', '/ee/ff')
+        self.assertEquals(sorted(moved), [('/ee/ff', 2), ('/ee/ff/cc', 3)])
+        self.assertEquals(t.get_path(3), '/ee/ff/cc')
+        self.assertEquals(t.get_wd('/aa/bb/cc'), None)
+
+        t.remove('/aa', 1)
+        self.assertEquals(t.get_path(1), None)
+        self.assertEquals(t.get_wd('/aa/dd'), 4)
+
+        t.remove('/aa/dd', 4)
+        self.assertEquals(sorted(t.iter_watches()), [('/ee/ff', 2), ('/ee/ff/cc', 3), ('relative', 5)])
+
+        watches = inotify.adapters._WatchesView(t)
+        watches_r = inotify.adapters._WatchesReverseView(t)
+
+        self.assertEquals(watches, {'/ee/ff': 2, '/ee/ff/cc': 3, 'relative': 5})
+        self.assertEquals(watches_r, {2: '/ee/ff', 3: '/ee/ff/cc', 5: 'relative'})
+
+    def test__table(self):
+        self.__check_table(inotify.adapters._WatchTable())
+
+    def test__compact_table(self):
+        self.__check_table(inotify.adapters._CompactWatchTable())
+
+    def test__compact_table_churn(self):
+        # Enough rows to grow and shift the hash-tables around.
+        import random
+        r = random.Random(0)
+
+        t = inotify.adapters._WatchTable()
+        c = inotify.adapters._CompactWatchTable()
+
+        paths = {}
+        moves = []
+        wd = 0
+        for n in range(3000):
+            action = r.random()
+            if action < 0.6 or not paths:
+                parent = r.choice(list(paths.keys()) + ['/root'])
+                path = parent + '/d%d' % r.randint(0, 20)
+                if path in paths:
+                    continue
+
+                wd += 1
+                paths[path] = wd
+                for table in (t, c):
+                    table.add(path, wd)
+            elif action < 0.9:
+                path = r.choice(list(paths.keys()))
+                for table in (t, c):
+                    table.remove(path, paths[path])
+
+                del paths[path]
+            else:
+                path = r.choice(list(paths.keys()))
+                new_path = '/root/m%d' % n
+                moves.append((sorted(c.move(path, new_path)), sorted(t.move(path, new_path))))
+
+                prefix = path + '/'
+                for old_path in [p for p in paths if p == path or p.startswith(prefix)]:
+                    paths[new_path + old_path[len(path):]] = paths.pop(old_path)
+
+        self.assertEquals([compact for (compact, _) in moves], [trie for (_, trie) in moves])
+        self.assertEquals(len(c), len(t))
+        self.assertEquals(sorted(c.iter_watches()), sorted(t.iter_watches()))
+        self.assertEquals(sorted(c.iter_watches()), sorted(paths.items()))
+
+        self.assertEquals(dict((path, c.get_wd(path)) for path in paths), paths)
+        self.assertEquals(dict((wd, c.get_path(wd)) for wd in paths.values()),
+                          dict((wd, path) for (path, wd) in paths.items()))
+
+
+class TestBackgroundReader(unittest.TestCase):
+    def __init__(self, *args, **kwargs):
+        self.maxDiff = None
+
+        super(TestBackgroundReader, self).__init__(*args, **kwargs)
+
+    def __wait_for_received(self, reader, count):
+        deadline_s = time.time() + 5
+        while reader.stats['received'] < count and time.time() < deadline_s:
+            time.sleep(0.01)
+
+    def test__drop_newest(self):
+        with inotify.test_support.temp_path() as path:
+            i = inotify.adapters.Inotify(block_duration_s=0.1)
+            i.add_watch(path, inotify.constants.IN_CREATE)
+
+            reader = inotify.adapters.BackgroundReader(
+                        i, max_size=2,
+                        overflow_policy=inotify.adapters.OVERFLOW_DROP_NEWEST)
+            reader.start()
+
+            try:
+                for n in range(5):
+                    with open(os.path.join(path, 'file%d' % n), 'w'):
+                        pass
+
+                self.__wait_for_received(reader, 5)
+
+                events = reader.get_batch(timeout_s=1)
+                self.assertEquals([filename for (_, _, _, filename) in events], ['file0', 'file1'])
+
+                stats = reader.stats
+                self.assertEquals(stats['dropped_newest'], 3)
+                self.assertEquals(stats['delivered'], 2)
+                self.assertEquals(stats['queued'], 0)
+            finally:
+                reader.stop()
+
+    def test__coalesce(self):
+        with inotify.test_support.temp_path() as path:
+            i = inotify.adapters.Inotify(block_duration_s=0.1)
+            i.add_watch(path, inotify.constants.IN_OPEN | inotify.constants.IN_CLOSE_WRITE)
+
+            reader = inotify.adapters.BackgroundReader(
+                        i, max_size=1,
+                        overflow_policy=inotify.adapters.OVERFLOW_COALESCE)
+            reader.start()
+
+            try:
+                for n in range(3):
+                    with open(os.path.join(path, 'file'), 'w'):
+                        pass
+
+                self.__wait_for_received(reader, 6)
+
+                events = reader.get_batch(timeout_s=1)
+
+                expected = [
+                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=40, cookie=0, len=16), ('IN_CLOSE_WRITE', 'IN_OPEN'), path, 'file'),
+                ]
+
+                self.assertEquals(events, expected)
+                self.assertEquals(reader.stats['coalesced'], 5)
+            finally:
+                reader.stop()
+
+    def test__block(self):
+        with inotify.test_support.temp_path() as path:
+            i = inotify.adapters.Inotify(block_duration_s=0.1)
+            i.add_watch(path, inotify.constants.IN_CREATE)
+
+            reader = inotify.adapters.BackgroundReader(i, max_size=1)
+            reader.start()
+
+            try:
+                for n in range(3):
+                    with open(os.path.join(path, 'file%d' % n), 'w'):
+                        pass
+
+                filenames = [filename for (_, _, _, filename)
+                             in reader.event_gen(timeout_s=0.5)]
+
+                self.assertEquals(filenames, ['file0', 'file1', 'file2'])
+                self.assertTrue(reader.stats['blocked'] >= 1)
+            finally:
+                reader.stop()
+
+
+def _record_event(event):
+    return event
+
+
+class TestEventHub(unittest.TestCase):
+    def __init__(self, *args, **kwargs):
+        self.maxDiff = None
+
+        super(TestEventHub, self).__init__(*args, **kwargs)
+
+    def test__event_gen(self):
+        with inotify.test_support.temp_path() as path:
+            path1 = os.path.join(path, 'aa')
+            path2 = os.path.join(path, 'bb')
+            path3 = os.path.join(path2, 'cc')
+
+            os.mkdir(path1)
+            os.mkdir(path2)
+
+            i = inotify.adapters.Inotify()
+            i.add_watch(path1, inotify.constants.IN_CREATE)
+
+            tree = inotify.adapters.InotifyTree(path2, mask=inotify.constants.IN_CREATE)
+
+            (read_fd, write_fd) = os.pipe()
+
+            hub = inotify.adapters.EventHub(block_duration_s=0.1)
+            hub.add_adapter(i)
+            hub.add_adapter(tree)
+            hub.add_fd(read_fd)
+
+            try:
+                with open(os.path.join(path1, 'seen_new_file1'), 'w'):
+                    pass
+
+                os.mkdir(path3)
+                os.write(write_fd, b'x')
+
+                seen = []
+                for (source, event) in hub.event_gen(timeout_s=0.3, yield_nones=False):
+                    if source == read_fd:
+                        self.assertEquals(os.read(read_fd, 1), b'x')
+                        seen.append(('pipe', event))
+
+                        with open(os.path.join(path3, 'seen_new_file2'), 'w'):
+                            pass
+                    else:
+                        (_, type_names, event_path, filename) = event
+                        seen.append((source is i, type_names, event_path, filename))
+
+                expected = [
+                    (True, ('IN_CREATE',), path1, 'seen_new_file1'),
+                    (False, ('IN_CREATE', 'IN_ISDIR'), path2, 'cc'),
+                    ('pipe', select.EPOLLIN),
+                    (False, ('IN_CREATE',), path3, 'seen_new_file2'),
+                ]
+
+                self.assertEquals(sorted(seen[:3], key=str), sorted(expected[:3], key=str))
+                self.assertEquals(seen[3:], expected[3:])
+
+                stats = hub.stats
+                self.assertEquals(stats['adapters'], 2)
+                self.assertEquals(stats['fds'], 1)
+                self.assertEquals(stats['events'], 3)
+                self.assertEquals(stats['queued'], 0)
+
+                hub.remove(read_fd)
+                self.assertEquals(hub.stats['fds'], 0)
+            finally:
+                hub.close()
+                os.close(read_fd)
+                os.close(write_fd)
+
+    def test__thread(self):
+        with inotify.test_support.temp_path() as path:
+            i = inotify.adapters.Inotify(shards=2)
+            i.add_watch(path, inotify.constants.IN_CREATE)
+
+            (read_fd, write_fd) = os.pipe()
+
+            received = []
+            condition = threading.Condition()
+
+            def batch_received(batch):
+                with condition:
+                    received.extend(filename for (_, _, _, filename) in batch)
+                    condition.notify_all()
+
+            def fd_ready(fd, epoll_mask):
+                with condition:
+                    received.append(os.read(fd, 1))
+                    condition.notify_all()
+
+            hub = inotify.adapters.EventHub()
+            hub.add_adapter(i, batch_received)
+            hub.add_fd(read_fd, fd_ready)
+            hub.start()
+
+            try:
+                for n in range(3):
+                    with open(os.path.join(path, 'file%d' % n), 'w'):
+                        pass
+
+                os.write(write_fd, b'x')
+
+                with condition:
+                    deadline_s = time.time() + 5
+                    while len(received) < 4 and time.time() < deadline_s:
+                        condition.wait(0.1)
+
+                self.assertEquals(sorted(received, key=str), sorted([b'x', 'file0', 'file1', 'file2'], key=str))
+            finally:
+                # We don't have to wait for the block-duration.
+                start_s = time.time()
+                hub.stop()
+                self.assertTrue(time.time() - start_s < 0.5)
+
+                hub.close()
+                os.close(read_fd)
+                os.close(write_fd)
+
+            self.assertTrue(hub.exception is None)
+
+
+@unittest.skipIf(inotify.adapters._HAS_FUTURES is False, "Needs concurrent.futures")
+class TestEventDispatcher(unittest.TestCase):
+    def test__per_shard_ordering(self):
+        with inotify.test_support.temp_path() as path:
+            path1 = os.path.join(path, 'aa')
+            os.mkdir(path1)
+
+            path2 = os.path.join(path, 'bb')
+            os.mkdir(path2)
+
+            i = inotify.adapters.Inotify(block_duration_s=0.1)
+            i.add_watch(path1, inotify.constants.IN_CREATE)
+            i.add_watch(path2, inotify.constants.IN_CREATE)
+
+            handled = []
+            lock = threading.Lock()
+
+            def handler(event):
+                # Give the other shard the chance to overtake us.
+                time.sleep(0.001)
+                with lock:
+                    handled.append((event[2], event[3]))
+
+            d = inotify.adapters.EventDispatcher(i, handler, workers=2, max_in_flight=4)
+
+            names = ['file%02d' % n for n in range(20)]
+            for name in names:
+                for dir_path in (path1, path2):
+                    with open(os.path.join(dir_path, name), 'w'):
+                        pass
+
+            for event in i.event_gen(timeout_s=0.5, yield_nones=False):
+                d.dispatch(event)
+
+            self.assertTrue(d.join(timeout_s=5))
+            d.close()
+
+            for dir_path in (path1, path2):
+                self.assertEquals([filename for (p, filename) in handled if p == dir_path], names)
+
+            stats = d.stats
+            self.assertEquals(stats['dispatched'], 40)
+            self.assertEquals(stats['completed'], 40)
+            self.assertEquals(stats['in_flight'], 0)
+
+    def test__process_pool(self):
+        with inotify.test_support.temp_path() as path:
+            i = inotify.adapters.Inotify(block_duration_s=0.1)
+            i.add_watch(path, inotify.constants.IN_CREATE)
+
+            with open(os.path.join(path, 'seen_new_file'), 'w'):
+                pass
+
+            executor = concurrent.futures.ProcessPoolExecutor(max_workers=2)
+            try:
+                d = inotify.adapters.EventDispatcher(
+                        i, _record_event, executor=executor,
+                        shard_by=inotify.adapters.SHARD_BY_PATH)
+
+                for event in i.event_gen(timeout_s=0.5, yield_nones=False):
+                    d.dispatch(event)
+
+                self.assertTrue(d.join(timeout_s=10))
+                self.assertEquals(d.stats['completed'], 1)
+            finally:
+                executor.shutdown()
+
+
+class TestEventCoalescer(unittest.TestCase):
+    def __event(self, mask, filename, wd=1, path='/watched'):
+        return (inotify.adapters._INOTIFY_EVENT(wd=wd, mask=mask, cookie=0, len=16),
+                inotify.adapters._get_event_names(mask), path, filename)
+
+    def test__quiet_window(self):
+        c = inotify.adapters.EventCoalescer(quiet_s=0.1, max_latency_s=1.0)
+
+        c.add(self.__event(inotify.constants.IN_MODIFY, 'file1'), now_s=0.0)
+        c.add(self.__event(inotify.constants.IN_MODIFY, 'file2'), now_s=0.01)
+        c.add(self.__event(inotify.constants.IN_MODIFY, 'file1'), now_s=0.05)
+        c.add(self.__event(inotify.constants.IN_CLOSE_WRITE, 'file1'), now_s=0.08)
+
+        self.assertEquals(c.flush_due(now_s=0.1), [])
+        self.assertEquals(c.flush_due(now_s=0.12), [
+            self.__event(inotify.constants.IN_MODIFY, 'file2'),
+        ])
+
+        mask = inotify.constants.IN_MODIFY | inotify.constants.IN_CLOSE_WRITE
+        self.assertEquals(c.flush_due(now_s=0.2), [
+            self.__event(mask, 'file1'),
+        ])
+
+        stats = c.stats
+        self.assertEquals(stats['received'], 4)
+        self.assertEquals(stats['emitted'], 2)
+        self.assertEquals(stats['merged'], 2)
+        self.assertEquals(stats['pending'], 0)
+        self.assertEquals(stats['compression_ratio'], 2.0)
+
+    def test__max_latency(self):
+        c = inotify.adapters.EventCoalescer(quiet_s=0.1, max_latency_s=0.5)
+
+        now_s = 0.0
+        while now_s < 0.45:
+            c.add(self.__event(inotify.constants.IN_MODIFY, 'file1'), now_s=now_s)
+            self.assertEquals(c.flush_due(now_s=now_s), [])
+            now_s += 0.05
+
+        self.assertEquals(len(c.flush_due(now_s=0.5)), 1)
+
+    def test__cancel_rules(self):
+        c = inotify.adapters.EventCoalescer()
+
+        c.add(self.__event(inotify.constants.IN_CREATE, 'file1'), now_s=0.0)
+        c.add(self.__event(inotify.constants.IN_MODIFY, 'file1'), now_s=0.0)
+        c.add(self.__event(inotify.constants.IN_DELETE, 'file1'), now_s=0.0)
+
+        # A deletion of something that was already there is kept.
+        c.add(self.__event(inotify.constants.IN_DELETE, 'file2'), now_s=0.0)
+        c.add(self.__event(inotify.constants.IN_CREATE, 'file2'), now_s=0.0)
+
+        mask = inotify.constants.IN_DELETE | inotify.constants.IN_CREATE
+        self.assertEquals(c.flush(), [self.__event(mask, 'file2')])
+        self.assertEquals(c.stats['cancelled'], 2)
+
+    def test__cancel_rules_existing(self):
+        c = inotify.adapters.EventCoalescer()
+
+        # Something that was there and is gone in the end is still reported
+        # as deleted, whatever happened in-between.
+        c.add(self.__event(inotify.constants.IN_DELETE, 'file1'), now_s=0.0)
+        c.add(self.__event(inotify.constants.IN_CREATE, 'file1'), now_s=0.0)
+        c.add(self.__event(inotify.constants.IN_DELETE, 'file1'), now_s=0.0)
+
+        self.assertEquals(c.flush(), [self.__event(inotify.constants.IN_DELETE, 'file1')])
+        self.assertEquals(c.stats['cancelled'], 0)
+
+    def test__max_pending(self):
+        c = inotify.adapters.EventCoalescer(max_pending=2)
+
+        self.assertEquals(c.add(self.__event(inotify.constants.IN_MODIFY, 'file1'), now_s=0.0), [])
+        self.assertEquals(c.add(self.__event(inotify.constants.IN_MODIFY, 'file2'), now_s=0.0), [])
+        self.assertEquals(c.add(self.__event(inotify.constants.IN_MODIFY, 'file2'), now_s=0.0), [])
+
+        self.assertEquals(
+            c.add(self.__event(inotify.constants.IN_MODIFY, 'file3'), now_s=0.0),
+            [self.__event(inotify.constants.IN_MODIFY, 'file1')])
+
+        stats = c.stats
+        self.assertEquals(stats['evicted'], 1)
+        self.assertEquals(stats['pending'], 2)
+
+    def test__event_gen(self):
+        with inotify.test_support.temp_path() as path:
+            i = inotify.adapters.Inotify(block_duration_s=0.05)
+            i.add_watch(path, inotify.constants.IN_MODIFY | inotify.constants.IN_CLOSE_WRITE)
+
+            # The kernel merges consecutive identical events itself, so we
+            # alternate between two files.
+            with open(os.path.join(path, 'file1'), 'w') as f1:
+                with open(os.path.join(path, 'file2'), 'w') as f2:
+                    for _ in range(50):
+                        for f in (f1, f2):
+                            f.write('x')
+                            f.flush()
+
+            c = inotify.adapters.EventCoalescer(quiet_s=0.05)
+            events = list(c.event_gen(i.event_gen(timeout_s=0.5, yield_nones=True),
+                                      yield_nones=False))
+
+            mask = inotify.constants.IN_MODIFY | inotify.constants.IN_CLOSE_WRITE
+            expected = [
+                (inotify.adapters._INOTIFY_EVENT(wd=1, mask=mask, cookie=0, len=16), ('IN_MODIFY', 'IN_CLOSE_WRITE'), path, 'file1'),
+                (inotify.adapters._INOTIFY_EVENT(wd=1, mask=mask, cookie=0, len=16), ('IN_MODIFY', 'IN_CLOSE_WRITE'), path, 'file2'),
+            ]
+
+            self.assertEquals(sorted(events), expected)
+
+            stats = c.stats
+            self.assertEquals(stats['received'], 102)
+            self.assertEquals(stats['compression_ratio'], 51.0)
+
+
+class TestMovePairer(unittest.TestCase):
+    def test__rename(self):
+        with inotify.test_support.temp_path() as path:
+            with open(os.path.join(path, 'old_name'), 'w'):
+                pass
+
+            i = inotify.adapters.Inotify(block_duration_s=0.1)
+            i.add_watch(path, inotify.constants.IN_MOVE)
+
+            os.rename(os.path.join(path, 'old_name'), os.path.join(path, 'new_name'))
+
+            p = inotify.adapters.MovePairer()
+            events = list(p.event_gen(i.event_gen(timeout_s=0.3), yield_nones=False))
+
+            self.assertEquals(len(events), 1)
+
+            move = events[0]
+            cookie = move[0].cookie
+            self.assertEquals(move, (inotify.adapters._INOTIFY_EVENT(wd=1, mask=192, cookie=cookie, len=16), ('IN_MOVED_FROM', 'IN_MOVED_TO'), path, 'new_name'))
+            self.assertEquals(move.old_path, os.path.join(path, 'old_name'))
+            self.assertEquals(move.new_path, os.path.join(path, 'new_name'))
+            self.assertEquals(move.from_event[1], ('IN_MOVED_FROM',))
+
+            self.assertEquals(p.stats['paired'], 1)
+
+    def test__unmatched(self):
+        def event(mask, cookie, filename):
+            return (inotify.adapters._INOTIFY_EVENT(wd=1, mask=mask, cookie=cookie, len=16),
+                    inotify.adapters._get_event_names(mask), '/watched', filename)
+
+        moved_from = event(inotify.constants.IN_MOVED_FROM, 5, 'moved_out')
+        moved_to = event(inotify.constants.IN_MOVED_TO, 6, 'moved_in')
+        modified = event(inotify.constants.IN_MODIFY, 0, 'modified')
+
+        p = inotify.adapters.MovePairer(timeout_s=0.5, max_pending=1)
+
+        self.assertEquals(p.add(moved_from, now_s=0.0), [])
+        self.assertEquals(p.add(moved_to, now_s=0.1), [moved_to])
+        self.assertEquals(p.add(modified, now_s=0.2), [modified])
+        self.assertEquals(p.flush_due(now_s=0.3), [])
+        self.assertEquals(p.add(modified, now_s=0.6), [moved_from, modified])
+
+        # The table is bounded.
+        other_from = event(inotify.constants.IN_MOVED_FROM, 7, 'other')
+
+        self.assertEquals(p.add(moved_from, now_s=1.0), [])
+        self.assertEquals(p.add(other_from, now_s=1.0), [moved_from])
+        self.assertEquals(p.flush(), [other_from])
+
+        stats = p.stats
+        self.assertEquals(stats['paired'], 0)
+        self.assertEquals(stats['moved_in'], 1)
+        self.assertEquals(stats['moved_out'], 3)
+        self.assertEquals(stats['evicted'], 1)
+        self.assertEquals(stats['pending'], 0)
+
+    def test__same_name(self):
+        def event(mask, cookie, filename):
+            return (inotify.adapters._INOTIFY_EVENT(wd=1, mask=mask, cookie=cookie, len=16),
+                    inotify.adapters._get_event_names(mask), '/watched', filename)
+
+        moved_from = event(inotify.constants.IN_MOVED_FROM, 5, 'name')
+        created = event(inotify.constants.IN_CREATE, 0, 'name')
+        other = event(inotify.constants.IN_CREATE, 0, 'other')
+
+        p = inotify.adapters.MovePairer(timeout_s=0.5)
+
+        # What was moved out goes first; the rest still passes straight
+        # through.
+        self.assertEquals(p.add(moved_from, now_s=0.0), [])
+        self.assertEquals(p.add(other, now_s=0.1), [other])
+        self.assertEquals(p.add(created, now_s=0.2), [moved_from, created])
+        self.assertEquals(p.flush(), [])
+
+        stats = p.stats
+        self.assertEquals(stats['moved_out'], 1)
+        self.assertEquals(stats['pending'], 0)
+
+class TestInotifyTree(unittest.TestCase):
+    def __init__(self, *args, **kwargs):
+        self.maxDiff = None
+
+        super(TestInotifyTree, self).__init__(*args, **kwargs)
+
+    @classmethod
+    def setUpClass(cls):
+        global _HAS_DIRECTORY_ACCESS_EVENTS
+        cls._HAS_DIRECTORY_ACCESS_EVENTS = _HAS_DIRECTORY_ACCESS_EVENTS
+        global _HAS_STRONG_PARENT_AFTER_CHILD
+        cls._HAS_STRONG_PARENT_AFTER_CHILD = _HAS_STRONG_PARENT_AFTER_CHILD
+
+    def __read_all_events(self, i):
+        events = list(i.event_gen(timeout_s=1, yield_nones=False))
+        return events
+
+    def test__cycle(self):
+        with inotify.test_support.temp_path() as path:
+            path1 = os.path.join(path, 'aa')
+            os.mkdir(path1)
+
+            path2 = os.path.join(path, 'bb')
+            os.mkdir(path2)
+
+            i = inotify.adapters.InotifyTree(path)
+
+            watches = i._i._Inotify__watches
+            w2, w3 = watches[path1], watches[path2]
+
+            with open(os.path.join(path, 'seen_new_file1'), 'w'):
+                pass
+
+            with open(os.path.join(path1, 'seen_new_file2'), 'w'):
+                pass
+
+            with open(os.path.join(path2, 'seen_new_file3'), 'w'):
+                pass
+
+            os.remove(os.path.join(path, 'seen_new_file1'))
+            os.remove(os.path.join(path1, 'seen_new_file2'))
+            os.remove(os.path.join(path2, 'seen_new_file3'))
+
+            os.rmdir(path1)
+            os.rmdir(path2)
+
+            events = self.__read_all_events(i)
+
+            if self._HAS_DIRECTORY_ACCESS_EVENTS:
+                expected = [
+                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741856, cookie=0, len=0), ('IN_OPEN', 'IN_ISDIR'), path, ''),
+                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741825, cookie=0, len=0), ('IN_ACCESS', 'IN_ISDIR'), path, ''),
+                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741840, cookie=0, len=0), ('IN_CLOSE_NOWRITE', 'IN_ISDIR'), path, ''),
+                ]
+                _access_dir_a = [
+                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741856, cookie=0, len=16), ('IN_OPEN', 'IN_ISDIR'), path, 'aa'),
+                    (inotify.adapters._INOTIFY_EVENT(wd=w2, mask=1073741856, cookie=0, len=0), ('IN_OPEN', 'IN_ISDIR'), path1, ''),
+                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741825, cookie=0, len=16), ('IN_ACCESS', 'IN_ISDIR'), path, 'aa'),
+                    (inotify.adapters._INOTIFY_EVENT(wd=w2, mask=1073741825, cookie=0, len=0), ('IN_ACCESS', 'IN_ISDIR'), path1, ''),
+                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741825, cookie=0, len=16), ('IN_ACCESS', 'IN_ISDIR'), path, 'aa'),
+                    (inotify.adapters._INOTIFY_EVENT(wd=w2, mask=1073741825, cookie=0, len=0), ('IN_ACCESS', 'IN_ISDIR'), path1, ''),
+                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741840, cookie=0, len=16), ('IN_CLOSE_NOWRITE', 'IN_ISDIR'), path, 'aa'),
+                    (inotify.adapters._INOTIFY_EVENT(wd=w2, mask=1073741840, cookie=0, len=0), ('IN_CLOSE_NOWRITE', 'IN_ISDIR'), path1, ''),
+                ]
+                _access_dir_b = [
+                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741856, cookie=0, len=16), ('IN_OPEN', 'IN_ISDIR'), path, 'bb'),
+                    (inotify.adapters._INOTIFY_EVENT(wd=w3, mask=1073741856, cookie=0, len=0), ('IN_OPEN', 'IN_ISDIR'), path2, ''),
+                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741825, cookie=0, len=16), ('IN_ACCESS', 'IN_ISDIR'), path, 'bb'),
+                    (inotify.adapters._INOTIFY_EVENT(wd=w3, mask=1073741825, cookie=0, len=0), ('IN_ACCESS', 'IN_ISDIR'), path2, ''),
+                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741825, cookie=0, len=16), ('IN_ACCESS', 'IN_ISDIR'), path, 'bb'),
+                    (inotify.adapters._INOTIFY_EVENT(wd=w3, mask=1073741825, cookie=0, len=0), ('IN_ACCESS', 'IN_ISDIR'), path2, ''),
+                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741840, cookie=0, len=16), ('IN_CLOSE_NOWRITE', 'IN_ISDIR'), path, 'bb'),
+                    (inotify.adapters._INOTIFY_EVENT(wd=w3, mask=1073741840, cookie=0, len=0), ('IN_CLOSE_NOWRITE', 'IN_ISDIR'), path2, ''),
+                ]
+            else:
+                expected = [
+                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741856, cookie=0, len=0), ('IN_OPEN', 'IN_ISDIR'), path, ''),
+                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741840, cookie=0, len=0), ('IN_CLOSE_NOWRITE', 'IN_ISDIR'), path, ''),
+                ]
+                _access_dir_a = [
+                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741856, cookie=0, len=16), ('IN_OPEN', 'IN_ISDIR'), path, 'aa'),
+                    (inotify.adapters._INOTIFY_EVENT(wd=w2, mask=1073741856, cookie=0, len=0), ('IN_OPEN', 'IN_ISDIR'), path1, ''),
+                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741840, cookie=0, len=16), ('IN_CLOSE_NOWRITE', 'IN_ISDIR'), path, 'aa'),
+                    (inotify.adapters._INOTIFY_EVENT(wd=w2, mask=1073741840, cookie=0, len=0), ('IN_CLOSE_NOWRITE', 'IN_ISDIR'), path1, ''),
+                ]
+                _access_dir_b = [
+                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741856, cookie=0, len=16), ('IN_OPEN', 'IN_ISDIR'), path, 'bb'),
+                    (inotify.adapters._INOTIFY_EVENT(wd=w3, mask=1073741856, cookie=0, len=0), ('IN_OPEN', 'IN_ISDIR'), path2, ''),
+                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741840, cookie=0, len=16), ('IN_CLOSE_NOWRITE', 'IN_ISDIR'), path, 'bb'),
+                    (inotify.adapters._INOTIFY_EVENT(wd=w3, mask=1073741840, cookie=0, len=0), ('IN_CLOSE_NOWRITE', 'IN_ISDIR'), path2, ''),
+                ]
+
+            # we can't be sure about the order the watches were registered
+            expected += (_access_dir_a + _access_dir_b if w2 < w3 
+                        else _access_dir_b + _access_dir_a)
+
+            expected += [
+                (inotify.adapters._INOTIFY_EVENT(wd=1, mask=256, cookie=0, len=16), ('IN_CREATE',), path, 'seen_new_file1'),
+                (inotify.adapters._INOTIFY_EVENT(wd=1, mask=32, cookie=0, len=16), ('IN_OPEN',), path, 'seen_new_file1'),
+                (inotify.adapters._INOTIFY_EVENT(wd=1, mask=8, cookie=0, len=16), ('IN_CLOSE_WRITE',), path, 'seen_new_file1'),
+
+                (inotify.adapters._INOTIFY_EVENT(wd=w2, mask=256, cookie=0, len=16), ('IN_CREATE',), path1, 'seen_new_file2'),
+                (inotify.adapters._INOTIFY_EVENT(wd=w2, mask=32, cookie=0, len=16), ('IN_OPEN',), path1, 'seen_new_file2'),
+                (inotify.adapters._INOTIFY_EVENT(wd=w2, mask=8, cookie=0, len=16), ('IN_CLOSE_WRITE',), path1, 'seen_new_file2'),
+
+                (inotify.adapters._INOTIFY_EVENT(wd=w3, mask=256, cookie=0, len=16), ('IN_CREATE',), path2, 'seen_new_file3'),
+                (inotify.adapters._INOTIFY_EVENT(wd=w3, mask=32, cookie=0, len=16), ('IN_OPEN',), path2, 'seen_new_file3'),
+                (inotify.adapters._INOTIFY_EVENT(wd=w3, mask=8, cookie=0, len=16), ('IN_CLOSE_WRITE',), path2, 'seen_new_file3'),
+
+                (inotify.adapters._INOTIFY_EVENT(wd=1, mask=512, cookie=0, len=16), ('IN_DELETE',), path, 'seen_new_file1'),
+                (inotify.adapters._INOTIFY_EVENT(wd=w2, mask=512, cookie=0, len=16), ('IN_DELETE',), path1, 'seen_new_file2'),
+                (inotify.adapters._INOTIFY_EVENT(wd=w3, mask=512, cookie=0, len=16), ('IN_DELETE',), path2, 'seen_new_file3'),
+            ]
+
+            if self._HAS_STRONG_PARENT_AFTER_CHILD:
+                expected += [
+                    (inotify.adapters._INOTIFY_EVENT(wd=w2, mask=1024, cookie=0, len=0), ('IN_DELETE_SELF',), path1, ''),
+                    (inotify.adapters._INOTIFY_EVENT(wd=w2, mask=32768, cookie=0, len=0), ('IN_IGNORED',), path1, ''),
+                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073742336, cookie=0, len=16), ('IN_DELETE', 'IN_ISDIR'), path, 'aa'),
+
+                    (inotify.adapters._INOTIFY_EVENT(wd=w3, mask=1024, cookie=0, len=0), ('IN_DELETE_SELF',), path2, ''),
+                    (inotify.adapters._INOTIFY_EVENT(wd=w3, mask=32768, cookie=0, len=0), ('IN_IGNORED',), path2, ''),
+                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073742336, cookie=0, len=16), ('IN_DELETE', 'IN_ISDIR'), path, 'bb'),
+                ]
+            else:
+                expected += [
+                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073742336, cookie=0, len=16), ('IN_DELETE', 'IN_ISDIR'), path, 'aa'),
+                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073742336, cookie=0, len=16), ('IN_DELETE', 'IN_ISDIR'), path, 'bb'),
+                    (inotify.adapters._INOTIFY_EVENT(wd=w2, mask=1024, cookie=0, len=0), ('IN_DELETE_SELF',), path1, ''),
+                    (inotify.adapters._INOTIFY_EVENT(wd=w2, mask=32768, cookie=0, len=0), ('IN_IGNORED',), path1, ''),
+
+                    (inotify.adapters._INOTIFY_EVENT(wd=w3, mask=1024, cookie=0, len=0), ('IN_DELETE_SELF',), path2, ''),
+                    (inotify.adapters._INOTIFY_EVENT(wd=w3, mask=32768, cookie=0, len=0), ('IN_IGNORED',), path2, ''),
+                ]
+
+            self.assertEquals(events, expected)
+
+    def test__renames(self):
+
+        # Since we're not reading the events one at a time in a loop and
+        # removing or renaming folders will flush any queued events, we have to
+        # group things in order to check things first before such operations.
+
+        with inotify.test_support.temp_path() as path:
+            i = inotify.adapters.InotifyTree(path)
+
+            old_path = os.path.join(path, 'old_folder')
+            new_path = os.path.join(path, 'new_folder')
+
+            os.mkdir(old_path)
+
+            events1 = self.__read_all_events(i)
+
+            if self._HAS_DIRECTORY_ACCESS_EVENTS:
+                expected = [
+                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741856, cookie=0, len=0), ('IN_OPEN', 'IN_ISDIR'), path, ''),
+                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741825, cookie=0, len=0), ('IN_ACCESS', 'IN_ISDIR'), path, ''),
+                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741840, cookie=0, len=0), ('IN_CLOSE_NOWRITE', 'IN_ISDIR'), path, ''),
+                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073742080, cookie=0, len=16), ('IN_CREATE', 'IN_ISDIR'), path, 'old_folder'),
+                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741856, cookie=0, len=16), ('IN_OPEN', 'IN_ISDIR'), path, 'old_folder'),
+                    (inotify.adapters._INOTIFY_EVENT(wd=2, mask=1073741856, cookie=0, len=0), ('IN_OPEN', 'IN_ISDIR'), old_path, ''),
+                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741825, cookie=0, len=16), ('IN_ACCESS', 'IN_ISDIR'), path, 'old_folder'),
+                    (inotify.adapters._INOTIFY_EVENT(wd=2, mask=1073741825, cookie=0, len=0), ('IN_ACCESS', 'IN_ISDIR'), old_path, ''),
+                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741825, cookie=0, len=16), ('IN_ACCESS', 'IN_ISDIR'), path, 'old_folder'),
+                    (inotify.adapters._INOTIFY_EVENT(wd=2, mask=1073741825, cookie=0, len=0), ('IN_ACCESS', 'IN_ISDIR'), old_path, ''),
+                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741840, cookie=0, len=16), ('IN_CLOSE_NOWRITE', 'IN_ISDIR'), path, 'old_folder'),
+                    (inotify.adapters._INOTIFY_EVENT(wd=2, mask=1073741840, cookie=0, len=0), ('IN_CLOSE_NOWRITE', 'IN_ISDIR'), old_path, ''),
+                ]
+            else:
+                expected = [
+                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741856, cookie=0, len=0), ('IN_OPEN', 'IN_ISDIR'), path, ''),
+                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741840, cookie=0, len=0), ('IN_CLOSE_NOWRITE', 'IN_ISDIR'), path, ''),
+                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073742080, cookie=0, len=16), ('IN_CREATE', 'IN_ISDIR'), path, 'old_folder'),
+                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741856, cookie=0, len=16), ('IN_OPEN', 'IN_ISDIR'), path, 'old_folder'),
+                    (inotify.adapters._INOTIFY_EVENT(wd=2, mask=1073741856, cookie=0, len=0), ('IN_OPEN', 'IN_ISDIR'), old_path, ''),
+                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741840, cookie=0, len=16), ('IN_CLOSE_NOWRITE', 'IN_ISDIR'), path, 'old_folder'),
+                    (inotify.adapters._INOTIFY_EVENT(wd=2, mask=1073741840, cookie=0, len=0), ('IN_CLOSE_NOWRITE', 'IN_ISDIR'), old_path, ''),
+                ]
+
+            self.assertEquals(events1, expected)
+
+
+            os.rename(old_path, new_path)
+
+            events2 = self.__read_all_events(i)
+
+            # The directory is moved within our tree, so it keeps its watch.
+            expected = [
+                (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741888, cookie=events2[1][0].cookie, len=16), ('IN_MOVED_FROM', 'IN_ISDIR'), path, 'old_folder'),
+                (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741952, cookie=events2[0][0].cookie, len=16), ('IN_MOVED_TO', 'IN_ISDIR'), path, 'new_folder'),
+                (inotify.adapters._INOTIFY_EVENT(wd=2, mask=2048, cookie=0, len=0), ('IN_MOVE_SELF',), new_path, ''),
+            ]
+
+            self.assertEquals(events2, expected)
+
+
+            with open(os.path.join(new_path, 'old_filename'), 'w'):
+                pass
+
+            os.rename(
+                os.path.join(new_path, 'old_filename'),
+                os.path.join(new_path, 'new_filename'))
+
+            os.remove(os.path.join(path, 'new_folder', 'new_filename'))
+            os.rmdir(os.path.join(path, 'new_folder'))
+
+            events3 = self.__read_all_events(i)
+
+            expected = [
+                (inotify.adapters._INOTIFY_EVENT(wd=2, mask=256, cookie=0, len=16), ('IN_CREATE',), new_path, 'old_filename'),
+                (inotify.adapters._INOTIFY_EVENT(wd=2, mask=32, cookie=0, len=16), ('IN_OPEN',), new_path, 'old_filename'),
+                (inotify.adapters._INOTIFY_EVENT(wd=2, mask=8, cookie=0, len=16), ('IN_CLOSE_WRITE',), new_path, 'old_filename'),
+
+                (inotify.adapters._INOTIFY_EVENT(wd=2, mask=64, cookie=events3[3][0].cookie, len=16), ('IN_MOVED_FROM',), new_path, 'old_filename'),
+                (inotify.adapters._INOTIFY_EVENT(wd=2, mask=128, cookie=events3[4][0].cookie, len=16), ('IN_MOVED_TO',), new_path, 'new_filename'),
+
+                (inotify.adapters._INOTIFY_EVENT(wd=2, mask=512, cookie=0, len=16), ('IN_DELETE',), new_path, 'new_filename'),
+            ]
+
+            if self._HAS_STRONG_PARENT_AFTER_CHILD:
+                expected += [
+                    (inotify.adapters._INOTIFY_EVENT(wd=2, mask=1024, cookie=0, len=0), ('IN_DELETE_SELF',), new_path, ''),
+                    (inotify.adapters._INOTIFY_EVENT(wd=2, mask=32768, cookie=0, len=0), ('IN_IGNORED',), new_path, ''),
+                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073742336, cookie=0, len=16), ('IN_DELETE', 'IN_ISDIR'), path, 'new_folder'),
+                ]
+            else:
+                expected += [
+                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073742336, cookie=0, len=16), ('IN_DELETE', 'IN_ISDIR'), path, 'new_folder'),
+                    (inotify.adapters._INOTIFY_EVENT(wd=2, mask=1024, cookie=0, len=0), ('IN_DELETE_SELF',), new_path, ''),
+                    (inotify.adapters._INOTIFY_EVENT(wd=2, mask=32768, cookie=0, len=0), ('IN_IGNORED',), new_path, ''),
+                ]
+
+            self.assertEquals(events3, expected)
+
+    def __check_move_subtree(self, compact_watches):
+        with inotify.test_support.temp_path() as path:
+            os.makedirs(os.path.join(path, 'aa', 'bb', 'cc'))
+            os.mkdir(os.path.join(path, 'dd'))
+
+            with inotify.test_support.temp_path() as outside_path:
+                i = inotify.adapters.InotifyTree(path, mask=inotify.constants.IN_CREATE,
+                                                 compact_watches=compact_watches)
+
+                watches = i._i._Inotify__watches
+                watches_r = i._i._Inotify__watches_r
+                wds = dict(watches)
+
+                # Within the tree, the watches are kept and re-pathed.
+                new_path = os.path.join(path, 'dd', 'moved')
+                os.rename(os.path.join(path, 'aa'), new_path)
+
+                with open(os.path.join(new_path, 'bb', 'cc', 'seen_new_file'), 'w'):
+                    pass
+
+                events = self.__read_all_events(i)
+
+                expected = [
+                    (inotify.adapters._INOTIFY_EVENT(wd=wds[os.path.join(path, 'aa', 'bb', 'cc')], mask=256, cookie=0, len=16), ('IN_CREATE',), os.path.join(new_path, 'bb', 'cc'), 'seen_new_file'),
+                ]
+
+                self.assertEquals(events, expected)
+
+                expected_watches = {
+                    path: wds[path],
+                    os.path.join(path, 'dd'): wds[os.path.join(path, 'dd')],
+                    new_path: wds[os.path.join(path, 'aa')],
+                    os.path.join(new_path, 'bb'): wds[os.path.join(path, 'aa', 'bb')],
+                    os.path.join(new_path, 'bb', 'cc'): wds[os.path.join(path, 'aa', 'bb', 'cc')],
+                }
+
+                self.assertEquals(watches, expected_watches)
+                self.assertEquals(watches_r, dict((wd, p) for (p, wd) in expected_watches.items()))
+
+                # Out of the tree, all of the watches are removed.
+                os.rename(new_path, os.path.join(outside_path, 'moved'))
+
+                batch = i.read_batch(timeout_s=1)
+                self.assertEquals(batch, [])
+
+                self.assertEquals(sorted(watches.keys()), [path, os.path.join(path, 'dd')])
+
+    def test__move_subtree(self):
+        self.__check_move_subtree(False)
+
+    def test__move_subtree_compact_watches(self):
+        self.__check_move_subtree(True)
+
+    def test__automatic_new_watches_on_new_paths(self):
+
+        # Tests that watches are actively established as new folders are
+        # created.
+
+        with inotify.test_support.temp_path() as path:
+            i = inotify.adapters.InotifyTree(path)
+
+            path1 = os.path.join(path, 'folder1')
+            path2 = os.path.join(path1, 'folder2')
+
+            os.mkdir(path1)
+
+            events = self.__read_all_events(i)
+
+            if self._HAS_DIRECTORY_ACCESS_EVENTS:
+                expected = [
+                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741856, cookie=0, len=0), ('IN_OPEN', 'IN_ISDIR'), path, ''),
+                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741825, cookie=0, len=0), ('IN_ACCESS', 'IN_ISDIR'), path, ''),
+                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741840, cookie=0, len=0), ('IN_CLOSE_NOWRITE', 'IN_ISDIR'), path, ''),
+                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073742080, cookie=0, len=16), ('IN_CREATE', 'IN_ISDIR'), path, 'folder1'),
+                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741856, cookie=0, len=16), ('IN_OPEN', 'IN_ISDIR'), path, 'folder1'),
+                    (inotify.adapters._INOTIFY_EVENT(wd=2, mask=1073741856, cookie=0, len=0), ('IN_OPEN', 'IN_ISDIR'), path1, ''),
+                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741825, cookie=0, len=16), ('IN_ACCESS', 'IN_ISDIR'), path, 'folder1'),
+                    (inotify.adapters._INOTIFY_EVENT(wd=2, mask=1073741825, cookie=0, len=0), ('IN_ACCESS', 'IN_ISDIR'), path1, ''),
+                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741825, cookie=0, len=16), ('IN_ACCESS', 'IN_ISDIR'), path, 'folder1'),
+                    (inotify.adapters._INOTIFY_EVENT(wd=2, mask=1073741825, cookie=0, len=0), ('IN_ACCESS', 'IN_ISDIR'), path1, ''),
+                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741840, cookie=0, len=16), ('IN_CLOSE_NOWRITE', 'IN_ISDIR'), path, 'folder1'),
+                    (inotify.adapters._INOTIFY_EVENT(wd=2, mask=1073741840, cookie=0, len=0), ('IN_CLOSE_NOWRITE', 'IN_ISDIR'), path1, ''),
+                ]
+            else:
+                expected = [
+                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741856, cookie=0, len=0), ('IN_OPEN', 'IN_ISDIR'), path, ''),
+                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741840, cookie=0, len=0), ('IN_CLOSE_NOWRITE', 'IN_ISDIR'), path, ''),
+                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073742080, cookie=0, len=16), ('IN_CREATE', 'IN_ISDIR'), path, 'folder1'),
+                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741856, cookie=0, len=16), ('IN_OPEN', 'IN_ISDIR'), path, 'folder1'),
+                    (inotify.adapters._INOTIFY_EVENT(wd=2, mask=1073741856, cookie=0, len=0), ('IN_OPEN', 'IN_ISDIR'), path1, ''),
+                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741840, cookie=0, len=16), ('IN_CLOSE_NOWRITE', 'IN_ISDIR'), path, 'folder1'),
+                    (inotify.adapters._INOTIFY_EVENT(wd=2, mask=1073741840, cookie=0, len=0), ('IN_CLOSE_NOWRITE', 'IN_ISDIR'), path1, ''),
+                ]
+
+            self.assertEquals(events, expected)
+
+
+            os.mkdir(path2)
+
+            events = self.__read_all_events(i)
+
+            if self._HAS_DIRECTORY_ACCESS_EVENTS:
+                expected = [
+                    (inotify.adapters._INOTIFY_EVENT(wd=2, mask=1073742080, cookie=0, len=16), ('IN_CREATE', 'IN_ISDIR'), path1, 'folder2'),
+                    (inotify.adapters._INOTIFY_EVENT(wd=2, mask=1073741856, cookie=0, len=16), ('IN_OPEN', 'IN_ISDIR'), path1, 'folder2'),
+                    (inotify.adapters._INOTIFY_EVENT(wd=3, mask=1073741856, cookie=0, len=0), ('IN_OPEN', 'IN_ISDIR'), path2, ''),
+                    (inotify.adapters._INOTIFY_EVENT(wd=2, mask=1073741825, cookie=0, len=16), ('IN_ACCESS', 'IN_ISDIR'), path1, 'folder2'),
+                    (inotify.adapters._INOTIFY_EVENT(wd=3, mask=1073741825, cookie=0, len=0), ('IN_ACCESS', 'IN_ISDIR'), path2, ''),
+                    (inotify.adapters._INOTIFY_EVENT(wd=2, mask=1073741825, cookie=0, len=16), ('IN_ACCESS', 'IN_ISDIR'), path1, 'folder2'),
+                    (inotify.adapters._INOTIFY_EVENT(wd=3, mask=1073741825, cookie=0, len=0), ('IN_ACCESS', 'IN_ISDIR'), path2, ''),
+                    (inotify.adapters._INOTIFY_EVENT(wd=2, mask=1073741840, cookie=0, len=16), ('IN_CLOSE_NOWRITE', 'IN_ISDIR'), path1, 'folder2'),
+                    (inotify.adapters._INOTIFY_EVENT(wd=3, mask=1073741840, cookie=0, len=0), ('IN_CLOSE_NOWRITE', 'IN_ISDIR'), path2, ''),
+                ]
+            else:
+                expected = [
+                    (inotify.adapters._INOTIFY_EVENT(wd=2, mask=1073742080, cookie=0, len=16), ('IN_CREATE', 'IN_ISDIR'), path1, 'folder2'),
+                    (inotify.adapters._INOTIFY_EVENT(wd=2, mask=1073741856, cookie=0, len=16), ('IN_OPEN', 'IN_ISDIR'), path1, 'folder2'),
+                    (inotify.adapters._INOTIFY_EVENT(wd=3, mask=1073741856, cookie=0, len=0), ('IN_OPEN', 'IN_ISDIR'), path2, ''),
+                    (inotify.adapters._INOTIFY_EVENT(wd=2, mask=1073741840, cookie=0, len=16), ('IN_CLOSE_NOWRITE', 'IN_ISDIR'), path1, 'folder2'),
+                    (inotify.adapters._INOTIFY_EVENT(wd=3, mask=1073741840, cookie=0, len=0), ('IN_CLOSE_NOWRITE', 'IN_ISDIR'), path2, ''),
+                ]
+
+            self.assertEquals(events, expected)
+
+
+            with open(os.path.join(path2,'filename'), 'w'):
+                pass
+
+            events = self.__read_all_events(i)
+
+            expected = [
+                (inotify.adapters._INOTIFY_EVENT(wd=3, mask=256, cookie=0, len=16), ('IN_CREATE',), path2, 'filename'),
+                (inotify.adapters._INOTIFY_EVENT(wd=3, mask=32, cookie=0, len=16), ('IN_OPEN',), path2, 'filename'),
+                (inotify.adapters._INOTIFY_EVENT(wd=3, mask=8, cookie=0, len=16), ('IN_CLOSE_WRITE',), path2, 'filename'),
+            ]
+
+            self.assertEquals(events, expected)
+
+    def test__automatic_new_watches_on_existing_paths(self):
+
+        # Tests whether the watches are recursively established when we
+        # initialize.
+
+        with inotify.test_support.temp_path() as path:
+            path1 = os.path.join(path, 'folder1')
+            path2 = os.path.join(path1, 'folder2')
+
+            os.mkdir(path1)
+            os.mkdir(path2)
+
+            i = inotify.adapters.InotifyTree(path)
+
+            with open(os.path.join(path2,'filename'), 'w'):
+                pass
+
+            events = self.__read_all_events(i)
+
+            if self._HAS_DIRECTORY_ACCESS_EVENTS:
+                expected = [
+                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741856, cookie=0, len=0), ('IN_OPEN', 'IN_ISDIR'), path, ''),
+                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741825, cookie=0, len=0), ('IN_ACCESS', 'IN_ISDIR'), path, ''),
+                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741840, cookie=0, len=0), ('IN_CLOSE_NOWRITE', 'IN_ISDIR'), path, ''),
+                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741856, cookie=0, len=16), ('IN_OPEN', 'IN_ISDIR'), path, 'folder1'),
+                    (inotify.adapters._INOTIFY_EVENT(wd=2, mask=1073741856, cookie=0, len=0), ('IN_OPEN', 'IN_ISDIR'), path1, ''),
+                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741825, cookie=0, len=16), ('IN_ACCESS', 'IN_ISDIR'), path, 'folder1'),
+                    (inotify.adapters._INOTIFY_EVENT(wd=2, mask=1073741825, cookie=0, len=0), ('IN_ACCESS', 'IN_ISDIR'), path1, ''),
+                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741825, cookie=0, len=16), ('IN_ACCESS', 'IN_ISDIR'), path, 'folder1'),
+                    (inotify.adapters._INOTIFY_EVENT(wd=2, mask=1073741825, cookie=0, len=0), ('IN_ACCESS', 'IN_ISDIR'), path1, ''),
+                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741840, cookie=0, len=16), ('IN_CLOSE_NOWRITE', 'IN_ISDIR'), path, 'folder1'),
+                    (inotify.adapters._INOTIFY_EVENT(wd=2, mask=1073741840, cookie=0, len=0), ('IN_CLOSE_NOWRITE', 'IN_ISDIR'), path1, ''),
+                    (inotify.adapters._INOTIFY_EVENT(wd=2, mask=1073741856, cookie=0, len=16), ('IN_OPEN', 'IN_ISDIR'), path1, 'folder2'),
+                    (inotify.adapters._INOTIFY_EVENT(wd=3, mask=1073741856, cookie=0, len=0), ('IN_OPEN', 'IN_ISDIR'), path2, ''),
+                    (inotify.adapters._INOTIFY_EVENT(wd=2, mask=1073741825, cookie=0, len=16), ('IN_ACCESS', 'IN_ISDIR'), path1, 'folder2'),
+                    (inotify.adapters._INOTIFY_EVENT(wd=3, mask=1073741825, cookie=0, len=0), ('IN_ACCESS', 'IN_ISDIR'), path2, ''),
+                    (inotify.adapters._INOTIFY_EVENT(wd=2, mask=1073741825, cookie=0, len=16), ('IN_ACCESS', 'IN_ISDIR'), path1, 'folder2'),
+                    (inotify.adapters._INOTIFY_EVENT(wd=3, mask=1073741825, cookie=0, len=0), ('IN_ACCESS', 'IN_ISDIR'), path2, ''),
+                    (inotify.adapters._INOTIFY_EVENT(wd=2, mask=1073741840, cookie=0, len=16), ('IN_CLOSE_NOWRITE', 'IN_ISDIR'), path1, 'folder2'),
+                    (inotify.adapters._INOTIFY_EVENT(wd=3, mask=1073741840, cookie=0, len=0), ('IN_CLOSE_NOWRITE', 'IN_ISDIR'), path2, ''),
+                    (inotify.adapters._INOTIFY_EVENT(wd=3, mask=256, cookie=0, len=16), ('IN_CREATE',), path2, 'filename'),
+                    (inotify.adapters._INOTIFY_EVENT(wd=3, mask=32, cookie=0, len=16), ('IN_OPEN',), path2, 'filename'),
+                    (inotify.adapters._INOTIFY_EVENT(wd=3, mask=8, cookie=0, len=16), ('IN_CLOSE_WRITE',), path2, 'filename'),
+                ]
+            else:
+                expected = [
+                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741856, cookie=0, len=0), ('IN_OPEN', 'IN_ISDIR'), path, ''),
+                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741840, cookie=0, len=0), ('IN_CLOSE_NOWRITE', 'IN_ISDIR'), path, ''),
+                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741856, cookie=0, len=16), ('IN_OPEN', 'IN_ISDIR'), path, 'folder1'),
+                    (inotify.adapters._INOTIFY_EVENT(wd=2, mask=1073741856, cookie=0, len=0), ('IN_OPEN', 'IN_ISDIR'), path1, ''),
+                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741840, cookie=0, len=16), ('IN_CLOSE_NOWRITE', 'IN_ISDIR'), path, 'folder1'),
+                    (inotify.adapters._INOTIFY_EVENT(wd=2, mask=1073741840, cookie=0, len=0), ('IN_CLOSE_NOWRITE', 'IN_ISDIR'), path1, ''),
+                    (inotify.adapters._INOTIFY_EVENT(wd=2, mask=1073741856, cookie=0, len=16), ('IN_OPEN', 'IN_ISDIR'), path1, 'folder2'),
+                    (inotify.adapters._INOTIFY_EVENT(wd=3, mask=1073741856, cookie=0, len=0), ('IN_OPEN', 'IN_ISDIR'), path2, ''),
+                    (inotify.adapters._INOTIFY_EVENT(wd=2, mask=1073741840, cookie=0, len=16), ('IN_CLOSE_NOWRITE', 'IN_ISDIR'), path1, 'folder2'),
+                    (inotify.adapters._INOTIFY_EVENT(wd=3, mask=1073741840, cookie=0, len=0), ('IN_CLOSE_NOWRITE', 'IN_ISDIR'), path2, ''),
+                    (inotify.adapters._INOTIFY_EVENT(wd=3, mask=256, cookie=0, len=16), ('IN_CREATE',), path2, 'filename'),
+                    (inotify.adapters._INOTIFY_EVENT(wd=3, mask=32, cookie=0, len=16), ('IN_OPEN',), path2, 'filename'),
+                    (inotify.adapters._INOTIFY_EVENT(wd=3, mask=8, cookie=0, len=16), ('IN_CLOSE_WRITE',), path2, 'filename'),
+                ]
+
+            self.assertEquals(events, expected)
+
+    def test__exclude_subdirectories(self):
+
+        # Tests whether the skip_dires parameter works as expected
+
+        with inotify.test_support.temp_path() as path:
+            for foldernum1 in range(1,5):
+                path1 = os.path.join(path, 'folder%d' % foldernum1)
+                os.mkdir(path1)
+                for foldernum2 in range(1,5):
+                    path2 = os.path.join(path1, 'subfolder%d' % foldernum2)
+                    os.mkdir(path2)
+                    for foldernum3 in range(1,3):
+                        path3 = os.path.join(path2, 'subsubfolder%d' % foldernum3)
+                        os.mkdir(path3)
+
+            ignored_dirs = (os.path.join(path, 'folder1'),
+                            os.path.join(path, 'folder2', 'subfolder2'),
+                            os.path.join(path, 'folder2', 'subfolder3'),
+                            os.path.join(path, 'folder2', 'subfolder4', 'subsubfolder2'),
+                            os.path.join(path, 'folder3'),
+                            os.path.join(path, 'folder4'),
+            )
+
+            expected_watches = (path, os.path.join(path, 'folder2'),
+                                os.path.join(path, 'folder2', 'subfolder1'),
+                                os.path.join(path, 'folder2', 'subfolder1', 'subsubfolder1'),
+                                os.path.join(path, 'folder2', 'subfolder1', 'subsubfolder2'),
+                                os.path.join(path, 'folder2', 'subfolder4'),
+                                os.path.join(path, 'folder2', 'subfolder4', 'subsubfolder1'),
+            )
+
+            i = inotify.adapters.InotifyTree(path, ignored_dirs=ignored_dirs)
+            events = self.__read_all_events(i)
+
+            watches = i._i._Inotify__watches
+            self.assertEquals(sorted(watches.keys()), sorted(expected_watches))
+
+            discovered_subdirs_expects = { path: [] }
+
+            if self._HAS_DIRECTORY_ACCESS_EVENTS:
+                expected = [
+                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741856, cookie=0, len=0), ('IN_OPEN', 'IN_ISDIR'), path, ''),
+                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741825, cookie=0, len=0), ('IN_ACCESS', 'IN_ISDIR'), path, ''),
+                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741840, cookie=0, len=0), ('IN_CLOSE_NOWRITE', 'IN_ISDIR'), path, ''),
+                ]
+                for dirpath, dirwd in sorted(watches.items(), key=lambda tup: tup[1])[1:]:
+                    parentpath, dirname = os.path.split(dirpath)
+                    parentwd = watches[parentpath]
+                    expects = [
+                        (inotify.adapters._INOTIFY_EVENT(wd=parentwd, mask=1073741856, cookie=0, len=16), ('IN_OPEN', 'IN_ISDIR'), parentpath, dirname),
+                        (inotify.adapters._INOTIFY_EVENT(wd=dirwd, mask=1073741856, cookie=0, len=0), ('IN_OPEN', 'IN_ISDIR'), dirpath, ''),
+                        (inotify.adapters._INOTIFY_EVENT(wd=parentwd, mask=1073741825, cookie=0, len=16), ('IN_ACCESS', 'IN_ISDIR'), parentpath, dirname),
+                        (inotify.adapters._INOTIFY_EVENT(wd=dirwd, mask=1073741825, cookie=0, len=0), ('IN_ACCESS', 'IN_ISDIR'), dirpath, ''),
+                        (inotify.adapters._INOTIFY_EVENT(wd=parentwd, mask=1073741825, cookie=0, len=16), ('IN_ACCESS', 'IN_ISDIR'), parentpath, dirname),
+                        (inotify.adapters._INOTIFY_EVENT(wd=dirwd, mask=1073741825, cookie=0, len=0), ('IN_ACCESS', 'IN_ISDIR'), dirpath, ''),
+                        (inotify.adapters._INOTIFY_EVENT(wd=parentwd, mask=1073741840, cookie=0, len=16), ('IN_CLOSE_NOWRITE', 'IN_ISDIR'), parentpath, dirname),
+                        (inotify.adapters._INOTIFY_EVENT(wd=dirwd, mask=1073741840, cookie=0, len=0), ('IN_CLOSE_NOWRITE', 'IN_ISDIR'), dirpath, ''),
+                    ]
+                    discovered_subdirs_expects[parentpath].append((dirpath, expects))
+                    discovered_subdirs_expects[dirpath] = []
+            else:
+                expected = [
+                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741856, cookie=0, len=0), ('IN_OPEN', 'IN_ISDIR'), path, ''),
+                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741840, cookie=0, len=0), ('IN_CLOSE_NOWRITE', 'IN_ISDIR'), path, ''),
+                ]
+                for dirpath, dirwd in sorted(watches.items(), key=lambda tup: tup[1])[1:]:
+                    parentpath, dirname = os.path.split(dirpath)
+                    parentwd = watches[parentpath]
+                    expects = [
+                        (inotify.adapters._INOTIFY_EVENT(wd=parentwd, mask=1073741856, cookie=0, len=16), ('IN_OPEN', 'IN_ISDIR'), parentpath, dirname),
+                        (inotify.adapters._INOTIFY_EVENT(wd=dirwd, mask=1073741856, cookie=0, len=0), ('IN_OPEN', 'IN_ISDIR'), dirpath, ''),
+                        (inotify.adapters._INOTIFY_EVENT(wd=parentwd, mask=1073741840, cookie=0, len=16), ('IN_CLOSE_NOWRITE', 'IN_ISDIR'), parentpath, dirname),
+                        (inotify.adapters._INOTIFY_EVENT(wd=dirwd, mask=1073741840, cookie=0, len=0), ('IN_CLOSE_NOWRITE', 'IN_ISDIR'), dirpath, ''),
+                    ]
+                    discovered_subdirs_expects[parentpath].append((dirpath, expects))
+                    discovered_subdirs_expects[dirpath] = []
+
+            for dirpath, expects in discovered_subdirs_expects[path]:
+                expected += expects
+                for dirpath, expects in discovered_subdirs_expects[dirpath]:
+                    expected += expects
+                    for dirpath, expects in discovered_subdirs_expects[dirpath]:
+                        expected += expects
+
+            self.assertEquals(events, expected)
+
+    def test__move_ignored_subdirectories(self):
+        with inotify.test_support.temp_path() as path:
+            path1 = os.path.join(path, 'aa')
+            path2 = os.path.join(path, 'bb')
+
+            os.makedirs(os.path.join(path1, 'skip'))
+            os.makedirs(os.path.join(path1, 'out'))
+
+            i = inotify.adapters.InotifyTree(
+                    path, mask=inotify.constants.IN_CREATE | inotify.constants.IN_MOVED_TO,
+                    ignored_dirs=[os.path.join(path1, 'skip')],
+                    ignored_patterns=['/aa/out'])
+
+            self.assertEquals(sorted(i._i._Inotify__watches.keys()), [path, path1])
+
+            # Neither is ignored at the new location.
+            os.rename(path1, path2)
+            i.read_events(timeout_s=1)
+
+            expected_watches = [
+                path,
+                path2,
+                os.path.join(path2, 'out'),
+                os.path.join(path2, 'skip'),
+            ]
+
+            self.assertEquals(sorted(i._i._Inotify__watches.keys()), expected_watches)
+
+            for name in ('skip', 'out'):
+                with open(os.path.join(path2, name, 'seen_new_file'), 'w'):
+                    pass
+
+            events = i.read_events(timeout_s=1)
+            self.assertEquals(sorted((p, f) for (_, _, p, f) in events), [
+                (os.path.join(path2, 'out'), 'seen_new_file'),
+                (os.path.join(path2, 'skip'), 'seen_new_file'),
+            ])
+
+    @unittest.skipIf(inotify.adapters.scandir is None or inotify.adapters._HAS_FUTURES is False,
+                     "Needs scandir and concurrent.futures")
+    def test__parallel_load(self):
+        with inotify.test_support.temp_path() as path:
+            for foldernum1 in range(1,5):
+                path1 = os.path.join(path, 'folder%d' % foldernum1)
+                os.mkdir(path1)
+                for foldernum2 in range(1,4):
+                    os.mkdir(os.path.join(path1, 'subfolder%d' % foldernum2))
+
+            os.symlink(os.path.join(path, 'folder1'), os.path.join(path, 'link1'))
+
+            ignored_dirs = (os.path.join(path, 'folder2', 'subfolder1'),
+                            os.path.join(path, 'folder3'),
+            )
+
+            serial = inotify.adapters.InotifyTree(path, ignored_dirs=ignored_dirs)
+            parallel = inotify.adapters.InotifyTree(path, ignored_dirs=ignored_dirs,
+                                                    load_workers=4)
+
+            self.assertEquals(
+                sorted(parallel._i._Inotify__watches.keys()),
+                sorted(serial._i._Inotify__watches.keys()))
+
+            self.assertNotIn(os.path.join(path, 'link1', 'subfolder1'),
+                             parallel._i._Inotify__watches)
+
+            # The same order as a serial walk.
+            self.assertEquals(
+                [p for (p, _) in parallel._load_tree(path, workers=4)],
+                [p for (p, _) in serial._load_tree(path)])
+
+            stats = parallel.load_stats
+            self.assertEquals(stats['directories'], 13)
+            self.assertEquals(stats['workers'], 4)
+
+    def __check_index(self, load_workers):
+        with inotify.test_support.temp_path() as path:
+            path1 = os.path.join(path, 'aa')
+            path2 = os.path.join(path1, 'bb')
+            os.makedirs(path2)
+
+            with open(os.path.join(path1, 'file1'), 'w'):
+                pass
+
+            i = inotify.adapters.InotifyTree(path, index=True,
+                                             load_workers=load_workers)
+            index = i.index
+
+            self.assertEquals(index.listdir(path), ['aa'])
+            self.assertEquals(index.listdir(path1), ['bb', 'file1'])
+            self.assertEquals(index.listdir(os.path.join(path1, 'file1')), None)
+            self.assertTrue(index.exists(os.path.join(path1, 'file1')))
+            self.assertTrue(index.is_dir(path2))
+            self.assertFalse(index.is_dir(os.path.join(path1, 'file1')))
+            self.assertFalse(index.exists(os.path.join(path1, 'file2')))
+
+            os.remove(os.path.join(path1, 'file1'))
+            with open(os.path.join(path2, 'file2'), 'w'):
+                pass
+
+            os.rename(path2, os.path.join(path, 'cc'))
+            os.mkdir(os.path.join(path, 'dd'))
+
+            list(i.event_gen(timeout_s=1, yield_nones=False))
+
+            path3 = os.path.join(path, 'cc')
+            path4 = os.path.join(path, 'dd')
+
+            expected = [
+                (path, ['aa', 'cc', 'dd'], []),
+                (path1, [], []),
+                (path3, [], ['file2']),
+                (path4, [], []),
+            ]
+
+            self.assertEquals(sorted(index.walk(path)), expected)
+            self.assertFalse(index.exists(path2))
+            self.assertEquals(len(index), 4)
+
+    def test__index(self):
+        self.__check_index(None)
+
+    def test__index_parallel_load(self):
+        self.__check_index(4)
+
+    def test__index_stat(self):
+        with inotify.test_support.temp_path() as path:
+            file_path = os.path.join(path, 'file1')
+            with open(file_path, 'w'):
+                pass
+
+            i = inotify.adapters.InotifyTree(path, index=True, index_stat=True)
+            self.assertEquals(i.index.stat(file_path)[2], 0)
+
+            with open(file_path, 'w') as f:
+                f.write('abc')
+
+            list(i.event_gen(timeout_s=1, yield_nones=False))
+
+            st = os.stat(file_path)
+            self.assertEquals(i.index.stat(file_path),
+                              (st.st_ino, st.st_mtime, 3, False))
+
+    def test__checkpoint(self):
+        with inotify.test_support.temp_path() as checkpoint_path:
+            self.__check_checkpoint(os.path.join(checkpoint_path, 'checkpoint'))
+
+    def __check_checkpoint(self, checkpoint_filepath):
+        with inotify.test_support.temp_path() as path:
+            path1 = os.path.join(path, 'aa')
+            path2 = os.path.join(path1, 'bb')
+            path3 = os.path.join(path, 'cc')
+            path4 = os.path.join(path, 'dd')
+            os.makedirs(path2)
+            os.mkdir(path3)
+
+            with open(os.path.join(path2, 'file1'), 'w'):
+                pass
+
+            # Nothing has changed in a while.
+            for directory in (path, path1, path2, path3):
+                os.utime(directory, (time.time() - 60, time.time() - 60))
+
+            i = inotify.adapters.InotifyTree(path, index=True)
+            i.save_checkpoint(checkpoint_filepath)
+            del i
+
+            # While we're down.
+            with open(os.path.join(path1, 'new_file'), 'w'):
+                pass
+
+            os.rmdir(path3)
+            os.mkdir(path4)
+            with open(os.path.join(path4, 'file2'), 'w'):
+                pass
+
+            i = inotify.adapters.InotifyTree(path, checkpoint=checkpoint_filepath)
+
+            # The top and "aa" have changed, "bb" hasn't.
+            self.assertEquals(i.load_stats['relisted'], 2)
+
+            mask = inotify.constants.IN_CREATE | inotify.constants.IN_DELETE
+            events = list(i.event_gen(timeout_s=0.1, yield_nones=False, mask=mask))
+            found = sorted((type_names, event_path, filename)
+                           for (_, type_names, event_path, filename) in events)
+
+            expected = [
+                (('IN_CREATE', 'IN_ISDIR', 'IN_SYNTHETIC'), path, 'dd'),
+                (('IN_CREATE', 'IN_SYNTHETIC'), path1, 'new_file'),
+                (('IN_CREATE', 'IN_SYNTHETIC'), path4, 'file2'),
+                (('IN_DELETE', 'IN_ISDIR', 'IN_SYNTHETIC'), path, 'cc'),
+            ]
+
+            self.assertEquals(found, expected)
+
+            self.assertEquals(
+                sorted(p for (p, _) in i.inotify._get_watch_tree(path)),
+                [path, path1, path2, path4])
+
+            self.assertEquals(i.index.listdir(path2), ['file1'])
+
+            # Anything else is loaded from scratch.
+            with open(checkpoint_filepath, 'wb') as f:
+                f.write(b'not a checkpoint')
+
+            i = inotify.adapters.InotifyTree(path, checkpoint=checkpoint_filepath)
+            self.assertEquals(i.load_stats['relisted'], 0)
+            self.assertEquals(i.load_stats['directories'], 4)
+
+    def test__checkpoint_missing_record(self):
+        with inotify.test_support.temp_path() as checkpoint_path:
+            checkpoint_filepath = os.path.join(checkpoint_path, 'checkpoint')
+
+            with inotify.test_support.temp_path() as path:
+                path1 = os.path.join(path, 'aa')
+                path2 = os.path.join(path1, 'bb')
+                os.makedirs(path2)
+
+                with open(os.path.join(path2, 'file1'), 'w'):
+                    pass
+
+                for directory in (path, path1, path2):
+                    os.utime(directory, (time.time() - 60, time.time() - 60))
+
+                i = inotify.adapters.InotifyTree(path, index=True)
+                i.save_checkpoint(checkpoint_filepath)
+                del i
+
+                # Drop the record of "aa" (which "bb" is below).
+                trees = inotify.adapters._read_checkpoint(checkpoint_filepath)
+                inotify.adapters._write_checkpoint(checkpoint_filepath, [
+                    (root, [(p, ino, mtime, stamp_s, sorted(entries.items()))
+                            for (p, ino, mtime, stamp_s, entries) in directories
+                            if p != path1])
+                    for (root, directories) in trees.items()])
+
+                i = inotify.adapters.InotifyTree(path, checkpoint=checkpoint_filepath)
+
+                self.assertEquals(i.load_stats['relisted'], 1)
+                self.assertEquals(
+                    sorted(p for (p, _) in i.inotify._get_watch_tree(path)),
+                    [path, path1, path2])
+
+                self.assertEquals(i.index.listdir(path2), ['file1'])
+
+                # Nothing is made up for it.
+                mask = inotify.constants.IN_CREATE | inotify.constants.IN_DELETE
+                self.assertEquals(list(i.event_gen(timeout_s=0.1, yield_nones=False, mask=mask)), [])
+
+    def test__emit_existing(self):
+        with inotify.test_support.temp_path() as path:
+            path1 = os.path.join(path, 'aa')
+            path2 = os.path.join(path1, 'bb')
+            os.makedirs(path2)
+
+            with open(os.path.join(path, 'file1'), 'w'):
+                pass
+
+            with open(os.path.join(path2, 'file2'), 'w'):
+                pass
+
+            i = inotify.adapters.InotifyTree(path, emit_existing=True)
+
+            # Only the top has been walked so far.
+            self.assertEquals(i.load_stats['directories'], 2)
+
+            events = i.event_gen(yield_nones=False, mask=inotify.constants.IN_CREATE)
+
+            found = []
+            for (_, type_names, event_path, filename) in events:
+                found.append((type_names, event_path, filename))
+                if len(found) == 3:
+                    break
+
+            expected = [
+                (('IN_CREATE', 'IN_ISDIR', 'IN_SYNTHETIC'), path, 'aa'),
+                (('IN_CREATE', 'IN_SYNTHETIC'), path, 'file1'),
+                (('IN_CREATE', 'IN_ISDIR', 'IN_SYNTHETIC'), path1, 'bb'),
+            ]
+
+            self.assertEquals(found, expected)
+
+            # In a directory that we've already walked.
+            with open(os.path.join(path1, 'file3'), 'w'):
+                pass
+
+            found = [(type_names, event_path, filename)
+                     for (_, type_names, event_path, filename)
+                     in i.event_gen(timeout_s=0.1, yield_nones=False,
+                                    mask=inotify.constants.IN_CREATE)]
+
+            expected = [
+                (('IN_CREATE', 'IN_SYNTHETIC'), path2, 'file2'),
+                (('IN_CREATE',), path1, 'file3'),
+            ]
+
+            self.assertEquals(found, expected)
+
+            self.assertEquals(i.load_stats['directories'], 3)
+            self.assertEquals(
+                sorted(p for (p, _) in i.inotify._get_watch_tree(path)),
+                [path, path1, path2])
+
+    def test__progressive(self):
+        with inotify.test_support.temp_path() as path:
+            for n1 in range(10):
+                for n2 in range(10):
+                    os.makedirs(os.path.join(path, 'aa%d' % n1, 'bb%d' % n2))
+
+            i = inotify.adapters.InotifyTree(path, progressive=True)
+
+            # Only the top has been listed.
+            self.assertEquals(i.load_progress, (1, 10))
+            self.assertTrue(i.loading)
+
+            # Events flow for what's already watched.
+            with open(os.path.join(path, 'aa0', 'file1'), 'w'):
+                pass
+
+            events = i.event_gen(yield_nones=False, mask=inotify.constants.IN_CREATE)
+            (_, type_names, event_path, filename) = next(events)
+
+            self.assertEquals((type_names, event_path, filename),
+                              (('IN_CREATE',), os.path.join(path, 'aa0'), 'file1'))
+
+            # The walk gets on in-between.
+            list(i.event_gen(timeout_s=0.5, yield_nones=False))
+
+            self.assertFalse(i.loading)
+            self.assertEquals(i.load_progress, (111, 0))
+            self.assertEquals(len(i.inotify._get_watch_tree(path)), 111)
+
+            with open(os.path.join(path, 'aa9', 'bb9', 'file2'), 'w'):
+                pass
+
+            found = [(event_path, filename)
+                     for (_, _, event_path, filename)
+                     in i.event_gen(timeout_s=0.1, yield_nones=False,
+                                    mask=inotify.constants.IN_CREATE)]
+
+            self.assertEquals(found, [(os.path.join(path, 'aa9', 'bb9'), 'file2')])
+
+    def test__progressive_move(self):
+        with inotify.test_support.temp_path() as path:
+            path1 = os.path.join(path, 'aa', 'bb', 'cc')
+            os.makedirs(path1)
+
+            i = inotify.adapters.InotifyTree(path, progressive=True)
+
+            # "aa" is watched but hasn't been listed yet.
+            path2 = os.path.join(path, 'dd')
+            os.rename(os.path.join(path, 'aa'), path2)
+
+            list(i.event_gen(timeout_s=0.1, yield_nones=False))
+
+            self.assertFalse(i.loading)
+            self.assertEquals(
+                sorted(p for (p, _) in i.inotify._get_watch_tree(path)),
+                [path, path2, os.path.join(path2, 'bb'),
+                 os.path.join(path2, 'bb', 'cc')])
+
+    def test__watch_budget(self):
+        with inotify.test_support.temp_path() as path:
+            paths = [os.path.join(path, 'aa%d' % n) for n in range(6)]
+            for directory in paths:
+                os.mkdir(directory)
+
+            # Nothing has changed in a while.
+            for directory in [path] + paths:
+                os.utime(directory, (time.time() - 60, time.time() - 60))
+
+            i = inotify.adapters.InotifyTree(path, watch_budget=3,
+                                             poll_interval_s=0.1)
+
+            # The top, and the first two that were found.
+            watched = sorted(p for (p, _) in i.inotify._get_watch_tree(path))
+            self.assertEquals(len(watched), 3)
+            self.assertEquals(watched[0], path)
+
+            polled = sorted(set(paths) - set(watched))
+
+            stats = i.budget_stats
+            self.assertEquals((stats['budget'], stats['watched'], stats['polled'],
+                               stats['evicted']),
+                              (3, 3, 4, 0))
+
+            with open(os.path.join(polled[0], 'file1'), 'w'):
+                pass
+
+            with open(os.path.join(watched[2], 'file2'), 'w'):
+                pass
+
+            mask = inotify.constants.IN_CREATE
+            events = list(i.event_gen(timeout_s=0.3, yield_nones=False, mask=mask))
+            found = [(type_names, event_path, filename)
+                     for (_, type_names, event_path, filename) in events]
+
+            expected = [
+                (('IN_CREATE',), watched[2], 'file2'),
+                (('IN_CREATE', 'IN_SYNTHETIC'), polled[0], 'file1'),
+            ]
+
+            self.assertEquals(found, expected)
+
+            # It's reported under its new watch (not that of an overflow).
+            self.assertEquals(events[1][0].wd, i.inotify._get_watch_wd(polled[0]))
+
+            # The ones that are still polled have their own.
+            wds = [i._poller.get_wd(directory) for directory in polled[1:]]
+            self.assertEquals(len(set(wds)), 3)
+            self.assertTrue(max(wds) < -1)
+            self.assertEquals(i._poller.get_wd(polled[1]), wds[0])
+
+            # It's active now, so it's watched in place of the one that's been
+            # quiet the longest.
+            self.assertEquals(
+                sorted(p for (p, _) in i.inotify._get_watch_tree(path)),
+                sorted([path, polled[0], watched[2]]))
+
+            stats = i.budget_stats
+            self.assertEquals((stats['watched'], stats['polled'], stats['evicted'],
+                               stats['promoted']),
+                              (3, 4, 1, 1))
+
+            # A new directory is as active as it gets.
+            path1 = os.path.join(polled[1], 'bb')
+            os.mkdir(path1)
+            list(i.event_gen(timeout_s=0.3, yield_nones=False))
+
+            with open(os.path.join(path1, 'file3'), 'w'):
+                pass
+
+            found = [(type_names, event_path, filename)
+                     for (_, type_names, event_path, filename)
+                     in i.event_gen(timeout_s=0.3, yield_nones=False, mask=mask)]
+
+            self.assertEquals(found, [(('IN_CREATE',), path1, 'file3')])
+
+            stats = i.budget_stats
+            self.assertEquals((stats['watched'], stats['polled']), (3, 5))
+
+    def test__shards(self):
+        with inotify.test_support.temp_path() as path:
+            for n in range(6):
+                os.makedirs(os.path.join(path, 'aa%d' % n, 'bb'))
+
+            i = inotify.adapters.InotifyTree(path, shards=3)
+
+            shard_stats = i.inotify.shard_stats
+            self.assertEquals(len(shard_stats), 3)
+
+            # Every subtree is kept together.
+            watches = i.inotify._get_watch_tree(path)
+            self.assertEquals(sum(stats['watches'] for stats in shard_stats),
+                              len(watches))
+
+            self.assertTrue(all(stats['watches'] > 0 for stats in shard_stats))
+
+            wds = dict(watches)
+            for n in range(6):
+                self.assertEquals(wds[os.path.join(path, 'aa%d' % n)] % 3,
+                                  wds[os.path.join(path, 'aa%d' % n, 'bb')] % 3)
+
+            # Across shards.
+            old_path = os.path.join(path, 'aa0', 'bb')
+            new_path = [os.path.join(path, 'aa%d' % n, 'cc')
+                        for n in range(1, 6)
+                        if wds[os.path.join(path, 'aa%d' % n)] % 3 != wds[old_path] % 3][0]
+
+            os.rename(old_path, new_path)
+            list(i.event_gen(timeout_s=0.1, yield_nones=False))
+
+            self.assertEquals(i.inotify._get_watch_wd(new_path), wds[old_path])
+            self.assertIsNone(i.inotify._get_watch_wd(old_path))
+
+            for n in range(6):
+                with open(os.path.join(path, 'aa%d' % n, 'file%d' % n), 'w'):
+                    pass
+
+            with open(os.path.join(new_path, 'file6'), 'w'):
+                pass
+
+            mask = inotify.constants.IN_CREATE
+            found = sorted((event_path, filename)
+                           for (_, _, event_path, filename)
+                           in i.event_gen(timeout_s=0.1, yield_nones=False, mask=mask))
+
+            expected = sorted([(os.path.join(path, 'aa%d' % n), 'file%d' % n)
+                               for n in range(6)] + [(new_path, 'file6')])
+
+            self.assertEquals(found, expected)
+
+            shard_stats = i.inotify.shard_stats
+            self.assertTrue(all(stats['events'] > 0 for stats in shard_stats))
+            self.assertEquals([stats['queued_bytes'] for stats in shard_stats],
+                              [0, 0, 0])
+
+    @unittest.skipIf(inotify.adapters.scandir is None or inotify.adapters._HAS_FUTURES is False,
+                     "Needs scandir and concurrent.futures")
+    def test__shards_parallel_load(self):
+        with inotify.test_support.temp_path() as path:
+            for n1 in range(20):
+                for n2 in range(20):
+                    os.makedirs(os.path.join(path, 'aa%d' % n1, 'bb%d' % n2))
+
+            i = inotify.adapters.InotifyTree(path, shards=3, load_workers=8)
+
+            # The watches were added from several threads.
+            watches = i.inotify._get_watch_tree(path)
+            self.assertEquals(len(watches), 421)
+            self.assertEquals(sum(stats['watches'] for stats in i.inotify.shard_stats),
+                              len(watches))
+
+    def test__ignored_patterns(self):
+        with inotify.test_support.temp_path() as path:
+            for subpath in ('src/node_modules/left-pad',
+                            'src/lib/__pycache__',
+                            'src/lib/node_modules',
+                            'build/output/deep',
+                            'docs/build/output',
+                            '.git/objects'):
+                os.makedirs(os.path.join(path, subpath))
+
+            ignored_patterns = ('node_modules', '__pycache__/', '/build/output',
+                                '.git', '*.pyc')
+
+            expected_watches = sorted([
+                path,
+                os.path.join(path, 'src'),
+                os.path.join(path, 'src', 'lib'),
+                os.path.join(path, 'build'),
+                os.path.join(path, 'docs'),
+                os.path.join(path, 'docs', 'build'),
+                os.path.join(path, 'docs', 'build', 'output'),
+            ])
+
+            for load_workers in (None, 2):
+                if load_workers is not None and \
+                   (inotify.adapters.scandir is None or inotify.adapters._HAS_FUTURES is False):
+                    continue
+
+                i = inotify.adapters.InotifyTree(
+                        path, mask=inotify.constants.IN_CREATE,
+                        ignored_patterns=ignored_patterns,
+                        ignore_matching_events=True,
+                        load_workers=load_workers)
+
+                watches = i._i._Inotify__watches
+                self.assertEquals(sorted(watches.keys()), expected_watches)
+                self.assertEquals(i.load_stats['pruned'], 5)
+
+            # Directories that come along later are pruned too, and the events
+            # for matching files and directories are dropped.
+            os.mkdir(os.path.join(path, 'docs', 'node_modules'))
+            with open(os.path.join(path, 'docs', 'seen_new_file'), 'w'):
+                pass
+            with open(os.path.join(path, 'docs', 'ignored.pyc'), 'w'):
+                pass
+
+            events = list(i.event_gen(timeout_s=0.5, yield_nones=False))
+
+            expected = [
+                (inotify.adapters._INOTIFY_EVENT(wd=watches[os.path.join(path, 'docs')], mask=256, cookie=0, len=16), ('IN_CREATE',), os.path.join(path, 'docs'), 'seen_new_file'),
+            ]
+
+            self.assertEquals(events, expected)
+            self.assertEquals(sorted(watches.keys()), expected_watches)
+            self.assertEquals(i.load_stats['pruned'], 6)
+
+    def test__read_batch(self):
+        with inotify.test_support.temp_path() as path:
+            path1 = os.path.join(path, 'aa')
+
+            i = inotify.adapters.InotifyTree(path, mask=inotify.constants.IN_CREATE)
+
+            os.mkdir(path1)
+
+            batch = i.read_batch(timeout_s=1)
+
+            expected = [
+                (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073742080, cookie=0, len=16), ('IN_CREATE', 'IN_ISDIR'), path, 'aa'),
+            ]
+
+            self.assertEquals(batch, expected)
+
+            with open(os.path.join(path1, 'seen_new_file'), 'w'):
+                pass
+
+            batch = i.read_batch(timeout_s=1)
+
+            expected = [
+                (inotify.adapters._INOTIFY_EVENT(wd=2, mask=256, cookie=0, len=16), ('IN_CREATE',), path1, 'seen_new_file'),
+            ]
+
+            self.assertEquals(batch, expected)
+
+    def test__read_events(self):
+        with inotify.test_support.temp_path() as path:
+            path1 = os.path.join(path, 'aa')
+
+            i = inotify.adapters.InotifyTree(path, mask=inotify.constants.IN_CREATE)
+
+            self.assertFalse(i.poll(0))
+
+            os.mkdir(path1)
+            with open(os.path.join(path, 'seen_new_file1'), 'w'):
+                pass
+
+            batch = i.read_events(max_events=1, timeout_s=1)
+
+            expected = [
+                (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073742080, cookie=0, len=16), ('IN_CREATE', 'IN_ISDIR'), path, 'aa'),
+            ]
+
+            self.assertEquals(batch, expected)
+
+            # The new directory is watched already, and the rest is kept.
+            with open(os.path.join(path1, 'seen_new_file2'), 'w'):
+                pass
+
+            self.assertTrue(i.poll(0))
+
+            batch = i.read_events(timeout_s=1)
+
+            expected = [
+                (inotify.adapters._INOTIFY_EVENT(wd=1, mask=256, cookie=0, len=16), ('IN_CREATE',), path, 'seen_new_file1'),
+            ]
+
+            self.assertEquals(batch, expected)
+
+            batch = i.read_events(timeout_s=1)
+
+            expected = [
+                (inotify.adapters._INOTIFY_EVENT(wd=2, mask=256, cookie=0, len=16), ('IN_CREATE',), path1, 'seen_new_file2'),
+            ]
+
+            self.assertEquals(batch, expected)
+            self.assertEquals(i.read_events(timeout_s=0), [])
+
+    def test__push_masks(self):
+        with inotify.test_support.temp_path() as path:
+            path1 = os.path.join(path, 'aa')
+
+            i = inotify.adapters.InotifyTree(path, block_duration_s=0.1,
+                                             push_masks=True)
+
+            events = i.event_gen(mask=inotify.constants.IN_CLOSE_WRITE)
+
+            # We're a consumer once we've started.
+            self.assertEquals(next(events), None)
+
+            with open(os.path.join(path, 'seen_file'), 'w'):
+                pass
+
+            # The tree still sees the directories.
+            os.mkdir(path1)
+
+            found = []
+            for event in events:
+                if event is None:
+                    break
+
+                found.append(event)
+
+            with open(os.path.join(path1, 'seen_new_file'), 'w'):
+                pass
+
+            for event in events:
+                if event is None:
+                    break
+
+                found.append(event)
+
+            expected = [
+                (inotify.adapters._INOTIFY_EVENT(wd=1, mask=8, cookie=0, len=16), ('IN_CLOSE_WRITE',), path, 'seen_file'),
+                (inotify.adapters._INOTIFY_EVENT(wd=2, mask=8, cookie=0, len=16), ('IN_CLOSE_WRITE',), path1, 'seen_new_file'),
+            ]
+
+            self.assertEquals(found, expected)
+            self.assertEquals(i.inotify.consumer_mask,
+                              inotify.constants.IN_CLOSE_WRITE | inotify.adapters._TREE_CURATION_MASK)
+
+            events.close()
+
+    def test__recover_overflow(self):
+        with inotify.test_support.temp_path() as path:
+            path1 = os.path.join(path, 'aa')
+            path2 = os.path.join(path, 'bb')
+            os.mkdir(path1)
+
+            for name in ('removed_file', 'changed_file'):
+                with open(os.path.join(path, name), 'w') as f:
+                    f.write('x')
+
+            mask = inotify.constants.IN_CREATE | \
+                   inotify.constants.IN_DELETE | \
+                   inotify.constants.IN_MODIFY | \
+                   inotify.constants.IN_Q_OVERFLOW
+
+            i = inotify.adapters.InotifyTree(path, mask=mask, recover_overflow=True)
+
+            with open('/proc/sys/fs/inotify/max_queued_events') as f:
+                max_queued_events = int(f.read())
+
+            names = set('file%d' % n for n in range(max_queued_events + 100))
+            for name in names:
+                with open(os.path.join(path1, name), 'w'):
+                    pass
+
+            os.remove(os.path.join(path, 'removed_file'))
+
+            with open(os.path.join(path, 'changed_file'), 'a') as f:
+                f.write('y')
+
+            os.mkdir(path2)
+            with open(os.path.join(path2, 'seen_new_file'), 'w'):
+                pass
+
+            events = list(i.event_gen(timeout_s=1, yield_nones=False))
+
+            # What was lost is made up for, once.
+            created = [filename
+                       for (_, type_names, event_path, filename) in events
+                       if event_path == path1]
+
+            self.assertEquals(len(created), len(names))
+            self.assertEquals(set(created), names)
+
+            expected = [
+                (inotify.adapters._INOTIFY_EVENT(wd=-1, mask=16384, cookie=0, len=0), ('IN_Q_OVERFLOW',), '', ''),
+                (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1049088, cookie=0, len=0), ('IN_DELETE', 'IN_SYNTHETIC'), path, 'removed_file'),
+                (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1074790656, cookie=0, len=0), ('IN_CREATE', 'IN_ISDIR', 'IN_SYNTHETIC'), path, 'bb'),
+                (inotify.adapters._INOTIFY_EVENT(wd=3, mask=1048832, cookie=0, len=0), ('IN_CREATE', 'IN_SYNTHETIC'), path2, 'seen_new_file'),
+                (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1048578, cookie=0, len=0), ('IN_MODIFY', 'IN_SYNTHETIC'), path, 'changed_file'),
+            ]
+
+            self.assertEquals([e for e in events if e[2] != path1], expected)
+
+            # The watches stayed and the new directory is watched.
+            watches = i.inotify._get_watch_tree(path)
+            self.assertEquals(sorted(watches), [(path, 1), (path1, 2), (path2, 3)])
 
     def test__moving_readded_folder(self):
         #test for https://github.com/dsoprea/PyInotify/issues/46
@@ -770,12 +2529,12 @@ class TestInotifyTree(unittest.TestCase):
             events = self.__read_all_events(i)
 
             expected = [
-                (inotify.adapters._INOTIFY_EVENT(wd=2, mask=256, cookie=0, len=16), ['IN_CREATE'], path1, 'file1'),
-                (inotify.adapters._INOTIFY_EVENT(wd=2, mask=32, cookie=0, len=16), ['IN_OPEN'], path1, 'file1'),
-                (inotify.adapters._INOTIFY_EVENT(wd=2, mask=8, cookie=0, len=16), ['IN_CLOSE_WRITE'], path1, 'file1'),
-                (inotify.adapters._INOTIFY_EVENT(wd=2, mask=256, cookie=0, len=16), ['IN_CREATE'], path1, 'file2'),
-                (inotify.adapters._INOTIFY_EVENT(wd=2, mask=32, cookie=0, len=16), ['IN_OPEN'], path1, 'file2'),
-                (inotify.adapters._INOTIFY_EVENT(wd=2, mask=8, cookie=0, len=16), ['IN_CLOSE_WRITE'], path1, 'file2'),
+                (inotify.adapters._INOTIFY_EVENT(wd=2, mask=256, cookie=0, len=16), ('IN_CREATE',), path1, 'file1'),
+                (inotify.adapters._INOTIFY_EVENT(wd=2, mask=32, cookie=0, len=16), ('IN_OPEN',), path1, 'file1'),
+                (inotify.adapters._INOTIFY_EVENT(wd=2, mask=8, cookie=0, len=16), ('IN_CLOSE_WRITE',), path1, 'file1'),
+                (inotify.adapters._INOTIFY_EVENT(wd=2, mask=256, cookie=0, len=16), ('IN_CREATE',), path1, 'file2'),
+                (inotify.adapters._INOTIFY_EVENT(wd=2, mask=32, cookie=0, len=16), ('IN_OPEN',), path1, 'file2'),
+                (inotify.adapters._INOTIFY_EVENT(wd=2, mask=8, cookie=0, len=16), ('IN_CLOSE_WRITE',), path1, 'file2'),
             ]
             self.assertEquals(events, expected)
 
@@ -810,12 +2569,12 @@ class TestInotifyTree(unittest.TestCase):
 
             wd = watches[path1]
             expected = [
-                (inotify.adapters._INOTIFY_EVENT(wd=wd, mask=256, cookie=0, len=16), ['IN_CREATE'], path1, 'file1'),
-                (inotify.adapters._INOTIFY_EVENT(wd=wd, mask=32, cookie=0, len=16), ['IN_OPEN'], path1, 'file1'),
-                (inotify.adapters._INOTIFY_EVENT(wd=wd, mask=8, cookie=0, len=16), ['IN_CLOSE_WRITE'], path1, 'file1'),
-                (inotify.adapters._INOTIFY_EVENT(wd=wd, mask=256, cookie=0, len=16), ['IN_CREATE'], path1, 'file2'),
-                (inotify.adapters._INOTIFY_EVENT(wd=wd, mask=32, cookie=0, len=16), ['IN_OPEN'], path1, 'file2'),
-                (inotify.adapters._INOTIFY_EVENT(wd=wd, mask=8, cookie=0, len=16), ['IN_CLOSE_WRITE'], path1, 'file2'),
+                (inotify.adapters._INOTIFY_EVENT(wd=wd, mask=256, cookie=0, len=16), ('IN_CREATE',), path1, 'file1'),
+                (inotify.adapters._INOTIFY_EVENT(wd=wd, mask=32, cookie=0, len=16), ('IN_OPEN',), path1, 'file1'),
+                (inotify.adapters._INOTIFY_EVENT(wd=wd, mask=8, cookie=0, len=16), ('IN_CLOSE_WRITE',), path1, 'file1'),
+                (inotify.adapters._INOTIFY_EVENT(wd=wd, mask=256, cookie=0, len=16), ('IN_CREATE',), path1, 'file2'),
+                (inotify.adapters._INOTIFY_EVENT(wd=wd, mask=32, cookie=0, len=16), ('IN_OPEN',), path1, 'file2'),
+                (inotify.adapters._INOTIFY_EVENT(wd=wd, mask=8, cookie=0, len=16), ('IN_CLOSE_WRITE',), path1, 'file2'),
             ]
             self.assertEquals(events, expected)
 
@@ -857,29 +2616,29 @@ class TestInotifyTrees(unittest.TestCase):
 
             if self._HAS_DIRECTORY_ACCESS_EVENTS:
                 expected = [
-                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741856, cookie=0, len=0), ['IN_OPEN', 'IN_ISDIR'], path1, ''),
-                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741825, cookie=0, len=0), ['IN_ACCESS', 'IN_ISDIR'], path1, ''),
-                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741840, cookie=0, len=0), ['IN_CLOSE_NOWRITE', 'IN_ISDIR'], path1, ''),
-                    (inotify.adapters._INOTIFY_EVENT(wd=2, mask=1073741856, cookie=0, len=0), ['IN_OPEN', 'IN_ISDIR'], path2, ''),
-                    (inotify.adapters._INOTIFY_EVENT(wd=2, mask=1073741825, cookie=0, len=0), ['IN_ACCESS', 'IN_ISDIR'], path2, ''),
-                    (inotify.adapters._INOTIFY_EVENT(wd=2, mask=1073741840, cookie=0, len=0), ['IN_CLOSE_NOWRITE', 'IN_ISDIR'], path2, ''),
+                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741856, cookie=0, len=0), ('IN_OPEN', 'IN_ISDIR'), path1, ''),
+                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741825, cookie=0, len=0), ('IN_ACCESS', 'IN_ISDIR'), path1, ''),
+                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741840, cookie=0, len=0), ('IN_CLOSE_NOWRITE', 'IN_ISDIR'), path1, ''),
+                    (inotify.adapters._INOTIFY_EVENT(wd=2, mask=1073741856, cookie=0, len=0), ('IN_OPEN', 'IN_ISDIR'), path2, ''),
+                    (inotify.adapters._INOTIFY_EVENT(wd=2, mask=1073741825, cookie=0, len=0), ('IN_ACCESS', 'IN_ISDIR'), path2, ''),
+                    (inotify.adapters._INOTIFY_EVENT(wd=2, mask=1073741840, cookie=0, len=0), ('IN_CLOSE_NOWRITE', 'IN_ISDIR'), path2, ''),
                 ]
             else:
                 expected = [
-                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741856, cookie=0, len=0), ['IN_OPEN', 'IN_ISDIR'], path1, ''),
-                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741840, cookie=0, len=0), ['IN_CLOSE_NOWRITE', 'IN_ISDIR'], path1, ''),
-                    (inotify.adapters._INOTIFY_EVENT(wd=2, mask=1073741856, cookie=0, len=0), ['IN_OPEN', 'IN_ISDIR'], path2, ''),
-                    (inotify.adapters._INOTIFY_EVENT(wd=2, mask=1073741840, cookie=0, len=0), ['IN_CLOSE_NOWRITE', 'IN_ISDIR'], path2, ''),
+                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741856, cookie=0, len=0), ('IN_OPEN', 'IN_ISDIR'), path1, ''),
+                    (inotify.adapters._INOTIFY_EVENT(wd=1, mask=1073741840, cookie=0, len=0), ('IN_CLOSE_NOWRITE', 'IN_ISDIR'), path1, ''),
+                    (inotify.adapters._INOTIFY_EVENT(wd=2, mask=1073741856, cookie=0, len=0), ('IN_OPEN', 'IN_ISDIR'), path2, ''),
+                    (inotify.adapters._INOTIFY_EVENT(wd=2, mask=1073741840, cookie=0, len=0), ('IN_CLOSE_NOWRITE', 'IN_ISDIR'), path2, ''),
                 ]
 
             expected += [
-                (inotify.adapters._INOTIFY_EVENT(wd=1, mask=256, cookie=0, len=16), ['IN_CREATE'], path1, 'seen_new_file1'),
-                (inotify.adapters._INOTIFY_EVENT(wd=1, mask=32, cookie=0, len=16), ['IN_OPEN'], path1, 'seen_new_file1'),
-                (inotify.adapters._INOTIFY_EVENT(wd=1, mask=8, cookie=0, len=16), ['IN_CLOSE_WRITE'], path1, 'seen_new_file1'),
+                (inotify.adapters._INOTIFY_EVENT(wd=1, mask=256, cookie=0, len=16), ('IN_CREATE',), path1, 'seen_new_file1'),
+                (inotify.adapters._INOTIFY_EVENT(wd=1, mask=32, cookie=0, len=16), ('IN_OPEN',), path1, 'seen_new_file1'),
+                (inotify.adapters._INOTIFY_EVENT(wd=1, mask=8, cookie=0, len=16), ('IN_CLOSE_WRITE',), path1, 'seen_new_file1'),
 
-                (inotify.adapters._INOTIFY_EVENT(wd=2, mask=256, cookie=0, len=16), ['IN_CREATE'], path2, 'seen_new_file2'),
-                (inotify.adapters._INOTIFY_EVENT(wd=2, mask=32, cookie=0, len=16), ['IN_OPEN'], path2, 'seen_new_file2'),
-                (inotify.adapters._INOTIFY_EVENT(wd=2, mask=8, cookie=0, len=16), ['IN_CLOSE_WRITE'], path2, 'seen_new_file2'),
+                (inotify.adapters._INOTIFY_EVENT(wd=2, mask=256, cookie=0, len=16), ('IN_CREATE',), path2, 'seen_new_file2'),
+                (inotify.adapters._INOTIFY_EVENT(wd=2, mask=32, cookie=0, len=16), ('IN_OPEN',), path2, 'seen_new_file2'),
+                (inotify.adapters._INOTIFY_EVENT(wd=2, mask=8, cookie=0, len=16), ('IN_CLOSE_WRITE',), path2, 'seen_new_file2'),
             ]
 
             self.assertEquals(events, expected)